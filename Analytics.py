@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Compares the yield of a plant with the yield expected from the 'Unit' settings.
+#
+#  The expected yield of a year is 'expectedYieldKWHperKWP' * 'peakOutputInWP' / 1000, spread over the days of the
+#  year by a seasonal curve. By default the curve is the daily extraterrestrial irradiation at the plant's latitude.
+#  A curve of 12 monthly shares can be given in 'Unit' as 'monthlyYieldShares' instead.
+#
+#  Without irradiation data the expected yield takes the place of the reference yield, so the performance ratio is
+#  the measured specific yield (kWh/kWp) divided by the expected one.
+#
+#  At each day's rollover the day's yield is appended to '<config root>.dailies' (day ordinal as uint32, yield in
+#  Wh as float64) and added to the running sums. The report of all years is only recomputed, vectorized, on start.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import logging
+import os
+from datetime import date, timedelta
+
+import numpy as np
+
+from raspend import ThreadHandlerBase
+
+DAILY_RECORD = np.dtype([("day", "<u4"), ("yield", "<f8")])
+
+def getDailyShares(year, latitude, monthlyShares=None):
+    # The share of each day of 'year' in the year's expected yield.
+    firstDay = np.datetime64("{:04d}-01-01".format(year))
+    days = np.arange(firstDay, np.datetime64("{:04d}-01-01".format(year + 1)))
+    if monthlyShares:
+        months = days.astype("datetime64[M]").astype(int) % 12
+        shares = np.asarray(monthlyShares, dtype=float)
+        return shares[months] / np.bincount(months, minlength=12)[months] / shares.sum()
+
+    # Daily extraterrestrial irradiation on a horizontal plane (FAO 56, equation 21).
+    dayOfYear = np.arange(1, len(days) + 1)
+    phi = np.radians(latitude)
+    declination = 0.409 * np.sin(2 * np.pi * dayOfYear / 365 - 1.39)
+    sunsetAngle = np.arccos(np.clip(-np.tan(phi) * np.tan(declination), -1, 1))
+    distance = 1 + 0.033 * np.cos(2 * np.pi * dayOfYear / 365)
+    irradiation = distance * (sunsetAngle * np.sin(phi) * np.sin(declination) + np.cos(phi) * np.cos(declination) * np.sin(sunsetAngle))
+    return irradiation / irradiation.sum()
+
+def readDailies(fileName):
+    # Returns the stored dailies, one record per day in ascending order.
+    if not os.path.isfile(fileName):
+        return np.zeros(0, dtype=DAILY_RECORD)
+    # A record torn by a crash is dropped, so the following records stay aligned.
+    size = os.path.getsize(fileName)
+    if size % DAILY_RECORD.itemsize:
+        logging.info("Ignoring the incomplete end of {}.".format(fileName))
+        os.truncate(fileName, size - size % DAILY_RECORD.itemsize)
+    dailies = np.fromfile(fileName, dtype=DAILY_RECORD)
+    # Later records of the same day (e.g. after a restart) replace earlier ones.
+    days, lastIndices = np.unique(dailies["day"][::-1], return_index=True)
+    return dailies[::-1][lastIndices]
+
+def toDates(ordinals):
+    return np.datetime64("0001-01-01") + (np.asarray(ordinals, dtype=np.int64) - 1).astype("timedelta64[D]")
+
+class Analytics(ThreadHandlerBase):
+    def __init__(self, configFileName):
+        self.fileName = os.path.splitext(configFileName)[0] + ".dailies"
+        self.shares = dict()
+        self.lastDay = 0
+        self.lastYield = 0.0
+        # Running sums [yield in kWh, expected yield in kWh, days] per year ("2019") and month ("2019-12").
+        self.years = dict()
+        self.months = dict()
+        # Set until the report of the start up was published with the yields read from the inverters.
+        self.startUpPending = False
+
+    def getShares(self, year):
+        if year not in self.shares:
+            self.shares[year] = getDailyShares(year, self.latitude, self.monthlyShares)
+        return self.shares[year]
+
+    def getExpectedYield(self, day):
+        # The expected yield of 'day' in kWh.
+        return self.annualYield * float(self.getShares(day.year)[day.timetuple().tm_yday - 1])
+
+    def getExpectedYieldBetween(self, first, last):
+        # The expected yield from day 'first' up to and including day 'last' in kWh.
+        expected = 0.0
+        for year in range(first.year, last.year + 1):
+            start = first.timetuple().tm_yday - 1 if year == first.year else 0
+            end = last.timetuple().tm_yday if year == last.year else None
+            expected += self.getShares(year)[start:end].sum()
+        return self.annualYield * float(expected)
+
+    def loadDailies(self):
+        return readDailies(self.fileName)
+
+    def computeReport(self, dailies):
+        # Sums yield and expected yield of all stored days per year and month at once.
+        self.years = dict()
+        self.months = dict()
+        if len(dailies) == 0:
+            return
+        self.lastDay = int(dailies["day"][-1])
+        self.lastYield = float(dailies["yield"][-1]) / 1000
+
+        dates = toDates(dailies["day"])
+        years = dates.astype("datetime64[Y]")
+        firstYear = years[0].astype(int) + 1970
+        lastYear = years[-1].astype(int) + 1970
+
+        # The shares of all covered years as one array, indexed by the days since the first year's January 1st.
+        allShares = np.concatenate([self.getShares(year) for year in range(firstYear, lastYear + 1)])
+        expected = self.annualYield * allShares[(dates - np.datetime64("{:04d}-01-01".format(firstYear))).astype(int)]
+        yields = dailies["yield"] / 1000
+
+        for keys, sums in ((years, self.years), (dates.astype("datetime64[M]"), self.months)):
+            labels, indices = np.unique(keys, return_inverse=True)
+            yieldSums = np.bincount(indices, weights=yields)
+            expectedSums = np.bincount(indices, weights=expected)
+            dayCounts = np.bincount(indices)
+            for label, yieldSum, expectedSum, dayCount in zip(labels.astype(str).tolist(), yieldSums, expectedSums, dayCounts):
+                sums[label] = [float(yieldSum), float(expectedSum), int(dayCount)]
+
+    def getRatios(self, yieldKWh, expectedKWh):
+        return { "yield": round(yieldKWh, 3),
+                 "specificYield": round(yieldKWh / self.kWp, 3),
+                 "expectedYield": round(expectedKWh, 3),
+                 "expectedSpecificYield": round(expectedKWh / self.kWp, 3),
+                 "performanceRatio": round(yieldKWh / expectedKWh, 3) if expectedKWh > 0 else None }
+
+    def publish(self, day, dayYield, yearYield, totalYield):
+        # 'day' is the latest complete day, the yields are in kWh.
+        yearStart = max(date(day.year, 1, 1), self.startUp)
+        theAnalytics = { "date": day.isoformat(),
+                         "kWp": self.kWp,
+                         "day": self.getRatios(dayYield, self.getExpectedYield(day)),
+                         "yearToDate": self.getRatios(yearYield, self.getExpectedYieldBetween(yearStart, day) if day >= yearStart else 0),
+                         "sinceStartUp": self.getRatios(totalYield, self.getExpectedYieldBetween(self.startUp, day) if day >= self.startUp else 0)
+                                         if totalYield is not None else None,
+                         "years": { year: dict(self.getRatios(*sums[0:2]), days=sums[2]) for year, sums in sorted(self.years.items()) },
+                         "months": { month: dict(self.getRatios(*sums[0:2]), days=sums[2])
+                                     for month, sums in sorted(self.months.items()) if month.startswith(str(day.year)) } }
+        deviation = theAnalytics["yearToDate"]["performanceRatio"]
+        theAnalytics["yearToDate"]["deviation"] = round((deviation - 1) * 100, 1) if deviation is not None else None
+        self.sharedDict["Analytics"] = theAnalytics
+
+    def getYields(self):
+        # The plant's yields of today, this year and in total, in kWh.
+        dayYield = yearYield = totalYield = 0
+        for inverter in self.sharedDict["Inverters"]:
+            thisState = self.sharedDict[inverter]
+            dayYield += thisState.dayYield
+            yearYield += thisState.totalYieldCurrYear
+            totalYield += thisState.totalYield
+        return dayYield / 1000, yearYield / 1000, totalYield / 1000
+
+    def prepare(self):
+        theUnit = self.sharedDict["Unit"]
+        self.kWp = theUnit["peakOutputInWP"] / 1000
+        self.annualYield = theUnit["expectedYieldKWHperKWP"] * self.kWp
+        self.startUp = date.fromisoformat(theUnit["startUp"])
+        self.latitude = theUnit["location"]["latitude"]
+        self.monthlyShares = theUnit.get("monthlyYieldShares")
+
+        self.computeReport(self.loadDailies())
+        self.publishStartUp()
+
+    def publishStartUp(self):
+        # Until the first rollover, yesterday is the latest complete day.
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        todayYield, yearYield, totalYield = self.getYields()
+        # The yields aren't known before all inverters were read. Until then, the dailies stored so far have to do.
+        self.startUpPending = any(self.sharedDict[inverter].totalYield == 0 for inverter in self.sharedDict["Inverters"])
+        if self.startUpPending or yesterday.year < today.year:
+            yearYield = self.years.get(str(yesterday.year), [0.0])[0]
+            # Today's yield is already stored, if the rollover ran before a restart.
+            if self.lastDay == today.toordinal() and yesterday.year == today.year:
+                yearYield -= self.lastYield
+        else:
+            yearYield -= todayYield
+        self.publish(yesterday, self.lastYield if self.lastDay == yesterday.toordinal() else 0.0, yearYield,
+                     totalYield - todayYield if not self.startUpPending else None)
+
+    def onCompleteCycle(self):
+        # Called by the sampling after each cycle all inverters answered in.
+        if self.startUpPending:
+            self.publishStartUp()
+        return
+
+    def invoke(self):
+        day = date.today()
+        dayYield, yearYield, totalYield = self.getYields()
+
+        # The day's running sums are only added once, a second rollover of the same day replaces them.
+        if day.toordinal() == self.lastDay:
+            for sums in (self.years[str(day.year)], self.months[day.strftime("%Y-%m")]):
+                sums[0] -= self.lastYield
+                sums[1] -= self.getExpectedYield(day)
+                sums[2] -= 1
+
+        try:
+            with open(self.fileName, "ab") as dailiesFile:
+                np.array([(day.toordinal(), dayYield * 1000)], dtype=DAILY_RECORD).tofile(dailiesFile)
+        except IOError as e:
+            logging.error("Unable to write '{}'! Error: {}".format(self.fileName, e))
+
+        for sums in (self.years.setdefault(str(day.year), [0.0, 0.0, 0]), self.months.setdefault(day.strftime("%Y-%m"), [0.0, 0.0, 0])):
+            sums[0] += dayYield
+            sums[1] += self.getExpectedYield(day)
+            sums[2] += 1
+        self.lastDay = day.toordinal()
+        self.lastYield = dayYield
+
+        self.startUpPending = False
+        self.publish(day, dayYield, yearYield, totalYield)
+        return
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Detection of inverters producing less than their siblings, e.g. due to shading, soiling or a fault.
+#
+#  At each cycle the output of every inverter is normalized by its 'maxOutput' and divided by the median of all
+#  normalized outputs of the plant. Each inverter's usual ratio (e.g. lower for a roof facing west in the morning)
+#  is its baseline, an exponential moving average, so memory is bounded by the number of inverters. An inverter is
+#  flagged, once its ratio stays below 'threshold' times its baseline for 'sustain' seconds, and cleared again,
+#  once it stays above for as long. All inverters are compared at once with numpy.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import numpy as np
+
+class AnomalyDetector():
+    # threshold: share of the baseline below which an inverter is low,
+    # sustain: seconds an inverter has to be low (or no longer low) until its flag changes,
+    # baselineHours: time constant of the baselines in hours of sampling,
+    # warmUp: seconds of sampling before an inverter is flagged at all,
+    # minLevel: cycles with a median normalized output below this (e.g. at dawn) are ignored.
+    DEFAULTS = { "threshold": 0.8,
+                 "sustain": 900,
+                 "baselineHours": 24,
+                 "warmUp": 3600,
+                 "minLevel": 0.1 }
+
+    def __init__(self, settings=None, interval=1):
+        # 'settings' is the plant's optional node 'Anomalies', 'interval' the sampling interval in seconds.
+        self.settings = dict(self.DEFAULTS)
+        if settings:
+            self.settings.update(settings)
+        self.interval = interval
+        self.alpha = 1 - np.exp(-interval / (self.settings["baselineHours"] * 3600))
+        self.setInverters([], [])
+
+    def setInverters(self, keys, maxOutputs):
+        self.keys = list(keys)
+        self.maxOutputs = np.asarray(maxOutputs, dtype=float)
+        count = len(self.keys)
+        self.baselines = np.ones(count)
+        self.sampled = np.zeros(count)
+        self.ratios = np.full(count, np.nan)
+        self.scores = np.full(count, np.nan)
+        self.flagged = np.zeros(count, dtype=bool)
+        # Seconds the scores have contradicted the flags.
+        self.durations = np.zeros(count)
+        self.since = np.zeros(count)
+
+    def update(self, tick, outputs, valid):
+        # Compares the outputs (W) of a cycle, in the order of 'keys'. Returns the indices of the changed flags.
+        valid = np.asarray(valid, dtype=bool) & (self.maxOutputs > 0)
+        if np.count_nonzero(valid) < 2:
+            return []
+
+        levels = np.asarray(outputs, dtype=float)[valid] / self.maxOutputs[valid]
+        reference = np.median(levels)
+        if reference < self.settings["minLevel"]:
+            return []
+
+        ratios = levels / reference
+
+        # Until warmed up, the baseline is the mean of all ratios so far. Flagged inverters keep their baseline.
+        sampled = self.sampled[valid]
+        alpha = np.maximum(self.alpha, self.interval / (sampled + self.interval))
+        flagged = self.flagged[valid]
+        baselines = self.baselines[valid]
+        baselines = np.where(flagged, baselines, baselines + alpha * (ratios - baselines))
+        self.baselines[valid] = baselines
+        self.sampled[valid] = sampled + self.interval
+
+        scores = ratios / baselines
+        self.ratios[valid] = ratios
+        self.scores[valid] = scores
+
+        low = scores < self.settings["threshold"]
+        contradicting = (low != flagged) & (sampled >= self.settings["warmUp"])
+        durations = np.where(contradicting, self.durations[valid] + self.interval, 0.0)
+        toggled = durations >= self.settings["sustain"]
+        durations[toggled] = 0.0
+        self.durations[valid] = durations
+
+        indices = np.flatnonzero(valid)[toggled]
+        self.flagged[indices] = ~self.flagged[indices]
+        self.since[indices] = tick
+        return indices.tolist()
+
+    def getAnomalies(self):
+        # The nodes' 'anomaly', in the order of 'keys': the ratio to the plant's median, the baseline, the score
+        # (ratio / baseline) and whether and since when the inverter is flagged.
+        ratios = np.round(self.ratios, 3).tolist()
+        baselines = np.round(self.baselines, 3).tolist()
+        scores = np.round(self.scores, 3).tolist()
+        return [{ "flagged": flagged,
+                  "since": since if flagged else None,
+                  "ratio": None if ratio != ratio else ratio,
+                  "baseline": baseline,
+                  "score": None if score != score else score }
+                for flagged, since, ratio, baseline, score in zip(self.flagged.tolist(), self.since.tolist(), ratios, baselines, scores)]
+
+    def getFlagged(self):
+        return [self.keys[index] for index in np.flatnonzero(self.flagged)]
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  An asyncio HTTP front end for many dashboard clients, serving '/data', the commands and '/scheduler' like
+#  raspend's server (see 'HttpServer') and its own request metrics at '/metrics'.
+#
+#  raspend's server answers one request after the other and closes each connection. Here, all connections are
+#  kept alive by a single event loop. Everything taking the access lock runs on a small, bounded pool of worker
+#  threads, so a sampling cycle holding the lock never stalls the loop. A rendered '/data' document is reused for
+#  'cacheSeconds', and concurrent requests for the same path wait for the same rendering, so a thousand clients
+#  cost one 'json.dumps' per path and period instead of a thousand. Each client address is limited by a token
+#  bucket of 'rateLimit' requests per second.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import asyncio
+import json
+import logging
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from DailyStatistics import QuantileSketch
+from HttpServer import dumpData
+from PlantSampling import summarize
+
+class AsyncHTTPServerThread(threading.Thread):
+    # Worker threads for everything taking the access lock and for the commands.
+    WORKERS = 4
+    # Idle keep-alive connections are closed after this many seconds.
+    KEEP_ALIVE_TIMEOUT = 15
+    MAX_HEADERS = 100
+    MAX_BODY = 65536
+    # Rendered documents of this many paths are kept at most.
+    MAX_DOCUMENTS = 256
+    # The token buckets of this many clients are kept at most. Full buckets are dropped first.
+    MAX_CLIENTS = 10000
+    # Rendered documents are reused for at most this many seconds.
+    CACHE_SECONDS = 0.5
+
+    def __init__(self, shutdownFlag=None, dataLock=None, sharedDict=None, commandMap=None, serverPort=0, schedulerMonitor=None,
+                 rateLimit=0, cacheSeconds=CACHE_SECONDS):
+        # A 'rateLimit' of 0 doesn't limit the clients.
+        super().__init__()
+        self.shutdownFlag = shutdownFlag
+        self.dataLock = dataLock
+        self.sharedDict = sharedDict
+        self.commandMap = commandMap
+        self.serverPort = serverPort
+        self.schedulerMonitor = schedulerMonitor
+        self.rateLimit = rateLimit
+        self.burst = max(1.0, 2 * rateLimit)
+        self.cacheSeconds = cacheSeconds
+
+        # Client address: [tokens, time of the last request].
+        self.buckets = dict()
+        # Path: (expiry, document) and path: future of a rendering in progress.
+        self.documents = dict()
+        self.renderings = dict()
+        # The open connections and their handlers.
+        self.writers = set()
+        self.handlers = set()
+
+        # The metrics are only changed on the event loop.
+        self.openConnections = 0
+        self.connections = 0
+        self.requests = 0
+        self.statuses = dict()
+        self.rateLimited = 0
+        self.renders = 0
+        self.latencies = QuantileSketch()
+        self.maxLatency = 0.0
+
+    def run(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.WORKERS, thread_name_prefix="mbpv-http")
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            logging.error("The asynchronous HTTP server failed! Error: {}".format(e))
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handleConnection, port=self.serverPort, backlog=1024, reuse_address=True)
+        logging.info("Asynchronous HTTP server listening on port {}".format(self.serverPort))
+        while not self.shutdownFlag.is_set():
+            await asyncio.sleep(0.5)
+        # Closed connections end their handlers, which are left to finish rather than cancelled.
+        server.close()
+        for writer in list(self.writers):
+            writer.close()
+        if self.handlers:
+            await asyncio.wait(self.handlers, timeout=2)
+
+    async def handleConnection(self, reader, writer):
+        client = (writer.get_extra_info("peername") or ("",))[0]
+        self.writers.add(writer)
+        self.handlers.add(asyncio.current_task())
+        self.openConnections += 1
+        self.connections += 1
+        try:
+            while not self.shutdownFlag.is_set():
+                requestLine = await asyncio.wait_for(reader.readline(), self.KEEP_ALIVE_TIMEOUT)
+                if not requestLine:
+                    break
+                headers = await asyncio.wait_for(self.readHeaders(reader), self.KEEP_ALIVE_TIMEOUT)
+                startTime = time.perf_counter()
+
+                parts = requestLine.decode("latin-1").split()
+                if len(parts) != 3 or headers is None:
+                    writer.write(makeResponse(400, "Bad request!", False))
+                    self.record(400, startTime)
+                    break
+                method, target, version = parts
+                connection = headers.get("connection", "").lower()
+                keepAlive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+                length = int(headers.get("content-length", 0))
+                if length > self.MAX_BODY:
+                    writer.write(makeResponse(413, "Payload too large!", False))
+                    self.record(413, startTime)
+                    break
+                body = await reader.readexactly(length) if length > 0 else b""
+
+                try:
+                    status, content, extraHeaders = await self.handleRequest(client, method, target, headers, body)
+                except Exception as e:
+                    logging.error("Handling '{} {}' failed! Error: {}".format(method, target, e))
+                    status, content, extraHeaders = 500, "Internal server error!", []
+                writer.write(makeResponse(status, content, keepAlive, extraHeaders))
+                await writer.drain()
+                self.record(status, startTime)
+                if not keepAlive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # Idle, gone or garbage, e.g. a line exceeding the stream's limit.
+            pass
+        finally:
+            self.openConnections -= 1
+            self.writers.discard(writer)
+            self.handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def readHeaders(self, reader):
+        # Returns the headers with lower case names or None, if there are too many.
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return headers
+            if len(headers) >= self.MAX_HEADERS:
+                return None
+            name, separator, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    def record(self, status, startTime):
+        latency = (time.perf_counter() - startTime) * 1000
+        self.requests += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latencies.add(latency)
+        self.maxLatency = max(self.maxLatency, latency)
+
+    def allow(self, client):
+        # Takes a token from the client's bucket, refilled by 'rateLimit' tokens per second up to 'burst'.
+        if self.rateLimit <= 0:
+            return True
+        now = time.monotonic()
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_CLIENTS:
+                self.pruneBuckets(now)
+            bucket = self.buckets[client] = [self.burst, now]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rateLimit)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def pruneBuckets(self, now):
+        # Clients idle long enough to have a full bucket again are the same as new ones.
+        idleSeconds = self.burst / self.rateLimit
+        self.buckets = { client: bucket for client, bucket in self.buckets.items() if now - bucket[1] < idleSeconds }
+        if len(self.buckets) >= self.MAX_CLIENTS:
+            self.buckets.clear()
+
+    async def handleRequest(self, client, method, target, headers, body):
+        # Returns the status, the content and additional headers.
+        if not self.allow(client):
+            self.rateLimited += 1
+            return 429, "Too many requests!", [("Retry-After", "1")]
+
+        urlComponents = urllib.parse.urlparse(target)
+        path = urlComponents.path
+        if method == "OPTIONS":
+            return 200, b"", [("Access-Control-Allow-Methods", "GET, POST, OPTIONS"),
+                              ("Access-Control-Allow-Headers", "X-Requested-With, Content-Type")]
+        if method == "POST":
+            if path.lower() != "/cmd":
+                return 404, "Not found!", []
+            return await self.runInExecutor(self.onPostCmd, headers, body)
+        if method != "GET":
+            return 405, "Method not allowed!", [("Allow", "GET, POST, OPTIONS")]
+
+        if path.lower() == "/data" or path.startswith("/data/"):
+            return 200, await self.getDocument(path), []
+        if path.lower() == "/metrics":
+            return 200, json.dumps(self.getMetrics()), []
+        if path.lower() == "/scheduler":
+            if self.schedulerMonitor is None:
+                return 501, "No scheduler timing available with '--processes' or '--replay'.", []
+            return await self.runInExecutor(self.onGetScheduler)
+        if path.lower() in ("/cmds", "/cmd"):
+            if self.commandMap is None or len(self.commandMap) == 0:
+                return 501, "No commands available", []
+            if path.lower() == "/cmds":
+                return await self.runInExecutor(self.onGetCmds)
+            return await self.runInExecutor(self.onGetCmd, urllib.parse.parse_qs(urlComponents.query))
+        if path.lower() in ("/history", "/peaks", "/export"):
+            return 501, "'{}' is only served on '--port'.".format(path), []
+        return 404, "Not found!", []
+
+    async def runInExecutor(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def getDocument(self, path):
+        # The rendered document of 'path', rendered at most once per 'cacheSeconds'.
+        now = time.monotonic()
+        cached = self.documents.get(path)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        rendering = self.renderings.get(path)
+        if rendering is None:
+            rendering = asyncio.ensure_future(self.runInExecutor(self.renderDocument, path))
+            self.renderings[path] = rendering
+            try:
+                document = await asyncio.shield(rendering)
+            finally:
+                del self.renderings[path]
+            self.renders += 1
+            if len(self.documents) >= self.MAX_DOCUMENTS:
+                self.documents.clear()
+            self.documents[path] = (time.monotonic() + self.cacheSeconds, document)
+            return document
+        return await asyncio.shield(rendering)
+
+    def renderDocument(self, path):
+        with self.dataLock:
+            return dumpData(self.sharedDict, path).encode("utf-8")
+
+    def onGetScheduler(self):
+        with self.dataLock:
+            return 200, json.dumps(self.schedulerMonitor.toDict(), ensure_ascii=False), []
+
+    def onGetCmds(self):
+        with self.dataLock:
+            return 200, json.dumps({ "Commands": [cmd.describe(False) for cmd in self.commandMap.values()] }, ensure_ascii=False), []
+
+    def onGetCmd(self, queryParams):
+        cmdName = queryParams.pop("name", [None])[0]
+        cmd = self.commandMap.get(cmdName)
+        if cmd is None:
+            return 404, "Command '{0}' not found!".format(cmdName), []
+        try:
+            result = cmd.execute({ key: values[0] for key, values in queryParams.items() })
+        except Exception as e:
+            return 500, "An unexpected error occured during execution of '{0}'! Exception: {1}".format(cmdName, e), []
+        return 200, json.dumps(result, ensure_ascii=False), []
+
+    def onPostCmd(self, headers, body):
+        # The payload is the same as for raspend, e.g. { "Command": { "Name": "..", "Args": { .. } } }, returned with its "Result".
+        if self.commandMap is None:
+            return 501, "No commands available.", []
+        if headers.get("content-type", "").split(";")[0].strip().lower() != "application/json":
+            return 415, "Invalid media type! Expecting 'application/json'.", []
+        try:
+            payload = json.loads(body.decode("utf-8"))
+        except (ValueError, UnicodeDecodeError):
+            return 500, "Encountered a JSON decoding error", []
+        if type(payload) is not dict or type(payload.get("Command")) is not dict or "Name" not in payload["Command"]:
+            return 400, "Unable to verify payload!", []
+
+        cmdName = payload["Command"]["Name"]
+        cmd = self.commandMap.get(cmdName)
+        if cmd is None:
+            return 404, "Command '{0}' not found!".format(cmdName), []
+        try:
+            payload["Command"]["Result"] = cmd.execute(payload["Command"].get("Args", dict()))
+        except Exception as e:
+            return 500, "An unexpected error occured during execution of '{0}'! Exception: {1}".format(cmdName, e), []
+        return 200, json.dumps(payload, ensure_ascii=False), []
+
+    def getMetrics(self):
+        return { "openConnections": self.openConnections,
+                 "connections": self.connections,
+                 "requests": self.requests,
+                 "statuses": { str(status): count for status, count in sorted(self.statuses.items()) },
+                 "rateLimited": self.rateLimited,
+                 "renders": self.renders,
+                 "latency": summarize(self.latencies, self.maxLatency) }
+
+def makeResponse(status, content, keepAlive, extraHeaders=()):
+    # JSON for success, plain text for errors.
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    contentType = "application/json; charset=utf-8" if status < 400 else "text/plain; charset=utf-8"
+    lines = ["HTTP/1.1 {} {}".format(status, HTTPStatus(status).phrase),
+             "Content-Type: " + contentType,
+             "Content-Length: {}".format(len(content)),
+             "Access-Control-Allow-Origin: *",
+             "Connection: " + ("keep-alive" if keepAlive else "close")]
+    lines += ["{}: {}".format(name, value) for name, value in extraHeaders]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + content
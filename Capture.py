@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Recording of raw Modbus responses to a compact binary capture file and replaying them through
+#  the acquisition pipeline, either in real time, accelerated or as fast as possible.
+#
+#  File layout: the magic 'MBPVCAP2' and the start time (double, unix timestamp) followed by records.
+#  A record starts with its kind (byte).
+#    NAME:     inverter id (uint16), length (byte) and the utf-8 encoded name of the inverter
+#    RESPONSE: milliseconds since start (uint64, from the monotonic clock), inverter id (uint16), register address (uint16),
+#              number of registers (byte, 0xFF for a missing response) and the registers (uint16 each)
+#  Files with the magic 'MBPVCAP1' store the milliseconds as uint32 and are still replayed.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import logging
+import struct
+import threading
+import time
+from datetime import datetime
+
+from raspend.utils.workerthreads import WorkerThreadBase
+from ModbusGateway import ModbusRequest, READ_INPUT_REGISTERS, READ_HOLDING_REGISTERS
+
+CAPTURE_MAGIC = b"MBPVCAP2"
+CAPTURE_HEADER = struct.Struct("<8sd")
+RECORD_KIND = struct.Struct("<B")
+RECORD_NAME = struct.Struct("<HB")
+RECORD_RESPONSE = struct.Struct("<QHHB")
+# The record layout of each capture format
+RECORD_RESPONSES = { CAPTURE_MAGIC: RECORD_RESPONSE,
+                     b"MBPVCAP1": struct.Struct("<IHHB") }
+
+KIND_NAME = 1
+KIND_RESPONSE = 2
+MISSING_RESPONSE = 0xFF
+
+class CaptureWriter():
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.names = dict()
+        self.startTime = time.time()
+        # The records are timed by the monotonic clock, so steps of the wall clock (e.g. by NTP) don't disturb them.
+        self.startMonotonic = time.monotonic()
+        self.file = open(fileName, "wb")
+        self.file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, self.startTime))
+
+    def register(self, name):
+        # Returns the id used for recording the responses of inverter 'name'.
+        with self.lock:
+            if name not in self.names:
+                self.names[name] = len(self.names)
+                encodedName = name.encode("utf-8")
+                self.file.write(RECORD_KIND.pack(KIND_NAME) + RECORD_NAME.pack(self.names[name], len(encodedName)) + encodedName)
+            return self.names[name]
+
+    def record(self, inverterId, requests, responses):
+        milliseconds = int((time.monotonic() - self.startMonotonic) * 1000)
+        data = bytearray()
+        for request, registers in zip(requests, responses):
+            data += RECORD_KIND.pack(KIND_RESPONSE)
+            if registers is None:
+                data += RECORD_RESPONSE.pack(milliseconds, inverterId, request.address, MISSING_RESPONSE)
+            else:
+                data += RECORD_RESPONSE.pack(milliseconds, inverterId, request.address, len(registers))
+                data += struct.pack("<{}H".format(len(registers)), *registers)
+        with self.lock:
+            if self.file:
+                self.file.write(data)
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+def getCaptureStartTime(fileName):
+    with open(fileName, "rb") as captureFile:
+        magic, startTime = CAPTURE_HEADER.unpack(captureFile.read(CAPTURE_HEADER.size))
+    if magic not in RECORD_RESPONSES:
+        raise ValueError("'{}' is not an mbpv capture file.".format(fileName))
+    return startTime
+
+def readCapture(fileName):
+    # Yields (timestamp, name, address, registers) for every recorded response. 'registers' is None for missing responses.
+    with open(fileName, "rb") as captureFile:
+        data = captureFile.read()
+
+    magic, startTime = CAPTURE_HEADER.unpack_from(data, 0)
+    if magic not in RECORD_RESPONSES:
+        raise ValueError("'{}' is not an mbpv capture file.".format(fileName))
+    recordResponse = RECORD_RESPONSES[magic]
+
+    names = dict()
+    offset = CAPTURE_HEADER.size
+    while offset < len(data):
+        kind = RECORD_KIND.unpack_from(data, offset)[0]
+        offset += RECORD_KIND.size
+        if kind == KIND_NAME:
+            inverterId, length = RECORD_NAME.unpack_from(data, offset)
+            offset += RECORD_NAME.size
+            names[inverterId] = data[offset:offset + length].decode("utf-8")
+            offset += length
+        elif kind == KIND_RESPONSE:
+            milliseconds, inverterId, address, count = recordResponse.unpack_from(data, offset)
+            offset += recordResponse.size
+            registers = None
+            if count != MISSING_RESPONSE:
+                registers = list(struct.unpack_from("<{}H".format(count), data, offset))
+                offset += 2 * count
+            yield startTime + milliseconds / 1000.0, names[inverterId], address, registers
+        else:
+            raise ValueError("Unknown record in '{}' at offset {}.".format(fileName, offset))
+
+def readCaptureCycles(fileName, interval):
+    # Groups the recorded responses into cycles of 'interval' seconds.
+    # Yields (tick, { name: { address: registers } }) in recording order.
+    currentTick = None
+    cycle = dict()
+    for timestamp, name, address, registers in readCapture(fileName):
+        tick = (timestamp // interval) * interval
+        if tick != currentTick:
+            if currentTick is not None:
+                yield currentTick, cycle
+            currentTick = tick
+            cycle = dict()
+        cycle.setdefault(name, dict())[address] = registers
+    if currentTick is not None:
+        yield currentTick, cycle
+
+class ReplayClient():
+    # Stands in for a Modbus client and answers with the responses of the current replay cycle.
+    def __init__(self, name, unitId=1):
+        self.name = name
+        self.unit_id = unitId
+        self.timeout = 0
+        self.responses = dict()
+
+    @property
+    def host(self):
+        return "replay"
+
+    @property
+    def port(self):
+        return 0
+
+    def is_open(self):
+        return True
+
+    def open(self):
+        return True
+
+    def close(self):
+        pass
+
+    def request(self, functionCode, address, count):
+        request = ModbusRequest(None, 0, functionCode, address, count)
+        request.complete(self.responses.get(address))
+        return request
+
+    def requestInputRegisters(self, address, count):
+        return self.request(READ_INPUT_REGISTERS, address, count)
+
+    def requestHoldingRegisters(self, address, count):
+        return self.request(READ_HOLDING_REGISTERS, address, count)
+
+    def read_input_registers(self, address, count):
+        return self.requestInputRegisters(address, count).wait()
+
+    def read_holding_registers(self, address, count):
+        return self.requestHoldingRegisters(address, count).wait()
+
+class ReplayClock():
+    # The replayed time, used by the handlers instead of the wall clock.
+    def __init__(self, localTimeZone, timestamp=None):
+        self.localTimeZone = localTimeZone
+        self.timestamp = timestamp if timestamp is not None else time.time()
+
+    def __call__(self):
+        return datetime.fromtimestamp(self.timestamp, self.localTimeZone)
+
+class ReplayWorkerThread(WorkerThreadBase):
+    # Drives a sampling handler (e.g. 'SamplePlant') with the cycles of a capture file instead of the wall clock.
+    # 'speed' is the acceleration factor, 0 replays as fast as possible.
+    def __init__(self, shutdownEvent, accessLock, threadHandler, cycles, replayClients, replayClock, speed=1.0):
+        super().__init__(shutdownEvent, accessLock, threadHandler)
+        self.cycles = cycles
+        self.replayClients = replayClients
+        self.replayClock = replayClock
+        self.speed = speed
+        return
+
+    def run(self):
+        # Without prepared handlers, none of the captured cycles can be replayed.
+        with self.accessLock:
+            try:
+                self.threadHandler.prepare()
+            except Exception as e:
+                logging.exception("Preparing the replay failed, nothing is replayed! Error: {}".format(e))
+                return
+
+        startTime = time.monotonic()
+        firstTick = None
+        replayed = 0
+
+        for tick, responses in self.cycles:
+            if firstTick is None:
+                firstTick = tick
+
+            if self.speed > 0:
+                timeout = (tick - firstTick) / self.speed - (time.monotonic() - startTime)
+                if self.shutdownEvent.wait(max(0.0, timeout)):
+                    break
+            elif self.shutdownEvent.is_set():
+                break
+
+            self.replayClock.timestamp = tick
+            for name, replayClient in self.replayClients.items():
+                replayClient.responses = responses.get(name, dict())
+
+            try:
+                self.threadHandler.acquire(tick)
+                with self.accessLock:
+                    self.threadHandler.invoke()
+            except Exception as e:
+                logging.exception("Replaying the cycle of {} failed! Error: {}".format(tick, e))
+                continue
+            replayed += 1
+
+        logging.info("Replayed {} cycles in {:.3f} seconds.".format(replayed, time.monotonic() - startTime))
+        return
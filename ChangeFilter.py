@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Change detection with per field deadbands. Values of an inverter's state are only written, its version
+#  bumped and listeners notified, if at least one value really changed.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import logging
+
+class ChangeFilter():
+    # Changes up to these amounts are suppressed. Fields without deadband are written on any change.
+    DEFAULT_DEADBANDS = { "currentOutput": 5,
+                          "internalTemperature": 0.5 }
+
+    def __init__(self, deadbands=None):
+        self.deadbands = dict(self.DEFAULT_DEADBANDS)
+        if deadbands:
+            self.deadbands.update(deadbands)
+        self.listeners = list()
+        self.written = 0
+        self.suppressed = 0
+
+    def addListener(self, listener):
+        # 'listener' is called with the node's key, the node's 'InverterState' and a dict of the changed fields.
+        self.listeners.append(listener)
+
+    def isChanged(self, field, oldValue, newValue):
+        if oldValue is None or type(newValue) is str:
+            return oldValue != newValue
+        return abs(newValue - oldValue) > self.deadbands.get(field, 0)
+
+    def apply(self, key, thisState, values):
+        # Writes 'values' into 'thisState', if one of them changed. Returns the changed fields.
+        changed = dict()
+        for field, value in values.items():
+            if self.isChanged(field, getattr(thisState, field), value):
+                changed[field] = value
+
+        if len(changed) == 0:
+            self.suppressed += 1
+            return changed
+
+        # Once a node changes, all its values are brought up to date.
+        for field, value in values.items():
+            setattr(thisState, field, value)
+        thisState.version += 1
+        self.written += 1
+
+        for listener in self.listeners:
+            try:
+                listener(key, thisState, changed)
+            except Exception as e:
+                logging.error("Notifying a listener about changes of '{}' failed! Error: {}".format(key, e))
+        return changed
+
+    def getStatistics(self):
+        return getChangeStatistics(self.written, self.suppressed)
+
+def getChangeStatistics(written, suppressed):
+    # The node 'changes' of the plant, i.e. how many samples were written and suppressed.
+    total = written + suppressed
+    return { "written": written,
+             "suppressed": suppressed,
+             "suppressionRatio": round(suppressed / total, 3) if total else 0 }
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Online daily statistics of an output stream, computed in constant memory as samples arrive.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import math
+
+class QuantileSketch():
+    # A mergeable quantile sketch with logarithmic buckets. Quantiles have a relative error of at most 'accuracy'.
+    # The number of buckets is bounded by the range of the values, e.g. ~470 buckets for 1 W to 10 kW at 1%.
+    def __init__(self, accuracy=0.01):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.logGamma = math.log(self.gamma)
+        self.buckets = dict()
+        self.zeroCount = 0
+        self.count = 0
+        # A bucket's midpoint may lie outside of the values added, so quantiles are clamped to their range.
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        self.count += 1
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        if value <= 0:
+            self.zeroCount += 1
+            return
+        index = math.ceil(math.log(value) / self.logGamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        self.count += other.count
+        self.zeroCount += other.zeroCount
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0
+        rank = q * (self.count - 1)
+        if rank < self.zeroCount:
+            return 0
+        seen = self.zeroCount
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                break
+        return min(max(2 * self.gamma ** index / (self.gamma + 1), self.minimum), self.maximum)
+
+class DailyStatistics():
+    # Gaps between two samples larger than this are not accounted for time above thresholds or ramp rates.
+    MAX_GAP = 60
+    QUANTILES = (0.1, 0.5, 0.9, 0.99)
+
+    def __init__(self, thresholds):
+        # 'thresholds' maps a label to a value, e.g. { "50%": 1500 }.
+        self.thresholds = thresholds
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.timeAbove = { label: 0.0 for label in self.thresholds }
+        self.maxRampUp = 0.0
+        self.maxRampDown = 0.0
+        self.lastValue = None
+        self.lastTimestamp = None
+        self.sketch = QuantileSketch()
+
+    def update(self, value, timestamp):
+        # Welford's algorithm for mean and variance.
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        self.sketch.add(value)
+
+        if self.lastTimestamp is not None:
+            dt = timestamp - self.lastTimestamp
+            if 0 < dt <= self.MAX_GAP:
+                for label, threshold in self.thresholds.items():
+                    if value > threshold:
+                        self.timeAbove[label] += dt
+                ramp = (value - self.lastValue) / dt
+                self.maxRampUp = max(self.maxRampUp, ramp)
+                self.maxRampDown = min(self.maxRampDown, ramp)
+
+        self.lastValue = value
+        self.lastTimestamp = timestamp
+
+    def getVariance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def toDict(self):
+        return { "samples": self.count,
+                 "mean": round(self.mean, 1),
+                 "stdDev": round(math.sqrt(self.getVariance()), 1),
+                 "min": self.minimum if self.minimum is not None else 0,
+                 "max": self.maximum if self.maximum is not None else 0,
+                 "secondsAbove": { label: round(seconds) for label, seconds in self.timeAbove.items() },
+                 "maxRampUp": round(self.maxRampUp, 1),
+                 "maxRampDown": round(self.maxRampDown, 1),
+                 "percentiles": { "p{:g}".format(q * 100): round(self.sketch.quantile(q)) for q in self.QUANTILES } }
+
+def getThresholds(maxOutput):
+    # Thresholds relative to the maximum output of an inverter or plant.
+    return { "{}%".format(percent): maxOutput * percent / 100 for percent in (25, 50, 75, 90) }
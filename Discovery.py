@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Discovery of SMA inverters via Modbus-TCP and a persistent cache of their identities.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import logging
+import json
+import os
+import socket
+import ipaddress
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from SMA_Inverters import getSunnyBoyIdentity
+
+class DeviceCache():
+    # Entries older than this are considered stale and the device will be identified again.
+    DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+    def __init__(self, fileName, maxAge=DEFAULT_MAX_AGE, readOnly=False):
+        self.fileName = fileName
+        self.maxAge = maxAge
+        # Updates of a read only cache are kept in memory only.
+        self.readOnly = readOnly
+        self.lock = threading.Lock()
+        self.devices = dict()
+        self.load()
+
+    def makeKey(self, host, port, unitId=None, name=None):
+        # Devices behind a gateway share host and port and are told apart by their unit id.
+        # The unit id discovered for a configured inverter is kept under the inverter's name.
+        if name is not None:
+            return "{}@{}:{}".format(name, host, port)
+        if unitId is None:
+            return "{}:{}".format(host, port)
+        return "{}:{}/{}".format(host, port, unitId)
+
+    def read(self):
+        if not os.path.isfile(self.fileName):
+            return dict()
+        try:
+            with open(self.fileName) as json_file:
+                return json.load(json_file)
+        except Exception as e:
+            logging.error("Reading device cache {} failed! Error: {}".format(self.fileName, e))
+            return dict()
+
+    def load(self):
+        self.devices = self.read()
+
+    def save(self):
+        # Other processes (e.g. the workers of --processes) share the file, so their newer entries are merged in first.
+        for key, entry in self.read().items():
+            if entry.get("timestamp", 0) > self.devices.get(key, dict()).get("timestamp", 0):
+                self.devices[key] = entry
+        tmpFileName = "{}.{}.tmp".format(self.fileName, os.getpid())
+        try:
+            with open(tmpFileName, 'w') as outfile:
+                json.dump(self.devices, outfile, indent=2)
+            os.replace(tmpFileName, self.fileName)
+        except Exception as e:
+            logging.error("Writing device cache {} failed! Error: {}".format(self.fileName, e))
+
+    def lookup(self, host, port, unitId=None, name=None):
+        # Returns the cached identity of the device or None, if it is unknown or stale.
+        with self.lock:
+            entry = self.devices.get(self.makeKey(host, port, unitId, name))
+        if entry is None:
+            return None
+        if datetime.now().timestamp() - entry.get("timestamp", 0) > self.maxAge:
+            return None
+        return entry
+
+    def update(self, host, port, identity, unitId=None, name=None):
+        entry = dict(identity)
+        entry["timestamp"] = int(datetime.now().timestamp())
+        with self.lock:
+            self.devices[self.makeKey(host, port, unitId, name)] = entry
+            if not self.readOnly:
+                self.save()
+        return entry
+
+def isPortOpen(host, port, timeout):
+    try:
+        with socket.create_connection((host, port), timeout):
+            return True
+    except OSError:
+        return False
+
+def probeDevice(host, port, timeout):
+    # Checking the TCP port first lets us skip unused addresses quickly.
+    if not isPortOpen(host, port, timeout):
+        return None
+    try:
+        identity = getSunnyBoyIdentity(host, port, timeout)
+    except Exception as e:
+        logging.info("Probing {}:{} failed! Error: {}".format(host, port, e))
+        return None
+    if identity:
+        identity["host"] = host
+        identity["port"] = port
+    return identity
+
+def scanNetwork(subnet, ports, timeout=0.5, maxWorkers=64):
+    # Probes all hosts of 'subnet' (e.g. '192.168.178.0/24') on all given ports concurrently.
+    network = ipaddress.ip_network(subnet, strict=False)
+    targets = [(str(host), port) for host in network.hosts() for port in ports]
+
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        results = executor.map(lambda target: probeDevice(target[0], target[1], timeout), targets)
+        devices = [device for device in results if device]
+
+    logging.info("Scanning {} found {} device(s).".format(subnet, len(devices)))
+    return devices
+
+def addDiscoveredInverters(mbpvData, devices, deviceCache=None):
+    # Adds an inverter node for each device not yet configured. Returns the number of added nodes.
+    configured = set()
+    for inverter in mbpvData["Inverters"]:
+        node = mbpvData[inverter]["inverter"]
+        configured.add((node["host"], node.get("port", 502)))
+
+    added = 0
+    for device in devices:
+        if deviceCache:
+            deviceCache.update(device["host"], device["port"], device)
+
+        if (device["host"], device["port"]) in configured:
+            continue
+
+        name = "SMA{}".format(device["serialNumber"])
+        mbpvData["Inverters"].append(name)
+        mbpvData[name] = { "inverter": { "name": device["model"],
+                                         "host": device["host"],
+                                         "port": device["port"],
+                                         "unitId": device["unitId"],
+                                         "maxOutput": device["maxOutput"] } }
+        configured.add((device["host"], device["port"]))
+        added += 1
+
+    return added
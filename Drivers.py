@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Registry of inverter drivers. The key 'driver' of an inverter's node 'inverter' selects the driver
+#  reading out that inverter, e.g. "sunnyboy" (default) or "sunspec".
+#
+#  A driver is created with (host, port, unitId, mbClient, deviceCache, clock) and provides
+#    - the latest values in 'dayYield' (Wh), 'totalYield' (Wh), 'currentOutput' (W), 'internalTemperature' (°C)
+#      and 'currentState' (see 'SunnyBoyConstants.STATE_AS_STRING'), where the day is that of 'clock()' (e.g. a replay's),
+#    - 'identity', a dict with unit id, model, serial number and maximum output or None, if unknown,
+#    - 'setCapture(capture, name)', 'requestCurrentValues()', 'completeCurrentValues(requests, timeout)' and
+#      'readCurrentValues()' with the semantics of 'SMA_Inverters.SunnyBoy',
+#    - optionally 'setTelemetry(enabled)', after which 'dcInputs' (a list with a dict of 'voltage' (V), 'current' (A)
+#      and 'power' (W) per DC input) and 'grid' (a dict with 'voltage' (V) per phase and 'frequency' (Hz)) are read too.
+#
+#  A driver's module registers the driver, when it's imported. The modules of the drivers below are imported when
+#  an inverter first uses them, so only the drivers of the configured inverters are loaded.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import importlib
+
+DEFAULT_DRIVER = "sunnyboy"
+DRIVER_MODULES = { "sunnyboy": "SMA_Inverters", "sunspec": "SunSpec" }
+
+# The maximum number of registers a single Modbus read may return.
+MAX_READ_COUNT = 125
+
+inverterDrivers = dict()
+
+def registerDriver(name, driverClass):
+    inverterDrivers[name] = driverClass
+
+def getDriverName(inverter):
+    return inverter.get("driver", DEFAULT_DRIVER)
+
+def createDriver(inverter, unitId=None, mbClient=None, deviceCache=None, clock=None):
+    name = getDriverName(inverter)
+    if name not in inverterDrivers and name in DRIVER_MODULES:
+        importlib.import_module(DRIVER_MODULES[name])
+    if name not in inverterDrivers:
+        raise ValueError("Unknown driver '{}' for inverter at {}! Known drivers: {}".format(name, inverter["host"], ", ".join(sorted(set(inverterDrivers) | set(DRIVER_MODULES)))))
+    driver = inverterDrivers[name](inverter["host"], inverter["port"], unitId, mbClient, deviceCache, clock)
+    if inverter.get("telemetry", False):
+        if not hasattr(driver, "setTelemetry"):
+            raise ValueError("Driver '{}' of inverter at {} has no extended telemetry!".format(name, inverter["host"]))
+        driver.setTelemetry(True)
+    return driver
+
+def buildReadPlan(ranges, maxGap=16, maxCount=MAX_READ_COUNT):
+    # Merges the register ranges (address, count) into as few block reads as possible.
+    # Gaps of up to 'maxGap' registers are read along, since another round trip costs more than a few registers.
+    blocks = list()
+    for address, count in sorted(ranges):
+        if blocks:
+            blockAddress, blockCount = blocks[-1]
+            end = max(blockAddress + blockCount, address + count)
+            if address - (blockAddress + blockCount) <= maxGap and end - blockAddress <= maxCount:
+                blocks[-1] = (blockAddress, end - blockAddress)
+                continue
+        blocks.append((address, count))
+    return blocks
+
+def sliceRegisters(blocks, blockRegisters, address, count):
+    # Returns the registers 'address' to 'address + count' from the responses of a read plan or None, if not read.
+    for (blockAddress, blockCount), registers in zip(blocks, blockRegisters):
+        if registers is not None and blockAddress <= address and address + count <= blockAddress + blockCount:
+            return registers[address - blockAddress:address - blockAddress + count]
+    return None
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Export of the history (see 'History') into columnar files for analysis, e.g. with numpy or pandas.
+#
+#  An export is a directory holding one '.npy' file per column, i.e. 'time' (start of the bucket), 'count' (number
+#  of samples) and one column per field, plus 'metadata.json'. The rows of each inverter are contiguous and in the
+#  order of time, their offset and number are listed in the metadata. So a column is loaded without copying, e.g.
+#  np.load("export/currentOutput.npy", mmap_mode="r")[offset:offset + rows].
+#
+#  The segment files are read with a numpy record type matching 'History.RECORD' and the columns are appended one
+#  segment at a time, so memory is bounded by the largest segment, not by the length of the export.
+#
+#  $ python3 Export.py --history=./history --output=./export --start=2019-06-01 --end=2019-07-01 --resolution=60
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from History import History, HISTORY_FIELDS, RECORD, RESOLUTIONS, RETENTION, parseTime
+
+RECORD_DTYPE = np.dtype([("start", "<u4"), ("count", "<u4"), ("values", "<f8", (len(HISTORY_FIELDS), 5))])
+assert RECORD_DTYPE.itemsize == RECORD.size
+
+# The aggregations of a bucket, by their index within a record's values, and 'delta' (last - first).
+EXPORT_AGGREGATIONS = ("sum", "min", "max", "first", "last", "avg", "delta")
+
+COLUMN_TYPES = { "time": "<i8", "count": "<u4" }
+FIELD_TYPE = "<f8"
+
+class ColumnFile():
+    # A '.npy' file that is appended to. Its header is rewritten with the final shape when closed, numpy reserves
+    # room for the shape to grow.
+    def __init__(self, fileName, dtype):
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self.file = open(fileName, "wb")
+        self.writeHeader()
+        self.headerSize = self.file.tell()
+
+    def writeHeader(self):
+        np.lib.format.write_array_header_1_0(self.file, { "descr": np.lib.format.dtype_to_descr(self.dtype),
+                                                          "fortran_order": False,
+                                                          "shape": (self.rows,) })
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        self.file.write(values.data)
+        self.rows += len(values)
+
+    def close(self):
+        self.file.seek(0)
+        self.writeHeader()
+        if self.file.tell() != self.headerSize:
+            raise ValueError("The header of {} outgrew its room!".format(self.file.name))
+        self.file.close()
+
+def chooseExportResolution(start, now):
+    # The finest resolution whose segments still cover 'start'.
+    for resolution in RESOLUTIONS:
+        if RETENTION[resolution] is None or start >= now - RETENTION[resolution] * 86400:
+            return resolution
+    return RESOLUTIONS[-1]
+
+def readRecords(history, resolution, period, name, limit=None):
+    # All complete records of a segment within its first 'limit' bytes. A record being appended right now is left out.
+    fileName = history.getSegmentFileName(resolution, period, name)
+    if not os.path.isfile(fileName):
+        return np.empty(0, RECORD_DTYPE)
+    size = os.path.getsize(fileName) if limit is None else min(limit, os.path.getsize(fileName))
+    return np.fromfile(fileName, RECORD_DTYPE, count=size // RECORD_DTYPE.itemsize)
+
+def mergeRecords(records):
+    # Merges the records of the same bucket, e.g. written before and after a restart, like 'Bucket.merge'.
+    starts = records["start"]
+    if len(records) < 2 or np.all(starts[1:] > starts[:-1]):
+        return records
+    records = records[np.argsort(starts, kind="stable")]
+    firsts = np.flatnonzero(np.r_[True, records["start"][1:] != records["start"][:-1]])
+    lasts = np.r_[firsts[1:], len(records)] - 1
+    values = records["values"]
+
+    merged = np.empty(len(firsts), RECORD_DTYPE)
+    merged["start"] = records["start"][firsts]
+    merged["count"] = np.add.reduceat(records["count"], firsts)
+    merged["values"][..., 0] = np.add.reduceat(values[..., 0], firsts)
+    merged["values"][..., 1] = np.minimum.reduceat(values[..., 1], firsts)
+    merged["values"][..., 2] = np.maximum.reduceat(values[..., 2], firsts)
+    merged["values"][..., 3] = values[firsts, :, 3]
+    merged["values"][..., 4] = values[lasts, :, 4]
+    return merged
+
+def getColumn(records, fieldIndex, aggregation):
+    values = records["values"][:, fieldIndex]
+    if aggregation == "avg":
+        return values[:, 0] / np.maximum(records["count"], 1)
+    if aggregation == "delta":
+        return values[:, 4] - values[:, 3]
+    return values[:, EXPORT_AGGREGATIONS.index(aggregation)]
+
+def getNames(history, resolution, periods):
+    # The names of all inverters (and 'Plant') with segments within 'periods'.
+    names = set()
+    for period in periods:
+        periodDirectory = os.path.join(history.directory, str(resolution), period)
+        if os.path.isdir(periodDirectory):
+            names.update(os.path.splitext(fileName)[0] for fileName in os.listdir(periodDirectory) if fileName.endswith(".bin"))
+    return sorted(names)
+
+def checkExport(directory, start, end, fields, aggregation, resolution):
+    # Raises a ValueError, if an export with these arguments would fail. 'resolution' may be None.
+    if resolution is not None and resolution not in RESOLUTIONS:
+        raise ValueError("'resolution' must be one of {}!".format(", ".join(str(resolution) for resolution in RESOLUTIONS)))
+    if aggregation not in EXPORT_AGGREGATIONS:
+        raise ValueError("Unknown aggregation '{}'! Known aggregations: {}".format(aggregation, ", ".join(EXPORT_AGGREGATIONS)))
+    for field in fields:
+        if field not in HISTORY_FIELDS:
+            raise ValueError("Unknown field '{}'! Known fields: {}".format(field, ", ".join(HISTORY_FIELDS)))
+    if start >= end:
+        raise ValueError("'start' must be before 'end'!")
+    if os.path.isdir(directory) and len(os.listdir(directory)):
+        raise ValueError("The directory '{}' isn't empty!".format(directory))
+
+def exportHistory(history, directory, start, end, names=None, fields=HISTORY_FIELDS, aggregation="avg", resolution=None, now=None):
+    # Writes the buckets starting within [start, end) into 'directory' and returns the metadata.
+    now = int(time.time()) if now is None else now
+    checkExport(directory, start, end, fields, aggregation, resolution)
+    if resolution is None:
+        resolution = chooseExportResolution(start, now)
+
+    periods = history.getPeriods(resolution, start, end)
+    if names is None:
+        names = getNames(history, resolution, periods)
+    fieldIndices = [HISTORY_FIELDS.index(field) for field in fields]
+
+    os.makedirs(directory, exist_ok=True)
+    columnTypes = dict(COLUMN_TYPES)
+    columnTypes.update((field, FIELD_TYPE) for field in fields)
+    columns = { column: ColumnFile(os.path.join(directory, column + ".npy"), dtype) for column, dtype in columnTypes.items() }
+
+    # The buckets not written yet, e.g. of the current minute, hour and day (see 'History.getOpenBuckets').
+    latestBuckets = history.getOpenBuckets(resolution, names)
+
+    inverters = list()
+    try:
+        for name in names:
+            offset = columns["time"].rows
+            latest, latestPeriod, size = latestBuckets.get(name, (None, None, None))
+            for period in periods:
+                if latest is not None and period > latestPeriod:
+                    break
+                if period == latestPeriod:
+                    records = np.concatenate([readRecords(history, resolution, period, name, size),
+                                              np.frombuffer(latest.pack(), RECORD_DTYPE)])
+                else:
+                    records = readRecords(history, resolution, period, name)
+                records = mergeRecords(records)
+                records = records[(records["start"] >= start) & (records["start"] < end)]
+                if len(records) == 0:
+                    continue
+                columns["time"].append(records["start"])
+                columns["count"].append(records["count"])
+                for field, fieldIndex in zip(fields, fieldIndices):
+                    columns[field].append(getColumn(records, fieldIndex, aggregation))
+            inverters.append({ "name": name, "offset": offset, "rows": columns["time"].rows - offset })
+    finally:
+        for column in columns.values():
+            column.close()
+
+    # Written last, so an export is complete once its metadata exists.
+    metadata = { "start": start,
+                 "end": end,
+                 "resolution": resolution,
+                 "aggregation": aggregation,
+                 "fields": list(fields),
+                 "columns": columnTypes,
+                 "rows": columns["time"].rows,
+                 "inverters": inverters,
+                 "created": now }
+    with open(os.path.join(directory, "metadata.json"), "w") as metadataFile:
+        json.dump(metadata, metadataFile, indent=2)
+    return metadata
+
+class ExportJobs():
+    # Runs the exports requested via '/export' one after the other in a thread of their own, so the HTTP server keeps
+    # serving meanwhile. The exports of a directory (e.g. '<history>/exports') are limited in number and by the
+    # free disk space, the oldest are removed to make room for new ones.
+    MAX_EXPORTS = 10
+    MAX_QUEUED = 4
+    MIN_FREE_SPACE = 100 * 1024 * 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # directory -> status of the exports requested since the start
+        self.jobs = dict()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mbpv-export")
+
+    def submit(self, history, directory, *args):
+        # Returns the status of the export or None, if too many are queued already.
+        directory = os.path.abspath(directory)
+        with self.lock:
+            pending = [status for status in self.jobs.values() if status["state"] in ("queued", "running")]
+            if self.jobs.get(directory) in pending:
+                return dict(self.jobs[directory])
+            if len(pending) >= self.MAX_QUEUED:
+                return None
+            status = { "name": os.path.basename(directory), "state": "queued", "directory": directory }
+            self.jobs[directory] = status
+        self.executor.submit(self.run, status, history, directory, args)
+        return dict(status)
+
+    def getStatus(self, directory):
+        # Exports of an earlier run are known by their metadata.
+        directory = os.path.abspath(directory)
+        with self.lock:
+            if directory in self.jobs:
+                return dict(self.jobs[directory])
+        metadataFileName = os.path.join(directory, "metadata.json")
+        if not os.path.isfile(metadataFileName):
+            return None
+        with open(metadataFileName) as metadataFile:
+            metadata = json.load(metadataFile)
+        return { "name": os.path.basename(directory), "state": "done", "directory": directory, "metadata": metadata }
+
+    def makeRoom(self, parentDirectory):
+        # Removes the oldest exports beyond MAX_EXPORTS, or as long as the free disk space is too low.
+        with self.lock:
+            busy = set(other for other, status in self.jobs.items() if status["state"] in ("queued", "running"))
+        exports = sorted((entry.path for entry in os.scandir(parentDirectory) if entry.is_dir() and entry.path not in busy),
+                         key=os.path.getmtime)
+        while len(exports) and (len(exports) >= self.MAX_EXPORTS or shutil.disk_usage(parentDirectory).free < self.MIN_FREE_SPACE):
+            oldest = exports.pop(0)
+            logging.info("Removing export {}.".format(oldest))
+            shutil.rmtree(oldest, ignore_errors=True)
+            with self.lock:
+                self.jobs.pop(oldest, None)
+        if shutil.disk_usage(parentDirectory).free < self.MIN_FREE_SPACE:
+            raise OSError("Less than {} MB of free disk space left!".format(self.MIN_FREE_SPACE // (1024 * 1024)))
+
+    def fail(self, status, directory, error):
+        logging.error("Export {} failed! Error: {}".format(directory, error))
+        with self.lock:
+            status["state"] = "failed"
+            status["error"] = str(error)
+
+    def run(self, status, history, directory, args):
+        # 'args' are those of 'exportHistory' following 'directory', which is an absolute path.
+        start, end, names, fields, aggregation, resolution, now = args
+        with self.lock:
+            status["state"] = "running"
+        startTime = time.perf_counter()
+        try:
+            # E.g. another export of the same name finished meanwhile.
+            checkExport(directory, start, end, fields, aggregation, resolution)
+            os.makedirs(os.path.dirname(directory), exist_ok=True)
+            self.makeRoom(os.path.dirname(directory))
+        except (ValueError, OSError) as e:
+            self.fail(status, directory, e)
+            return
+        try:
+            metadata = exportHistory(history, directory, *args)
+        except (ValueError, OSError) as e:
+            # Incomplete exports only take up space.
+            shutil.rmtree(directory, ignore_errors=True)
+            self.fail(status, directory, e)
+            return
+        logging.info("Exported {} rows to {} in {:.2f} s.".format(metadata["rows"], directory, time.perf_counter() - startTime))
+        with self.lock:
+            status["state"] = "done"
+            status["metadata"] = metadata
+
+# All requests of '/export' share this queue.
+exportJobs = ExportJobs()
+
+def main():
+    from tzlocal import get_localzone
+
+    cmdLineParser = argparse.ArgumentParser(prog="Export", usage="%(prog)s [options]")
+    cmdLineParser.add_argument("--history", help="Directory of the history, see '--history' of mbpv", type=str, required=True)
+    cmdLineParser.add_argument("--output", help="Directory to write the export to, must be empty", type=str, required=True)
+    cmdLineParser.add_argument("--start", help="Unix timestamp or local date and time in ISO format (default: a day before '--end')", type=str, required=False)
+    cmdLineParser.add_argument("--end", help="Unix timestamp or local date and time in ISO format (default: now)", type=str, required=False)
+    cmdLineParser.add_argument("--inverters", help="Comma separated names of inverters, 'Plant' for the plant (default: all)", type=str, required=False)
+    cmdLineParser.add_argument("--fields", help="Comma separated fields (default: all)", type=str, default=",".join(HISTORY_FIELDS), required=False)
+    cmdLineParser.add_argument("--aggregation", help="Aggregation of the buckets: " + ", ".join(EXPORT_AGGREGATIONS) + " (default: avg)", type=str, default="avg", required=False)
+    cmdLineParser.add_argument("--resolution", help="Bucket size in seconds: " + ", ".join(str(resolution) for resolution in RESOLUTIONS) + " (default: the finest covering '--start')", type=int, required=False)
+    args = cmdLineParser.parse_args()
+
+    localTimeZone = get_localzone()
+    now = int(time.time())
+    end = parseTime(args.end, localTimeZone) if args.end else now
+    start = parseTime(args.start, localTimeZone) if args.start else end - 86400
+
+    startTime = time.perf_counter()
+    metadata = exportHistory(History(args.history, localTimeZone), args.output, start, end,
+                             args.inverters.split(",") if args.inverters else None, args.fields.split(","),
+                             args.aggregation, args.resolution, now)
+    print("Exported {} rows of {} inverters at a resolution of {} s in {:.2f} s.".format(
+          metadata["rows"], len(metadata["inverters"]), metadata["resolution"], time.perf_counter() - startTime))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Forecast of a plant's output for today and tomorrow, computed once per day.
+#
+#  The clear sky output of each quarter hour is the irradiation on a horizontal plane under clear sky (Haurwitz)
+#  times 'peakOutputInWP', limited to the time between sunrise and sunset of the SunMoon ephemeris. It's scaled by
+#  the ratio of measured to clear sky yield of the recent days, which absorbs the plant's orientation, losses and
+#  the weather. The ratio is a linear fit over the dailies of the last year (see 'Analytics'), weighted by the age
+#  of the days. Without enough dailies, the expected yield of the 'Unit' takes the place of the measured one.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import logging
+import os
+import threading
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from Analytics import getDailyShares, readDailies
+from History import localize
+from Suntimes import suntimesCache
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def getClearSkyPower(timestamps, longitude, latitude):
+    # The output in W per Wp of a horizontal plane under clear sky at the given UTC timestamps.
+    timestamps = np.asarray(timestamps, dtype=float)
+    days = np.floor(timestamps / 86400)
+    dates = np.datetime64("1970-01-01") + days.astype("timedelta64[D]")
+    dayOfYear = (dates - dates.astype("datetime64[Y]")).astype(int) + 1
+    hours = (timestamps - days * 86400) / 3600
+
+    # Declination and equation of time (Spencer).
+    gamma = 2 * np.pi / 365 * (dayOfYear - 1 + (hours - 12) / 24)
+    declination = (0.006918 - 0.399912 * np.cos(gamma) + 0.070257 * np.sin(gamma) - 0.006758 * np.cos(2 * gamma)
+                   + 0.000907 * np.sin(2 * gamma) - 0.002697 * np.cos(3 * gamma) + 0.00148 * np.sin(3 * gamma))
+    equationOfTime = 229.18 * (0.000075 + 0.001868 * np.cos(gamma) - 0.032077 * np.sin(gamma)
+                               - 0.014615 * np.cos(2 * gamma) - 0.040849 * np.sin(2 * gamma))
+    hourAngle = np.radians((hours * 60 + equationOfTime + 4 * longitude) / 4 - 180)
+
+    phi = np.radians(latitude)
+    cosZenith = np.sin(phi) * np.sin(declination) + np.cos(phi) * np.cos(declination) * np.cos(hourAngle)
+    cosZenith = np.maximum(cosZenith, 0.0)
+    # Haurwitz: 1098 W/m² * cos(z) * exp(-0.057 / cos(z)), relative to the 1000 W/m² of Wp.
+    return 1.098 * cosZenith * np.exp(-0.057 / np.maximum(cosZenith, 1e-3))
+
+def getClearSkyYields(ordinals, longitude, latitude, interval=900):
+    # The clear sky yield in Wh per Wp of each day, from solar midnight to solar midnight.
+    starts = (np.asarray(ordinals, dtype=np.int64) - EPOCH_ORDINAL) * 86400 - longitude * 240
+    timestamps = starts[:, np.newaxis] + (np.arange(86400 // interval) + 0.5) * interval
+    return getClearSkyPower(timestamps, longitude, latitude).sum(axis=1) * interval / 3600
+
+class Forecast():
+    # Dailies of up to a year are fitted. Their weight halves every 'HALF_LIFE' days.
+    FIT_DAYS = 365
+    HALF_LIFE = 7
+    # With fewer dailies, the expected yield is used.
+    MIN_DAYS = 3
+    INTERVAL = 900
+
+    def __init__(self, configFileName, localTimeZone):
+        self.fileName = os.path.splitext(configFileName)[0] + ".dailies"
+        self.localTimeZone = localTimeZone
+        self.lock = threading.Lock()
+        self.forecasts = dict()
+
+    def getForecast(self, theUnit, dt):
+        # Returns the node 'Forecast' for the day of 'dt'. It's only computed for the first call of a day.
+        day = date(dt.year, dt.month, dt.day)
+        with self.lock:
+            if day not in self.forecasts:
+                try:
+                    self.forecasts = { day: self.computeForecast(theUnit, day) }
+                except Exception as e:
+                    logging.error("Computing the forecast for {} failed! Error: {}".format(day.isoformat(), e))
+                    return None
+            return self.forecasts[day]
+
+    def fitRatios(self, dailies, clearSkyYields, day, offsets):
+        # Fits measured to clear sky yield over the days before 'day'. Returns the ratios at the given day offsets.
+        ages = day.toordinal() - dailies["day"].astype(np.int64)
+        ratios = dailies["yield"] / clearSkyYields
+        weights = 0.5 ** (ages / self.HALF_LIFE)
+        slope, intercept = np.polyfit(-ages, ratios, 1, w=np.sqrt(weights))
+        return np.clip(intercept + slope * np.asarray(offsets), ratios.min(), ratios.max())
+
+    def getExpectedRatio(self, theUnit, day, longitude, latitude):
+        # The expected yield in Wh per Wp of 'day' relative to its clear sky yield.
+        shares = getDailyShares(day.year, latitude, theUnit.get("monthlyYieldShares"))
+        expected = theUnit["expectedYieldKWHperKWP"] * shares[day.timetuple().tm_yday - 1]
+        return float(expected / getClearSkyYields([day.toordinal()], longitude, latitude, self.INTERVAL)[0])
+
+    def computeForecast(self, theUnit, day):
+        longitude = theUnit["location"]["longitude"]
+        latitude = theUnit["location"]["latitude"]
+        peakOutput = theUnit["peakOutputInWP"]
+
+        # Days without yield (e.g. while mbpv didn't run) are left out.
+        dailies = readDailies(self.fileName)
+        dailies = dailies[(dailies["day"] >= day.toordinal() - self.FIT_DAYS) & (dailies["day"] < day.toordinal()) & (dailies["yield"] > 0)]
+        days = [day, day + timedelta(days=1)]
+
+        if len(dailies) >= self.MIN_DAYS:
+            clearSkyYields = getClearSkyYields(dailies["day"], longitude, latitude, self.INTERVAL) * peakOutput
+            ratios = self.fitRatios(dailies, clearSkyYields, day, [0, 1]).tolist()
+        else:
+            ratios = [self.getExpectedRatio(theUnit, thisDay, longitude, latitude) for thisDay in days]
+
+        theForecast = { "days": len(dailies) }
+        for key, thisDay, ratio in zip(("today", "tomorrow"), days, ratios):
+            theForecast[key] = self.getDayForecast(thisDay, ratio, peakOutput, longitude, latitude)
+        return theForecast
+
+    def getDayForecast(self, day, ratio, peakOutput, longitude, latitude):
+        # The output of each interval of the local day in W, at its middle.
+        start = localize(datetime(day.year, day.month, day.day), self.localTimeZone).timestamp()
+        nextDay = day + timedelta(days=1)
+        end = localize(datetime(nextDay.year, nextDay.month, nextDay.day), self.localTimeZone).timestamp()
+        timestamps = np.arange(start, end, self.INTERVAL) + self.INTERVAL / 2
+
+        sunrise, noon, sunset = suntimesCache.getSunRiseSet(longitude, latitude, datetime(day.year, day.month, day.day))
+        power = getClearSkyPower(timestamps, longitude, latitude) * peakOutput * ratio
+        power[(timestamps < sunrise) | (timestamps > sunset)] = 0
+
+        return { "date": day.isoformat(),
+                 "yield": round(float(power.sum()) * self.INTERVAL / 3600 / 1000, 3),
+                 "ratio": round(ratio, 3),
+                 "start": int(start),
+                 "interval": self.INTERVAL,
+                 "power": np.rint(power).astype(int).tolist() }
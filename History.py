@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  History of the inverters' and the plant's values at several resolutions, stored in binary segment files.
+#
+#  Every sample is aggregated into buckets of 1 minute, 15 minutes, 1 hour and 1 day. A closed bucket is appended
+#  to the segment file '<directory>/<resolution>/<period>/<name>.bin', where a period is a day (1 minute), a month
+#  (15 minutes, 1 hour) or a year (1 day). Day buckets and periods start at local midnight.
+#
+#  A record holds the start of the bucket (uint32), the number of samples (uint32) and for each field of
+#  HISTORY_FIELDS its sum, minimum, maximum, first and last value (double each). Records of the same bucket
+#  (e.g. written before and after a restart) are merged when queried. Queries include the buckets still open.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import logging
+import os
+import shutil
+import struct
+import threading
+from datetime import datetime, timedelta
+
+HISTORY_FIELDS = ("currentOutput", "dayYield", "totalYield", "internalTemperature")
+
+RECORD = struct.Struct("<II" + "ddddd" * len(HISTORY_FIELDS))
+
+RESOLUTION_MINUTE = 60
+RESOLUTION_QUARTER = 900
+RESOLUTION_HOUR = 3600
+RESOLUTION_DAY = 86400
+RESOLUTIONS = (RESOLUTION_MINUTE, RESOLUTION_QUARTER, RESOLUTION_HOUR, RESOLUTION_DAY)
+
+# Days segments of a resolution are kept, None keeps them forever.
+RETENTION = { RESOLUTION_MINUTE: 31,
+              RESOLUTION_QUARTER: 400,
+              RESOLUTION_HOUR: None,
+              RESOLUTION_DAY: None }
+
+PERIOD_FORMAT = { RESOLUTION_MINUTE: "%Y-%m-%d",
+                  RESOLUTION_QUARTER: "%Y-%m",
+                  RESOLUTION_HOUR: "%Y-%m",
+                  RESOLUTION_DAY: "%Y" }
+
+# Calendar buckets of a query, answered from the day resolution.
+CALENDAR_BUCKETS = ("day", "month", "year")
+
+AGGREGATIONS = ("avg", "sum", "min", "max", "first", "last", "count", "delta")
+
+def localize(naive, localTimeZone):
+    # pytz time zones need 'localize', zoneinfo time zones don't have it.
+    if hasattr(localTimeZone, "localize"):
+        return localTimeZone.localize(naive)
+    return naive.replace(tzinfo=localTimeZone)
+
+def parseTime(text, localTimeZone):
+    # Either a unix timestamp or a local date and time in ISO format, e.g. '2019-12-01' or '2019-12-01T12:00'.
+    try:
+        return int(float(text))
+    except ValueError:
+        return int(localize(datetime.fromisoformat(text), localTimeZone).timestamp())
+
+def getLocalMidnight(timestamp, localTimeZone):
+    dt = datetime.fromtimestamp(timestamp, localTimeZone)
+    return int(localize(datetime(dt.year, dt.month, dt.day), localTimeZone).timestamp())
+
+class Bucket():
+    __slots__ = ("start", "count", "values")
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        # Sum, minimum, maximum, first and last value of each field.
+        self.values = None
+
+    def add(self, values):
+        if self.values is None:
+            self.values = [[value, value, value, value, value] for value in values]
+        else:
+            for aggregate, value in zip(self.values, values):
+                aggregate[0] += value
+                aggregate[1] = min(aggregate[1], value)
+                aggregate[2] = max(aggregate[2], value)
+                aggregate[4] = value
+        self.count += 1
+
+    def merge(self, count, values):
+        # Merges an aggregate of later samples, e.g. a stored record.
+        if count == 0:
+            return
+        if self.values is None:
+            self.values = [list(aggregate) for aggregate in values]
+        else:
+            for aggregate, other in zip(self.values, values):
+                aggregate[0] += other[0]
+                aggregate[1] = min(aggregate[1], other[1])
+                aggregate[2] = max(aggregate[2], other[2])
+                aggregate[4] = other[4]
+        self.count += count
+
+    def pack(self):
+        return RECORD.pack(self.start, self.count, *[value for aggregate in self.values for value in aggregate])
+
+    def getValue(self, index, aggregation):
+        if aggregation == "count":
+            return self.count
+        aggregate = self.values[index]
+        if aggregation == "avg":
+            return aggregate[0] / self.count
+        if aggregation == "delta":
+            return aggregate[4] - aggregate[3]
+        return aggregate[("sum", "min", "max", "first", "last").index(aggregation)]
+
+def unpackRecord(data, offset):
+    record = RECORD.unpack_from(data, offset)
+    values = [record[index:index + 5] for index in range(2, len(record), 5)]
+    return record[0], record[1], values
+
+class History():
+    def __init__(self, directory, localTimeZone):
+        self.directory = directory
+        self.localTimeZone = localTimeZone
+        # Queries (e.g. of the HTTP server) copy the open buckets while samples are recorded.
+        self.lock = threading.Lock()
+        # (resolution, name) -> open 'Bucket'
+        self.buckets = dict()
+        # (resolution, period, name) -> file object
+        self.files = dict()
+        self.currentDay = None
+        # The local day of the latest sample, so its midnight isn't computed per sample.
+        self.dayStart = 0
+        self.dayEnd = 0
+
+    def getBucketStart(self, resolution, timestamp):
+        if resolution != RESOLUTION_DAY:
+            return int(timestamp // resolution) * resolution
+        if not self.dayStart <= timestamp < self.dayEnd:
+            self.dayStart = getLocalMidnight(timestamp, self.localTimeZone)
+            self.dayEnd = getLocalMidnight(self.dayStart + 30 * 3600, self.localTimeZone)
+        return self.dayStart
+
+    def getPeriod(self, resolution, timestamp):
+        return datetime.fromtimestamp(timestamp, self.localTimeZone).strftime(PERIOD_FORMAT[resolution])
+
+    def getSegmentFileName(self, resolution, period, name):
+        return os.path.join(self.directory, str(resolution), period, name + ".bin")
+
+    def readSegment(self, resolution, period, name, limit=None):
+        # Yields (start, count, values) of all complete records of a segment within its first 'limit' bytes.
+        fileName = self.getSegmentFileName(resolution, period, name)
+        if not os.path.isfile(fileName):
+            return
+        with open(fileName, "rb") as segmentFile:
+            data = segmentFile.read() if limit is None else segmentFile.read(limit)
+        # A record being appended right now is skipped.
+        for offset in range(0, len(data) - len(data) % RECORD.size, RECORD.size):
+            yield unpackRecord(data, offset)
+
+    def restore(self, names, now):
+        # Rebuilds the open buckets of the coarser resolutions from the minute segments, after mbpv crashed.
+        for name in names:
+            for resolution in RESOLUTIONS[1:]:
+                start = self.getBucketStart(resolution, now)
+                lastStart = None
+                for recordStart, count, values in self.readSegment(resolution, self.getPeriod(resolution, start), name):
+                    lastStart = recordStart
+                # Written at the last shutdown.
+                if lastStart is not None and lastStart >= start:
+                    continue
+                bucket = Bucket(start)
+                for period in sorted(set([self.getPeriod(RESOLUTION_MINUTE, start), self.getPeriod(RESOLUTION_MINUTE, now)])):
+                    for recordStart, count, values in self.readSegment(RESOLUTION_MINUTE, period, name):
+                        if start <= recordStart < now:
+                            bucket.merge(count, values)
+                if bucket.count:
+                    self.buckets[(resolution, name)] = bucket
+
+    def record(self, timestamp, name, values):
+        # 'values' holds the values of HISTORY_FIELDS.
+        with self.lock:
+            for resolution in RESOLUTIONS:
+                start = self.getBucketStart(resolution, timestamp)
+                bucket = self.buckets.get((resolution, name))
+                if bucket is None or bucket.start != start:
+                    if bucket is not None:
+                        self.write(resolution, name, bucket)
+                    bucket = Bucket(start)
+                    self.buckets[(resolution, name)] = bucket
+                bucket.add(values)
+
+    def getOpenBuckets(self, resolution, names):
+        # Copies of the open buckets of 'resolution' by name, each with the period of its segment and the segment's
+        # size. Records written after the copy was taken (e.g. the copied bucket once closed) are beyond that size
+        # or in a later period, so queries leave them out.
+        openBuckets = dict()
+        with self.lock:
+            for name in names:
+                bucket = self.buckets.get((resolution, name))
+                if bucket is None or bucket.count == 0:
+                    continue
+                period = self.getPeriod(resolution, bucket.start)
+                segmentFile = self.files.get((resolution, period, name))
+                if segmentFile:
+                    size = segmentFile.tell()
+                else:
+                    fileName = self.getSegmentFileName(resolution, period, name)
+                    size = os.path.getsize(fileName) if os.path.isfile(fileName) else 0
+                copy = Bucket(bucket.start)
+                copy.merge(bucket.count, bucket.values)
+                openBuckets[name] = (copy, period, size)
+        return openBuckets
+
+    def write(self, resolution, name, bucket):
+        period = self.getPeriod(resolution, bucket.start)
+        key = (resolution, period, name)
+        if key not in self.files:
+            # Only one period per resolution and name is written at a time.
+            for other in [other for other in self.files if other[0] == resolution and other[2] == name]:
+                self.files.pop(other).close()
+            fileName = self.getSegmentFileName(resolution, period, name)
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            self.files[key] = open(fileName, "ab")
+        self.files[key].write(bucket.pack())
+
+    def flush(self, timestamp):
+        # Called once per cycle, so queries see the buckets closed during the cycle.
+        with self.lock:
+            for segmentFile in self.files.values():
+                segmentFile.flush()
+
+        day = self.getPeriod(RESOLUTION_MINUTE, timestamp)
+        if day != self.currentDay:
+            self.currentDay = day
+            self.prune(timestamp)
+
+    def prune(self, timestamp):
+        for resolution, days in RETENTION.items():
+            if days is None:
+                continue
+            oldest = self.getPeriod(resolution, timestamp - days * 86400)
+            resolutionDirectory = os.path.join(self.directory, str(resolution))
+            if not os.path.isdir(resolutionDirectory):
+                continue
+            for period in os.listdir(resolutionDirectory):
+                if period < oldest:
+                    shutil.rmtree(os.path.join(resolutionDirectory, period), ignore_errors=True)
+                    logging.info("Removed history segment {} of resolution {}.".format(period, resolution))
+
+    def close(self):
+        # Open buckets are written as they are and merged with the rest of their bucket after a restart.
+        with self.lock:
+            for (resolution, name), bucket in self.buckets.items():
+                if bucket.count:
+                    self.write(resolution, name, bucket)
+            self.buckets = dict()
+            for segmentFile in self.files.values():
+                segmentFile.close()
+            self.files = dict()
+
+    def chooseResolution(self, bucket, start, now):
+        # The coarsest resolution whose buckets fit into the requested ones and whose segments still cover 'start'.
+        # 'start' is rounded down to it by the query, and its last bucket may reach beyond 'end'.
+        if bucket in CALENDAR_BUCKETS:
+            return RESOLUTION_DAY
+        covering = [resolution for resolution in (RESOLUTION_MINUTE, RESOLUTION_QUARTER, RESOLUTION_HOUR)
+                    if RETENTION[resolution] is None or start >= now - RETENTION[resolution] * 86400]
+        for resolution in reversed(covering):
+            if bucket % resolution == 0:
+                return resolution
+        # The finer resolutions were pruned already, so the buckets get as coarse as the finest one still stored.
+        return covering[0]
+
+    def getPeriods(self, resolution, start, end):
+        periods = list()
+        day = datetime.fromtimestamp(start, self.localTimeZone).date()
+        lastDay = datetime.fromtimestamp(max(start, end - 1), self.localTimeZone).date()
+        while day <= lastDay:
+            period = day.strftime(PERIOD_FORMAT[resolution])
+            if len(periods) == 0 or periods[-1] != period:
+                periods.append(period)
+            day += timedelta(days=1)
+        return periods
+
+    def getQueryBucketStart(self, bucket, start, recordStart):
+        if bucket == "day":
+            return recordStart
+        if bucket in CALENDAR_BUCKETS:
+            dt = datetime.fromtimestamp(recordStart, self.localTimeZone)
+            naive = datetime(dt.year, dt.month if bucket == "month" else 1, 1)
+            return int(localize(naive, self.localTimeZone).timestamp())
+        return start + (recordStart - start) // bucket * bucket
+
+    def query(self, start, end, names, fields, aggregation, bucket, now):
+        # Yields (bucketStart, name, [value of each field]) in the order of time, then of 'names'.
+        # Only the segments of one period are held in memory at a time.
+        resolution = self.chooseResolution(bucket, start, now)
+        if resolution != RESOLUTION_DAY:
+            start -= start % resolution
+        fieldIndices = [HISTORY_FIELDS.index(field) for field in fields]
+
+        periods = self.getPeriods(resolution, start, end)
+        openBuckets = dict()
+        # The samples of the buckets not written yet, e.g. of the current minute, hour and day.
+        latestBuckets = self.getOpenBuckets(resolution, names)
+
+        def merge(name, recordStart, count, values):
+            if recordStart < start or recordStart >= end:
+                return
+            bucketStart = self.getQueryBucketStart(bucket, start, recordStart)
+            buckets = openBuckets.setdefault(bucketStart, dict())
+            if name not in buckets:
+                buckets[name] = Bucket(bucketStart)
+            buckets[name].merge(count, values)
+
+        for period in periods:
+            for name in names:
+                latest, latestPeriod, size = latestBuckets.get(name, (None, None, None))
+                if latest is not None and period > latestPeriod:
+                    continue
+                for recordStart, count, values in self.readSegment(resolution, period, name, size if period == latestPeriod else None):
+                    merge(name, recordStart, count, values)
+                # Merged last, as it holds the latest samples.
+                if period == latestPeriod:
+                    merge(name, latest.start, latest.count, latest.values)
+
+            # Buckets starting before the next period can't get more records, except calendar buckets spanning periods.
+            if period == periods[-1]:
+                completeBefore = None
+            else:
+                completeBefore = self.getPeriodEnd(resolution, period)
+            for bucketStart in sorted(openBuckets):
+                if completeBefore is not None and not self.isBucketComplete(bucket, bucketStart, completeBefore):
+                    break
+                buckets = openBuckets.pop(bucketStart)
+                for name in names:
+                    if name in buckets:
+                        yield bucketStart, name, [buckets[name].getValue(index, aggregation) for index in fieldIndices]
+
+    def getPeriodEnd(self, resolution, period):
+        if resolution == RESOLUTION_MINUTE:
+            naive = datetime.strptime(period, "%Y-%m-%d") + timedelta(days=1)
+        elif resolution == RESOLUTION_DAY:
+            naive = datetime(int(period) + 1, 1, 1)
+        else:
+            year, month = [int(part) for part in period.split("-")]
+            naive = datetime(year + month // 12, month % 12 + 1, 1)
+        return int(localize(naive, self.localTimeZone).timestamp())
+
+    def isBucketComplete(self, bucket, bucketStart, periodEnd):
+        if bucket == "day":
+            return bucketStart < periodEnd
+        if bucket in CALENDAR_BUCKETS:
+            return self.getQueryBucketStart(bucket, 0, periodEnd) > bucketStart
+        return bucketStart + bucket <= periodEnd
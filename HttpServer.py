@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  raspend's HTTP interface, serving the JSON views of the 'InverterState' records within the shared dictionary
+#  the history of the plants (see '/history' below) and the daily peaks (see '/peaks').
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import json
+import os
+import re
+import socket
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from functools import partial
+
+from raspend.http import RaspendHttpRequestHandler
+from raspend.utils.stoppablehttpserver import StoppableHttpServer, StoppableHttpServerThread
+from InverterState import InverterState, jsonDefault
+from History import HISTORY_FIELDS, AGGREGATIONS, CALENDAR_BUCKETS, parseTime
+
+def dumpData(sharedDict, path):
+    # The JSON view of 'sharedDict' for '/data' or of one of its nodes, e.g. for '/data/SB30/currentOutput'.
+    # The caller holds the data lock.
+    data = sharedDict
+    for part in path.split('/')[1:]:
+        if (type(data) is dict or type(data) is InverterState) and part in data:
+            data = data[part]
+    return json.dumps(data, ensure_ascii=False, default=jsonDefault)
+
+class MbpvHttpRequestHandler(RaspendHttpRequestHandler):
+    # Rows of history and peak responses are sent in chunks of this many rows.
+    CHUNK_ROWS = 500
+
+    def __init__(self, histories, localTimeZone, peakLogs, schedulerMonitor, *args, **kwargs):
+        # 'histories' and 'peakLogs' map plant names to their 'History' and 'PeakLog'. A single plant has the name None.
+        self.histories = histories
+        self.localTimeZone = localTimeZone
+        self.peakLogs = peakLogs
+        # The timing of the aligned sampling (see 'PlantSampling.SchedulerMonitor') or None.
+        self.schedulerMonitor = schedulerMonitor
+        super().__init__(*args, **kwargs)
+
+    def onGetRootDataPath(self):
+        with self.dataLock:
+            return json.dumps(self.sharedDict, ensure_ascii=False, default=jsonDefault)
+
+    def onGetDetailedDataPath(self):
+        with self.dataLock:
+            return dumpData(self.sharedDict, self.path)
+
+    def do_GET(self):
+        urlComponents = urllib.parse.urlparse(self.path)
+        if urlComponents.path.lower() == "/history":
+            return self.onGetHistory(urllib.parse.parse_qs(urlComponents.query))
+        if urlComponents.path.lower() == "/peaks":
+            return self.onGetPeaks(urllib.parse.parse_qs(urlComponents.query))
+        if urlComponents.path.lower() == "/scheduler":
+            return self.onGetScheduler()
+        if urlComponents.path.lower() == "/export":
+            return self.onGetExport(urllib.parse.parse_qs(urlComponents.query))
+        if urlComponents.path.lower() == "/exports":
+            return self.onGetExports(urllib.parse.parse_qs(urlComponents.query))
+        return super().do_GET()
+
+    def parseTime(self, text):
+        return parseTime(text, self.localTimeZone)
+
+    def parseHistoryQuery(self, queryParams):
+        # Returns the arguments of 'History.query' or raises a ValueError.
+        def getParam(name, default=None):
+            return queryParams[name][0] if name in queryParams else default
+
+        plant = getParam("plant")
+        if plant not in self.histories:
+            raise ValueError("Unknown plant '{}'! Known plants: {}".format(plant, ", ".join(str(name) for name in self.histories)))
+
+        with self.dataLock:
+            plantData = self.sharedDict[plant] if plant else self.sharedDict
+            known = list(plantData["Inverters"]) + ["Plant"]
+
+        now = int(time.time())
+        end = self.parseTime(getParam("end", now))
+        start = self.parseTime(getParam("start", end - 86400))
+
+        names = getParam("inverters", ",".join(known[:-1])).split(",")
+        fields = getParam("fields", ",".join(HISTORY_FIELDS)).split(",")
+        aggregation = getParam("aggregation", "avg")
+        bucket = getParam("bucket", "3600")
+        if bucket not in CALENDAR_BUCKETS:
+            bucket = int(bucket)
+            if bucket < 60 or bucket % 60:
+                raise ValueError("'bucket' must be a multiple of 60 seconds or one of {}!".format(", ".join(CALENDAR_BUCKETS)))
+
+        for name in names:
+            if name not in known:
+                raise ValueError("Unknown inverter '{}'!".format(name))
+        for field in fields:
+            if field not in HISTORY_FIELDS:
+                raise ValueError("Unknown field '{}'! Known fields: {}".format(field, ", ".join(HISTORY_FIELDS)))
+        if aggregation not in AGGREGATIONS:
+            raise ValueError("Unknown aggregation '{}'! Known aggregations: {}".format(aggregation, ", ".join(AGGREGATIONS)))
+        if start >= end:
+            raise ValueError("'start' must be before 'end'!")
+
+        return self.histories[plant], (start, end, names, fields, aggregation, bucket, now)
+
+    def writeChunk(self, text):
+        data = text.encode("utf-8")
+        if len(data):
+            self.wfile.write("{:X}\r\n".format(len(data)).encode("ascii") + data + b"\r\n")
+
+    def sendRows(self, rows, asCsv, columns, properties):
+        # Streams 'rows' with chunked transfer encoding, so the response is never held in memory.
+        # Chunked transfer encoding needs HTTP/1.1. The connection is closed afterwards nevertheless.
+        self.protocol_version = "HTTP/1.1"
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-type', 'text/csv; charset=utf-8' if asCsv else 'application/json; charset=utf-8')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        try:
+            if asCsv:
+                self.writeChunk(",".join(columns) + "\n")
+            else:
+                self.writeChunk(json.dumps(properties)[:-1] + ', "rows": [')
+
+            lines = list()
+            separator = ""
+            for row in rows:
+                if asCsv:
+                    lines.append(",".join(str(value) for value in row) + "\n")
+                else:
+                    lines.append(separator + json.dumps(row))
+                    separator = ","
+                if len(lines) >= self.CHUNK_ROWS:
+                    self.writeChunk("".join(lines))
+                    lines = list()
+            self.writeChunk("".join(lines))
+
+            if not asCsv:
+                self.writeChunk("]}")
+            self.wfile.write(b"0\r\n\r\n")
+        except OSError:
+            # The client went away.
+            pass
+        return
+
+    def onGetHistory(self, queryParams):
+        """ '/history?start=..&end=..&inverters=..&fields=..&aggregation=..&bucket=..&format=json|csv&plant=..'
+        """
+        if len(self.histories) == 0:
+            self.send_error(501, "No history available, see '--history'.")
+            return
+
+        try:
+            history, queryArgs = self.parseHistoryQuery(queryParams)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+
+        start, end, names, fields, aggregation, bucket, now = queryArgs
+        rows = ([bucketStart, name] + [round(value, 3) for value in values]
+                for bucketStart, name, values in history.query(start, end, names, fields, aggregation, bucket, now))
+        self.sendRows(rows, queryParams.get("format", ["json"])[0] == "csv", ["time", "inverter"] + fields,
+                      { "start": start, "end": end, "aggregation": aggregation, "bucket": bucket, "fields": fields })
+        return
+
+    def onGetPeaks(self, queryParams):
+        """ '/peaks?start=..&end=..&inverters=..&top=..&statistics=0|1&format=json|csv&plant=..'
+
+            The daily peaks from 'start' up to and including 'end' (local dates in ISO format), either in the order of
+            the log or the 'top' highest peaks. With 'statistics=1', each row also holds the day's statistics (JSON only).
+        """
+        def getParam(name, default=None):
+            return queryParams[name][0] if name in queryParams else default
+
+        if len(self.peakLogs) == 0:
+            self.send_error(501, "No peak log available, see '--peaklog'.")
+            return
+
+        try:
+            plant = getParam("plant")
+            if plant not in self.peakLogs:
+                raise ValueError("Unknown plant '{}'! Known plants: {}".format(plant, ", ".join(str(name) for name in self.peakLogs)))
+            peakLog = self.peakLogs[plant]
+            start = date.fromisoformat(getParam("start")) if "start" in queryParams else None
+            end = date.fromisoformat(getParam("end")) if "end" in queryParams else None
+            names = getParam("inverters").split(",") if "inverters" in queryParams else None
+            top = int(getParam("top", 0))
+            if top < 0:
+                raise ValueError("'top' must not be negative!")
+            asCsv = getParam("format", "json") == "csv"
+            withStatistics = getParam("statistics", "0") == "1"
+            if asCsv and withStatistics:
+                raise ValueError("The statistics are only available as JSON!")
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+
+        rows = peakLog.top(top, start, end, names) if top else peakLog.query(start, end, names)
+        if withStatistics:
+            rows = self.addPeakStatistics(peakLog, rows)
+        else:
+            rows = ([day.isoformat(), name, peak, peakTime] for day, name, peak, peakTime in rows)
+        self.sendRows(rows, asCsv, ["date", "inverter", "peak", "time"],
+                      { "start": start.isoformat() if start else None, "end": end.isoformat() if end else None, "top": top })
+        return
+
+    def addPeakStatistics(self, peakLog, rows):
+        # The statistics of a day are read once for all of its rows.
+        statisticsDay = None
+        for day, name, peak, peakTime in rows:
+            if day != statisticsDay:
+                statistics = peakLog.getStatistics(day) or dict()
+                statisticsDay = day
+            yield [day.isoformat(), name, peak, peakTime, statistics.get(name)]
+
+    def onGetScheduler(self):
+        """ '/scheduler'
+
+            Lag percentiles and overrun counts of the aligned sampling and the response times of each inverter.
+        """
+        if self.schedulerMonitor is None:
+            self.send_error(501, "No scheduler timing available with '--processes' or '--replay'.")
+            return
+
+        with self.dataLock:
+            strJsonResponse = json.dumps(self.schedulerMonitor.toDict(), ensure_ascii=False)
+
+        try:
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json; charset=utf-8')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(bytes(strJsonResponse, 'utf-8'))
+        except OSError:
+            # The client went away.
+            pass
+        return
+
+    def onGetExport(self, queryParams):
+        """ '/export?start=..&end=..&inverters=..&fields=..&aggregation=..&resolution=..&name=..&plant=..'
+
+            Queues the export of the history into columnar files in '<history>/exports/<name>' (see 'Export') and
+            responds with its status (202), which is then available via '/exports?name=..&plant=..'.
+        """
+        def getParam(name, default=None):
+            return queryParams[name][0] if name in queryParams else default
+
+        if len(self.histories) == 0:
+            self.send_error(501, "No history available, see '--history'.")
+            return
+
+        from Export import checkExport, exportJobs
+
+        try:
+            plant = getParam("plant")
+            if plant not in self.histories:
+                raise ValueError("Unknown plant '{}'! Known plants: {}".format(plant, ", ".join(str(name) for name in self.histories)))
+            with self.dataLock:
+                plantData = self.sharedDict[plant] if plant else self.sharedDict
+                known = list(plantData["Inverters"]) + ["Plant"]
+
+            now = int(time.time())
+            end = self.parseTime(getParam("end", now))
+            start = self.parseTime(getParam("start", end - 86400))
+            names = getParam("inverters", ",".join(known[:-1])).split(",")
+            for name in names:
+                if name not in known:
+                    raise ValueError("Unknown inverter '{}'!".format(name))
+            fields = getParam("fields", ",".join(HISTORY_FIELDS)).split(",")
+            aggregation = getParam("aggregation", "avg")
+            resolution = int(getParam("resolution")) if "resolution" in queryParams else None
+            directory = self.getExportDirectory(plant, getParam("name", time.strftime("%Y%m%d-%H%M%S", time.localtime(now))))
+            checkExport(directory, start, end, fields, aggregation, resolution)
+            status = exportJobs.submit(self.histories[plant], directory, start, end, names, fields, aggregation, resolution, now)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except OSError as e:
+            self.send_error(500, str(e))
+            return
+
+        if status is None:
+            self.send_error(503, "Too many exports queued, try again later.")
+            return
+        self.sendJson(202, status)
+
+    def onGetExports(self, queryParams):
+        """ '/exports?name=..&plant=..'
+
+            The status of an export: 'queued', 'running', 'failed' (with the 'error') or 'done' (with the 'metadata').
+        """
+        def getParam(name, default=None):
+            return queryParams[name][0] if name in queryParams else default
+
+        if len(self.histories) == 0:
+            self.send_error(501, "No history available, see '--history'.")
+            return
+
+        from Export import exportJobs
+
+        try:
+            plant = getParam("plant")
+            if plant not in self.histories:
+                raise ValueError("Unknown plant '{}'! Known plants: {}".format(plant, ", ".join(str(name) for name in self.histories)))
+            if "name" not in queryParams:
+                raise ValueError("'name' is missing!")
+            status = exportJobs.getStatus(self.getExportDirectory(plant, getParam("name")))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except OSError as e:
+            self.send_error(500, str(e))
+            return
+
+        if status is None:
+            self.send_error(404, "Unknown export '{}'!".format(getParam("name")))
+            return
+        self.sendJson(200, status)
+
+    def getExportDirectory(self, plant, exportName):
+        if not re.fullmatch(r"[\w-][\w.-]*", exportName):
+            raise ValueError("'name' may only contain letters, digits, '_', '-' and '.'!")
+        return os.path.join(self.histories[plant].directory, "exports", exportName)
+
+    def sendJson(self, status, data):
+        strJsonResponse = json.dumps(data, ensure_ascii=False)
+        try:
+            self.send_response(status)
+            self.send_header('Content-type', 'application/json; charset=utf-8')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(bytes(strJsonResponse, 'utf-8'))
+        except OSError:
+            # The client went away.
+            pass
+        return
+
+class MbpvHttpServer(StoppableHttpServer):
+    # Queries of the history and the peak log may read for a while. They're handled by threads of their own,
+    # so the other requests (e.g. '/data') are still answered one after the other meanwhile.
+    QUERY_PATHS = (b"/history", b"/peaks")
+    QUERY_WORKERS = 4
+
+    def __init__(self, server_address, RequestHandlerClass, shutdownFlag=None):
+        super().__init__(server_address, RequestHandlerClass, shutdownFlag)
+        self.queries = ThreadPoolExecutor(max_workers=self.QUERY_WORKERS, thread_name_prefix="mbpv-query")
+
+    def isQuery(self, request):
+        # Peeks at the request line. If it hasn't arrived completely yet, the request is handled like any other.
+        try:
+            requestLine = request.recv(256, socket.MSG_PEEK)
+        except OSError:
+            return False
+        parts = requestLine.split(b" ")
+        return len(parts) > 2 and parts[0] == b"GET" and parts[1].split(b"?")[0].lower() in self.QUERY_PATHS
+
+    def process_request(self, request, client_address):
+        if self.isQuery(request):
+            self.queries.submit(self.processQuery, request, client_address)
+        else:
+            super().process_request(request, client_address)
+
+    def processQuery(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        self.queries.shutdown()
+        super().server_close()
+
+class MbpvHTTPServerThread(StoppableHttpServerThread):
+    def __init__(self, shutdownFlag=None, dataLock=None, sharedDict=None, commandMap=None, serverPort=0, histories=None, localTimeZone=None, peakLogs=None,
+                 schedulerMonitor=None):
+        handler = partial(MbpvHttpRequestHandler, histories if histories is not None else dict(), localTimeZone,
+                          peakLogs if peakLogs is not None else dict(), schedulerMonitor, dataLock, sharedDict, commandMap)
+        # raspend's server thread with a server handling the queries by threads of their own.
+        threading.Thread.__init__(self)
+        self.shutdownFlag = shutdownFlag
+        self.stoppableHttpServer = MbpvHttpServer(('', serverPort), handler, shutdownFlag)
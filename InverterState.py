@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  The live state of an inverter as a slotted record instead of a dict.
+#
+#  Handlers access the fields as attributes. The JSON view of a node is only built on demand, i.e. for
+#  HTTP responses and the config file (see 'jsonDefault').
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+from SMA_Inverters import SunnyBoyConstants
+
+class InverterState():
+    # The fields in the order they are serialized. Unknown keys of a node are kept in 'extra'.
+    __slots__ = ("inverter", "totalYieldLastYear", "totalYieldCurrYear", "dayYield", "totalYield", "currentOutput",
+                 "maxPeakOutputDay", "maxPeakTime", "internalTemperature", "currentState", "version", "sampleCycle",
+                 "sampleTime", "dcInputs", "grid", "anomaly", "extra")
+    FIELDS = __slots__[:-4]
+    # Only serialized if set, i.e. with extended telemetry or anomaly detection.
+    OPTIONAL_FIELDS = __slots__[-4:-1]
+    FIELD_SET = frozenset(FIELDS + OPTIONAL_FIELDS)
+
+    def __init__(self, inverter):
+        # 'inverter' is the node's Modbus configuration (see 'Inverter' in README.md).
+        self.inverter = inverter
+        self.totalYieldLastYear = 0
+        self.totalYieldCurrYear = 0
+        self.dayYield = 0
+        self.totalYield = 0
+        self.currentOutput = 0
+        self.maxPeakOutputDay = 0
+        self.maxPeakTime = "--:--"
+        self.internalTemperature = 0
+        self.currentState = SunnyBoyConstants.STATE_AS_STRING[SunnyBoyConstants.STATE_UNKNOWN]
+        self.version = 0
+        self.sampleCycle = 0
+        self.sampleTime = 0
+        self.dcInputs = None
+        self.grid = None
+        self.anomaly = None
+        self.extra = None
+
+    @classmethod
+    def fromDict(cls, node):
+        state = cls(node["inverter"])
+        for key, value in node.items():
+            state[key] = value
+        return state
+
+    def toConfig(self):
+        # The static part of the node, as stored in the config file. Runtime counters are kept by 'StateJournal'.
+        node = { "inverter": self.inverter }
+        if self.extra:
+            node.update(self.extra)
+        return node
+
+    def toDict(self):
+        node = { field: getattr(self, field) for field in self.FIELDS }
+        for field in self.OPTIONAL_FIELDS:
+            if getattr(self, field) is not None:
+                node[field] = getattr(self, field)
+        if self.extra:
+            node.update(self.extra)
+        return node
+
+    # Dict like access, e.g. for generic code and request paths like '/data/sunnyboy1/currentOutput'.
+    def __getitem__(self, key):
+        if key in self.FIELD_SET:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = dict()
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return key in self.FIELD_SET or (self.extra is not None and key in self.extra)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.toDict().keys()
+
+def toInverterStates(mbpvData):
+    # Replaces the inverter nodes loaded from the config file by 'InverterState' records.
+    for inverter in mbpvData["Inverters"]:
+        if not isinstance(mbpvData[inverter], InverterState):
+            mbpvData[inverter] = InverterState.fromDict(mbpvData[inverter])
+    return mbpvData
+
+def jsonDefault(obj):
+    # Used as 'default' of 'json.dump', so the records are serialized as their JSON view.
+    if isinstance(obj, InverterState):
+        return obj.toDict()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
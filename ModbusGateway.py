@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Modbus-TCP connections shared by all inverters behind the same host and port (e.g. a Modbus gateway).
+#  Requests are pipelined: several transactions may be outstanding at once and every response is routed
+#  back to its request by the transaction id of the MBAP header.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import logging
+import socket
+import struct
+import threading
+
+READ_HOLDING_REGISTERS = 0x03
+READ_INPUT_REGISTERS = 0x04
+
+# Transaction id, protocol id, length, unit id
+MBAP_HEADER = struct.Struct(">HHHB")
+
+# Requests timing out in a row, until a stalled or half-open connection is closed and reopened by the next request.
+MAX_TIMEOUTS = 3
+
+class ModbusRequest():
+    def __init__(self, connection, transactionId, functionCode, address, count):
+        self.connection = connection
+        self.transactionId = transactionId
+        self.functionCode = functionCode
+        self.address = address
+        self.count = count
+        self.registers = None
+        self.event = threading.Event()
+
+    def complete(self, registers):
+        self.registers = registers
+        self.event.set()
+
+    def wait(self, timeout=None):
+        # Returns the list of registers or None, if the request failed or timed out.
+        if not self.event.wait(timeout):
+            # Give up this transaction, so that it doesn't occupy a slot of the connection anymore.
+            if self.connection:
+                self.connection.cancel(self)
+            return None
+        return self.registers
+
+class ModbusConnection():
+    def __init__(self, host, port, timeout=5.0, maxOutstanding=16):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.sendLock = threading.Lock()
+        self.pendingLock = threading.Lock()
+        self.pending = dict()
+        self.transactionId = 0
+        self.timeouts = 0
+        # Limits the number of requests in flight, as gateways only buffer a few of them.
+        self.outstanding = threading.BoundedSemaphore(maxOutstanding)
+
+    def is_open(self):
+        return self.sock is not None
+
+    def open(self):
+        with self.sendLock:
+            if self.sock is not None:
+                return True
+            try:
+                sock = socket.create_connection((self.host, self.port), self.timeout)
+                # The receiver blocks until data arrives, the connection is closed or shut down.
+                sock.settimeout(None)
+            except OSError as e:
+                logging.error("Unable to connect to {}:{}! Error: {}".format(self.host, self.port, e))
+                return False
+            self.sock = sock
+            receiver = threading.Thread(target=self.receive, args=(sock,), daemon=True)
+            receiver.start()
+        return True
+
+    def close(self):
+        with self.sendLock:
+            sock = self.sock
+            self.sock = None
+        with self.pendingLock:
+            self.timeouts = 0
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        self.failPending()
+
+    def failPending(self):
+        with self.pendingLock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for request in pending:
+            self.outstanding.release()
+            request.complete(None)
+
+    def cancel(self, request):
+        with self.pendingLock:
+            cancelled = self.pending.pop(request.transactionId, None) is request
+            if cancelled:
+                self.timeouts += 1
+            timeouts = self.timeouts
+        if cancelled:
+            self.outstanding.release()
+            request.complete(None)
+            if timeouts >= MAX_TIMEOUTS and self.sock is not None:
+                logging.error("{} requests to {}:{} timed out in a row! Reconnecting.".format(timeouts, self.host, self.port))
+                self.close()
+
+    def nextTransactionId(self):
+        self.transactionId = (self.transactionId % 0xFFFF) + 1
+        return self.transactionId
+
+    def submit(self, unitId, functionCode, address, count):
+        # Sends a read request without waiting for its response. Use 'wait' on the returned request.
+        if not self.open():
+            request = ModbusRequest(None, 0, functionCode, address, count)
+            request.complete(None)
+            return request
+
+        if not self.outstanding.acquire(timeout=self.timeout):
+            request = ModbusRequest(None, 0, functionCode, address, count)
+            request.complete(None)
+            return request
+
+        with self.sendLock:
+            transactionId = self.nextTransactionId()
+            request = ModbusRequest(self, transactionId, functionCode, address, count)
+            with self.pendingLock:
+                self.pending[transactionId] = request
+            frame = MBAP_HEADER.pack(transactionId, 0, 6, unitId) + struct.pack(">BHH", functionCode, address, count)
+            try:
+                self.sock.sendall(frame)
+                sent = True
+            except (OSError, AttributeError) as e:
+                logging.error("Sending to {}:{} failed! Error: {}".format(self.host, self.port, e))
+                sent = False
+
+        if not sent:
+            self.close()
+        return request
+
+    def receiveAll(self, sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("connection closed by peer")
+            data += chunk
+        return data
+
+    def receive(self, sock):
+        try:
+            while True:
+                transactionId, protocolId, length, unitId = MBAP_HEADER.unpack(self.receiveAll(sock, MBAP_HEADER.size))
+                if length < 3:
+                    # Not even a function code and a byte count: the stream is out of sync.
+                    raise ConnectionError("invalid MBAP length {}".format(length))
+                pdu = self.receiveAll(sock, length - 1)
+
+                with self.pendingLock:
+                    request = self.pending.pop(transactionId, None)
+                    if request is not None:
+                        self.timeouts = 0
+                if request is None:
+                    continue
+                self.outstanding.release()
+
+                registers = None
+                # Exception responses have the highest bit of the function code set.
+                if pdu[0] == request.functionCode and len(pdu) == 2 + 2 * request.count:
+                    registers = list(struct.unpack(">{}H".format(request.count), pdu[2:]))
+                request.complete(registers)
+        except (OSError, ConnectionError, struct.error) as e:
+            if self.sock is sock:
+                logging.info("Connection to {}:{} lost! Error: {}".format(self.host, self.port, e))
+        except Exception as e:
+            # The connection must not stay open without its receiver.
+            if self.sock is sock:
+                logging.error("Receiving from {}:{} failed! Error: {}".format(self.host, self.port, e))
+        if self.sock is sock:
+            self.close()
+
+class ModbusConnectionPool():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = dict()
+
+    def get(self, host, port):
+        with self.lock:
+            key = (host, port)
+            if key not in self.connections:
+                self.connections[key] = ModbusConnection(host, port)
+            return self.connections[key]
+
+    def closeAll(self):
+        with self.lock:
+            connections = list(self.connections.values())
+        for connection in connections:
+            connection.close()
+
+# All inverters of an mbpv instance share this pool.
+connectionPool = ModbusConnectionPool()
+
+class ModbusGatewayClient():
+    # Addresses a single unit id over a (possibly shared) connection.
+    def __init__(self, connection, unitId=1, timeout=5.0):
+        self.connection = connection
+        self.unit_id = unitId
+        self.timeout = timeout
+
+    @property
+    def host(self):
+        return self.connection.host
+
+    @property
+    def port(self):
+        return self.connection.port
+
+    def is_open(self):
+        return self.connection.is_open()
+
+    def open(self):
+        return self.connection.open()
+
+    def close(self):
+        self.connection.close()
+
+    def requestInputRegisters(self, address, count):
+        return self.connection.submit(self.unit_id, READ_INPUT_REGISTERS, address, count)
+
+    def requestHoldingRegisters(self, address, count):
+        return self.connection.submit(self.unit_id, READ_HOLDING_REGISTERS, address, count)
+
+    def read_input_registers(self, address, count):
+        return self.requestInputRegisters(address, count).wait(self.timeout)
+
+    def read_holding_registers(self, address, count):
+        return self.requestHoldingRegisters(address, count).wait(self.timeout)
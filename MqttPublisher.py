@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Publishes the inverters' values and the Suntimes of a plant to an MQTT broker, whenever they change.
+#
+#  Acquisition only puts the changed node into a bounded queue, keyed by topic. A topic that is already queued just
+#  gets its newer value, so bursts and backlogs collapse to the latest value per topic. If the queue is full
+#  nevertheless, the oldest topic is dropped. A sender thread of its own connects to the broker, reconnects with
+#  backoff and writes all queued topics at once as a batch of PUBLISH packets (MQTT 3.1.1, QoS 0).
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import json
+import logging
+import select
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from raspend import ThreadHandlerBase
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PINGREQ = 0xC0
+DISCONNECT = 0xE0
+
+def encodeLength(length):
+    # The remaining length of a packet, 7 bits per byte.
+    data = bytearray()
+    while True:
+        length, digit = divmod(length, 128)
+        data.append(digit | (0x80 if length else 0))
+        if not length:
+            return bytes(data)
+
+def encodeString(text):
+    data = text.encode("utf-8")
+    return struct.pack(">H", len(data)) + data
+
+class MqttClient():
+    # A minimal MQTT 3.1.1 client, which only publishes with QoS 0.
+    def __init__(self, host, port=1883, clientId="mbpv", username=None, password=None, keepAlive=60, timeout=5):
+        self.host = host
+        self.port = port
+        self.clientId = clientId
+        self.username = username
+        self.password = password
+        self.keepAlive = keepAlive
+        self.timeout = timeout
+        self.sock = None
+
+    def connect(self):
+        flags = 0x02
+        payload = encodeString(self.clientId)
+        if self.username:
+            flags |= 0x80
+            payload += encodeString(self.username)
+            if self.password:
+                flags |= 0x40
+                payload += encodeString(self.password)
+        variableHeader = encodeString("MQTT") + struct.pack(">BBH", 4, flags, self.keepAlive)
+
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        try:
+            self.sock.sendall(bytes([CONNECT]) + encodeLength(len(variableHeader) + len(payload)) + variableHeader + payload)
+            response = b""
+            while len(response) < 4:
+                data = self.sock.recv(4 - len(response))
+                if not data:
+                    raise ConnectionError("Connection closed by broker")
+                response += data
+            if response[0] != CONNACK or response[3] != 0:
+                raise ConnectionError("Connection refused by broker (return code {})".format(response[3]))
+        except Exception:
+            self.close()
+            raise
+
+    def makePublish(self, topic, payload, retain=False):
+        data = encodeString(topic) + payload
+        return bytes([PUBLISH | (0x01 if retain else 0)]) + encodeLength(len(data)) + data
+
+    def send(self, packets):
+        self.sock.sendall(b"".join(packets))
+
+    def ping(self):
+        self.sock.sendall(bytes([PINGREQ, 0]))
+
+    def drain(self):
+        # Discards what the broker sends (e.g. PINGRESP). An empty read means the broker closed the connection.
+        while select.select([self.sock], [], [], 0)[0]:
+            if not self.sock.recv(4096):
+                raise ConnectionError("Connection closed by broker")
+
+    def disconnect(self):
+        try:
+            self.sock.sendall(bytes([DISCONNECT, 0]))
+        except OSError:
+            pass
+        self.close()
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+class MqttPublisher(ThreadHandlerBase):
+    # The values published for each inverter.
+    FIELDS = ("currentOutput", "dayYield", "totalYield", "totalYieldCurrYear", "internalTemperature", "currentState", "version")
+    # Seconds to wait for more changes, before a batch is sent.
+    BATCH_DELAY = 0.1
+    # Maximum seconds between two reconnects.
+    MAX_BACKOFF = 60
+
+    def __init__(self, config, clientId="mbpv", topic="mbpv"):
+        # 'config' is the plant's node 'MQTT' (see README.md), 'topic' the prefix of all topics (see 'getMqttTopic').
+        self.client = MqttClient(config["host"], config.get("port", 1883), config.get("clientId", clientId),
+                                 config.get("username"), config.get("password"), config.get("keepAlive", 60))
+        self.topic = topic
+        self.retain = config.get("retain", True)
+        self.maxQueue = config.get("maxQueue", 10000)
+
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.stopEvent = threading.Event()
+        self.thread = None
+        self.suntimes = None
+        self.counters = { "queued": 0, "coalesced": 0, "dropped": 0, "published": 0, "batches": 0, "connects": 0 }
+        self.connected = False
+
+    def enqueue(self, topic, value):
+        # Called by acquisition, so it must never wait for the broker.
+        with self.condition:
+            if topic in self.pending:
+                self.counters["coalesced"] += 1
+            elif len(self.pending) >= self.maxQueue:
+                self.pending.popitem(last=False)
+                self.counters["dropped"] += 1
+            self.pending[topic] = value
+            self.counters["queued"] += 1
+            self.condition.notify()
+
+    def onChange(self, key, thisState, changed):
+        # Listener of the plant's 'ChangeFilter'. The node is copied, since it's changed further after the call.
+        self.enqueue(self.topic + "/" + key, { field: getattr(thisState, field) for field in self.FIELDS })
+
+    def requeue(self, batch):
+        # Values of a failed batch are sent again, unless newer ones were queued meanwhile.
+        with self.condition:
+            for topic, value in batch.items():
+                if topic not in self.pending and len(self.pending) < self.maxQueue:
+                    self.pending[topic] = value
+
+    def takeBatch(self, timeout):
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(timeout)
+        if self.pending and self.BATCH_DELAY:
+            # Changes of the same sampling cycle arrive one after the other.
+            self.stopEvent.wait(self.BATCH_DELAY)
+        with self.condition:
+            batch = self.pending
+            self.pending = OrderedDict()
+        return batch
+
+    def sendBatch(self, batch):
+        # All PUBLISH packets of a batch are sent with a single write.
+        self.client.send([self.client.makePublish(topic, json.dumps(value).encode("utf-8"), self.retain) for topic, value in batch.items()])
+
+    def run(self):
+        backoff = 1
+        while not self.stopEvent.is_set():
+            if not self.connected:
+                try:
+                    self.client.connect()
+                except Exception as e:
+                    logging.error("Connecting to MQTT broker {}:{} failed! Error: {}".format(self.client.host, self.client.port, e))
+                    self.stopEvent.wait(backoff)
+                    backoff = min(backoff * 2, self.MAX_BACKOFF)
+                    continue
+                logging.info("Connected to MQTT broker {}:{}.".format(self.client.host, self.client.port))
+                self.connected = True
+                self.counters["connects"] += 1
+                backoff = 1
+                lastSent = time.monotonic()
+
+            batch = self.takeBatch(self.client.keepAlive / 2)
+            try:
+                self.client.drain()
+                if batch:
+                    self.sendBatch(batch)
+                    self.counters["published"] += len(batch)
+                    self.counters["batches"] += 1
+                    lastSent = time.monotonic()
+                elif time.monotonic() - lastSent >= self.client.keepAlive / 2:
+                    self.client.ping()
+                    lastSent = time.monotonic()
+            except OSError as e:
+                logging.error("Publishing to MQTT broker {}:{} failed! Error: {}".format(self.client.host, self.client.port, e))
+                self.client.close()
+                self.connected = False
+                self.requeue(batch)
+
+        if self.connected:
+            # Whatever is left is sent before disconnecting.
+            batch = self.takeBatch(0)
+            try:
+                if batch:
+                    self.sendBatch(batch)
+            except OSError:
+                pass
+            self.client.disconnect()
+            self.connected = False
+
+    def getStatistics(self):
+        with self.condition:
+            return dict(self.counters, connected=self.connected, pending=len(self.pending))
+
+    def close(self):
+        self.stopEvent.set()
+        with self.condition:
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+
+    def prepare(self):
+        # The current values are published once, so retained topics are up to date after a restart.
+        for inverter in self.sharedDict["Inverters"]:
+            self.onChange(inverter, self.sharedDict[inverter], None)
+        self.thread = threading.Thread(target=self.run, name="MqttPublisher", daemon=True)
+        self.thread.start()
+        self.invoke()
+
+    def invoke(self):
+        # The Suntimes only change at day change.
+        if self.sharedDict.get("Suntimes") != self.suntimes:
+            self.suntimes = self.sharedDict.get("Suntimes")
+            self.enqueue(self.topic + "/Suntimes", self.suntimes)
+        self.sharedDict["MQTTStatus"] = self.getStatistics()
+        return
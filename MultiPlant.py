@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Support for serving several PV plants, each with its own configuration file, from one mbpv instance.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import os
+
+from raspend import ThreadHandlerBase
+
+def getPlantName(configFileName):
+    # The plant's node name is the name of its config file without extension.
+    return os.path.splitext(os.path.basename(configFileName))[0]
+
+# Node names of the shared dictionary besides the plants' when serving several plants.
+RESERVED_PLANT_NAMES = ("Plants",)
+
+def checkPlantNames(plantNames):
+    # Raises a ValueError, if plants would overwrite each other's (or a reserved) node and files.
+    seen = set()
+    for plantName in plantNames:
+        if plantName in RESERVED_PLANT_NAMES:
+            raise ValueError("The plant name '{}' is reserved, please rename its config file!".format(plantName))
+        if plantName in seen:
+            raise ValueError("Several config files have the plant name '{}', please rename them!".format(plantName))
+        seen.add(plantName)
+
+def getMqttTopic(mqttConfig, plantName, multiPlant):
+    # The prefix of a plant's MQTT topics, by default 'mbpv' or with several plants e.g. 'mbpv/plant1'.
+    return mqttConfig.get("topic", "mbpv/" + plantName if multiPlant else "mbpv")
+
+def checkMqttTopics(topics):
+    # Raises a ValueError, if plants would publish their inverters to the same topics.
+    seen = set()
+    for topic in topics:
+        if topic in seen:
+            raise ValueError("Several plants publish to the MQTT topic '{}', please set different topics!".format(topic))
+        seen.add(topic)
+
+def getPlantFileName(fileName, plantName):
+    # Derives a file name per plant, e.g. 'peaks.csv' becomes 'peaks_plant1.csv'.
+    root, ext = os.path.splitext(fileName)
+    return "{}_{}{}".format(root, plantName, ext)
+
+class PlantGroup(ThreadHandlerBase):
+    # Runs the handlers of several plants within a single thread, so plants don't cost a thread per task.
+    # Each handler must already be bound to the shared dictionary of its plant.
+    def __init__(self, handlers):
+        self.handlers = handlers
+
+    def prepare(self):
+        for handler in self.handlers:
+            handler.setShutdownFlag(self.shutdownFlag)
+            handler.prepare()
+        return
+
+    def acquire(self, tick):
+        # Send the requests of all plants first, then collect the responses.
+        for handler in self.handlers:
+            handler.requestCycle(tick)
+        for handler in self.handlers:
+            handler.gatherCycle(tick)
+        return
+
+    def invoke(self):
+        for handler in self.handlers:
+            handler.invoke()
+        return
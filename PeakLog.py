@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  The log of the daily peaks, stored in a binary file next to the csv peak log (e.g. 'peaks.csv' and 'peaks.peaks').
+#
+#  A record holds the day (proleptic Gregorian ordinal, uint32), the id of the inverter (uint16), the peak output
+#  in W (uint32) and the time of the peak in minutes after midnight (uint16). The records are sorted by day and id,
+#  so a peak is found by binary search without reading the whole file. The ids are the indices into the list of
+#  names in '<root>.peaks.json'. An id is never reused, so inverters can be added and removed at any time. The
+#  whole plant has the name 'Plant'.
+#
+#  The daily statistics of the inverters and the plant (see 'DailyStatistics') are stored with the day's records in
+#  '<root>.peaks.stats', one JSON object per day and line, e.g. '{"date": "2019-06-01", "statistics": {"Plant": ..}}'.
+#
+#  The csv file is only an export, rewritten from the binary log with a column for each name.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import bisect
+import heapq
+import json
+import logging
+import os
+import struct
+import threading
+from datetime import date
+
+from StateJournal import replaceFile
+
+PEAK_RECORD = struct.Struct("<IHIH")
+
+# The peak time of records imported from old csv files is unknown.
+NO_PEAK_TIME = 0xFFFF
+
+# Number of records read at once by queries.
+READ_BLOCK = 4096
+
+def toMinutes(peakTime):
+    try:
+        hours, minutes = peakTime.split(":")
+        return int(hours) * 60 + int(minutes)
+    except (AttributeError, ValueError):
+        return NO_PEAK_TIME
+
+def fromMinutes(minutes):
+    if minutes == NO_PEAK_TIME:
+        return "--:--"
+    return "{:02d}:{:02d}".format(minutes // 60, minutes % 60)
+
+class PeakKeys():
+    # A read-only sequence of the records' (day, id) keys, so 'bisect' can search the file.
+    def __init__(self, peakLog):
+        self.peakLog = peakLog
+
+    def __len__(self):
+        return self.peakLog.count
+
+    def __getitem__(self, index):
+        return self.peakLog.readRecords(index, index + 1)[0][0:2]
+
+class PeakLog():
+    def __init__(self, csvFileName):
+        root = os.path.splitext(csvFileName)[0]
+        self.csvFileName = csvFileName
+        self.fileName = root + ".peaks"
+        self.namesFileName = root + ".peaks.json"
+        self.lock = threading.Lock()
+        self.keys = PeakKeys(self)
+
+        self.names = list()
+        if os.path.isfile(self.namesFileName):
+            with open(self.namesFileName) as namesFile:
+                self.names = json.load(namesFile)["names"]
+        self.ids = { name: inverterId for inverterId, name in enumerate(self.names) }
+
+        self.file = open(self.fileName, "a+b")
+        self.count = self.file.seek(0, os.SEEK_END) // PEAK_RECORD.size
+        # A record torn by a crash is dropped.
+        if self.file.tell() != self.count * PEAK_RECORD.size:
+            logging.info("Ignoring the incomplete end of {}.".format(self.fileName))
+            self.file.truncate(self.count * PEAK_RECORD.size)
+
+        self.statisticsFileName = root + ".peaks.stats"
+        self.statisticsFile = open(self.statisticsFileName, "a+b")
+        self.loadStatisticsOffsets()
+
+    def loadStatisticsOffsets(self):
+        # The offset of each day's line in the statistics file.
+        self.statisticsOffsets = dict()
+        self.statisticsFile.seek(0)
+        offset = 0
+        for line in self.statisticsFile:
+            # A line torn by a crash is dropped.
+            if not line.endswith(b"\n"):
+                logging.info("Ignoring the incomplete end of {}.".format(self.statisticsFileName))
+                self.statisticsFile.truncate(offset)
+                break
+            try:
+                self.statisticsOffsets[date.fromisoformat(json.loads(line)["date"]).toordinal()] = offset
+            except (ValueError, KeyError) as e:
+                logging.error("Ignoring a line of {}! Error: {}".format(self.statisticsFileName, e))
+            offset += len(line)
+
+    def getId(self, name):
+        # The names are written before any record refers to them.
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            replaceFile(self.namesFileName, json.dumps({ "names": self.names }))
+        return self.ids[name]
+
+    def readRecords(self, first, last):
+        self.file.seek(first * PEAK_RECORD.size)
+        return list(PEAK_RECORD.iter_unpack(self.file.read((last - first) * PEAK_RECORD.size)))
+
+    def add(self, day, peaks, statistics=None):
+        # Stores the peaks of 'day', a list of (name, peak output, peak time), and the day's statistics by name.
+        dayNumber = day.toordinal()
+        with self.lock:
+            lastDay = self.readRecords(self.count - 1, self.count)[0][0] if self.count else 0
+            if dayNumber < lastDay:
+                logging.error("Peaks of {} are older than the latest peaks in {}!".format(day, self.fileName))
+                return False
+            if dayNumber == lastDay:
+                # Logged again on the same day, e.g. after a restart. The day's records are replaced.
+                self.count = bisect.bisect_left(self.keys, (dayNumber, 0))
+                self.file.truncate(self.count * PEAK_RECORD.size)
+
+            records = sorted((dayNumber, self.getId(name), max(0, int(peak)), toMinutes(peakTime)) for name, peak, peakTime in peaks)
+            self.file.write(b"".join(PEAK_RECORD.pack(*record) for record in records))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.count += len(records)
+
+            if statistics is not None:
+                self.addStatistics(dayNumber, statistics)
+        return True
+
+    def addStatistics(self, dayNumber, statistics):
+        # The day's statistics are replaced, like its records. The caller holds the lock.
+        offset = self.statisticsOffsets.get(dayNumber)
+        if offset is not None:
+            self.statisticsFile.truncate(offset)
+        offset = self.statisticsFile.seek(0, os.SEEK_END)
+        line = json.dumps({ "date": date.fromordinal(dayNumber).isoformat(), "statistics": statistics }) + "\n"
+        self.statisticsFile.write(line.encode("utf-8"))
+        self.statisticsFile.flush()
+        os.fsync(self.statisticsFile.fileno())
+        self.statisticsOffsets[dayNumber] = offset
+
+    def getStatistics(self, day):
+        # Returns the statistics of 'day' by name or None.
+        with self.lock:
+            offset = self.statisticsOffsets.get(day.toordinal())
+            if offset is None:
+                return None
+            self.statisticsFile.seek(offset)
+            return json.loads(self.statisticsFile.readline())["statistics"]
+
+    def getRange(self, start, end):
+        # The indices of the records from day 'start' up to and including day 'end'.
+        first = bisect.bisect_left(self.keys, (start.toordinal(), 0)) if start else 0
+        last = bisect.bisect_left(self.keys, (end.toordinal() + 1, 0)) if end else self.count
+        return first, last
+
+    def lookup(self, day, name):
+        # Returns (peak output, peak time) of inverter 'name' on 'day' or None.
+        with self.lock:
+            if name not in self.ids:
+                return None
+            key = (day.toordinal(), self.ids[name])
+            index = bisect.bisect_left(self.keys, key)
+            if index == self.count:
+                return None
+            record = self.readRecords(index, index + 1)[0]
+            if record[0:2] != key:
+                return None
+            return record[2], fromMinutes(record[3])
+
+    def query(self, start=None, end=None, names=None):
+        # Yields (day, name, peak output, peak time) in the order of the log, 'start' and 'end' are inclusive.
+        with self.lock:
+            first, last = self.getRange(start, end)
+        ids = set(self.ids[name] for name in names if name in self.ids) if names is not None else None
+        for blockStart in range(first, last, READ_BLOCK):
+            with self.lock:
+                records = self.readRecords(blockStart, min(blockStart + READ_BLOCK, last))
+            for dayNumber, inverterId, peak, minutes in records:
+                if ids is None or inverterId in ids:
+                    yield date.fromordinal(dayNumber), self.names[inverterId], peak, fromMinutes(minutes)
+
+    def top(self, count, start=None, end=None, names=None):
+        # The 'count' highest peaks, e.g. the best peak of the plant this year is 'top(1, date(2019, 1, 1), None, ["Plant"])'.
+        return heapq.nlargest(count, self.query(start, end, names), key=lambda row: row[2])
+
+    def importCsv(self):
+        # Peak logs written before the binary log existed are imported once. Columns without a header are skipped.
+        if self.count or not os.path.isfile(self.csvFileName):
+            return
+        days = dict()
+        try:
+            with open(self.csvFileName) as csvFile:
+                header = csvFile.readline().strip().split(",")[1:]
+                for line in csvFile:
+                    columns = line.strip().split(",")
+                    if len(columns) < 2:
+                        continue
+                    days[date.fromisoformat(columns[0])] = [(name, int(float(peak)), None) for name, peak in zip(header, columns[1:]) if peak]
+        except (IOError, ValueError) as e:
+            logging.error("Importing csv file '{}' failed! Error: {}".format(self.csvFileName, e))
+            return
+        for day in sorted(days):
+            self.add(day, days[day])
+        logging.info("Imported {} days of {} into {}.".format(len(days), self.csvFileName, self.fileName))
+
+    def exportCsv(self, fileName=None):
+        # One row per day and a column for each name ever logged. Inverters not present on a day have empty cells.
+        with self.lock:
+            names = list(self.names)
+        lines = ["Date," + ",".join(names) + "\n"]
+        row = None
+        currentDay = None
+        for day, name, peak, peakTime in self.query():
+            if day != currentDay:
+                if row:
+                    lines.append(currentDay.isoformat() + "," + ",".join(row) + "\n")
+                currentDay = day
+                row = [""] * len(names)
+            row[self.ids[name]] = str(peak)
+        if row:
+            lines.append(currentDay.isoformat() + "," + ",".join(row) + "\n")
+        try:
+            replaceFile(fileName or self.csvFileName, "".join(lines))
+        except IOError as e:
+            logging.error("Unable to write csv file '{}'! Error: {}".format(fileName or self.csvFileName, e))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.statisticsFile.close()
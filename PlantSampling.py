@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Time aligned sampling of all inverters of a PV plant.
+#
+#  All inverters are triggered at the same wall clock tick, so every sample of a cycle is stamped with
+#  the same cycle id and timestamp. Plant totals and the plant's peak are only taken from fully gathered cycles.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import logging
+import math
+import time
+from datetime import datetime
+
+from raspend import ThreadHandlerBase
+from raspend.utils.workerthreads import WorkerThreadBase
+from ChangeFilter import ChangeFilter
+from DailyStatistics import DailyStatistics, QuantileSketch, getThresholds
+from History import HISTORY_FIELDS
+
+class SamplePlant(ThreadHandlerBase):
+    # Seconds between two updates of the node 'Statistics'.
+    STATISTICS_INTERVAL = 60
+    # Number of cycles, in which inverters not answered yet are read regardless of daylight.
+    INITIAL_CYCLES = 5
+
+    def __init__(self, readers, localTimeZone, deadline, clock=None):
+        # 'readers' are the 'ReadInverter' handlers of the plant's inverters.
+        self.readers = readers
+        self.localTimeZone = localTimeZone
+        # Seconds after sending the requests until all responses of a cycle must have arrived.
+        self.deadline = deadline
+        self.cycleId = 0
+        self.tick = None
+        self.pending = dict()
+        self.sampled = list()
+        self.gathered = dict()
+        self.today = clock() if clock else datetime.now(localTimeZone)
+        self.changeFilter = None
+        self.statistics = dict()
+        self.latencies = dict()
+        self.plantStatistics = None
+        self.statisticsPublished = 0
+        self.history = None
+        self.anomalyDetector = None
+        self.analytics = None
+        self.changeListeners = list()
+        self.initialReaders = set()
+        self.initialCycles = 0
+
+    def addChangeListener(self, listener):
+        # 'listener' is notified about each changed inverter node (see 'ChangeFilter.addListener').
+        self.changeListeners.append(listener)
+
+    def setHistory(self, history):
+        # Every gathered sample is recorded to 'history' (see 'History.History').
+        self.history = history
+
+    def setAnomalyDetector(self, anomalyDetector):
+        # The outputs of each cycle are compared by 'anomalyDetector' (see 'Anomalies.AnomalyDetector').
+        self.anomalyDetector = anomalyDetector
+
+    def setAnalytics(self, analytics):
+        # 'analytics' is told about each complete cycle (see 'Analytics.onCompleteCycle').
+        self.analytics = analytics
+
+    def prepare(self):
+        # Optional deadbands of the plant's config, e.g. { "currentOutput": 5, "internalTemperature": 0.5 }.
+        self.changeFilter = ChangeFilter(self.sharedDict.get("Deadbands"))
+        for listener in self.changeListeners:
+            self.changeFilter.addListener(listener)
+
+        # Instead of each inverter being read one after the other while holding the access lock,
+        # the first cycles read all inverters at once, even at night.
+        for reader in self.readers:
+            reader.readOnPrepare = False
+            reader.setChangeFilter(self.changeFilter)
+            reader.setSharedDict(self.sharedDict)
+            reader.setShutdownFlag(self.shutdownFlag)
+            reader.prepare()
+        self.initialReaders = set(self.readers)
+        self.initialCycles = self.INITIAL_CYCLES
+
+        for reader in self.readers:
+            self.latencies[reader.key] = QuantileSketch()
+            self.statistics[reader.key] = DailyStatistics(getThresholds(self.sharedDict[reader.key].inverter.get("maxOutput", 0)))
+        self.plantStatistics = DailyStatistics(getThresholds(self.sharedDict["Unit"].get("peakOutputInWP", 0)))
+        self.publishStatistics()
+
+        if self.anomalyDetector:
+            self.anomalyDetector.setInverters([reader.key for reader in self.readers],
+                                              [self.sharedDict[reader.key].inverter.get("maxOutput", 0) for reader in self.readers])
+
+        if self.history:
+            self.history.restore([reader.key for reader in self.readers] + ["Plant"], self.today.timestamp())
+
+        # The day's peak may have been restored by the state journal.
+        thePlant = self.sharedDict.get("Plant", dict())
+        self.sharedDict["Plant"] = { "cycle": 0,
+                                     "timestamp": 0,
+                                     "currentOutput": 0,
+                                     "dayYield": 0,
+                                     "maxPeakOutputDay": thePlant.get("maxPeakOutputDay", 0),
+                                     "maxPeakTime": thePlant.get("maxPeakTime", "--:--"),
+                                     "cycleLatency": 0,
+                                     "maxCycleLatency": 0,
+                                     "completeCycles": 0,
+                                     "incompleteCycles": 0,
+                                     "lastStragglers": [],
+                                     "stragglers": dict(),
+                                     "anomalies": [],
+                                     "changes": self.changeFilter.getStatistics() }
+        return
+
+    def acquire(self, tick):
+        # Called at each tick without holding the access lock, since it waits for the inverters' responses.
+        self.requestCycle(tick)
+        self.gatherCycle(tick)
+        return
+
+    def requestCycle(self, tick):
+        self.cycleId += 1
+        self.tick = tick
+        self.requestTime = time.monotonic()
+
+        self.pending = dict()
+        initial = self.initialCycles > 0
+        for reader in self.readers:
+            if reader.isDaylight(tick) or (initial and reader in self.initialReaders):
+                self.pending[reader] = reader.driver.requestCurrentValues()
+        if initial:
+            self.initialCycles -= 1
+
+        self.sampled = list(self.pending.keys())
+        return
+
+    def gatherCycle(self, tick):
+        self.gathered = dict()
+        for reader, requests in self.pending.items():
+            if reader.driver.completeCurrentValues(requests, max(0.0, self.requestTime + self.deadline - time.monotonic())):
+                self.gathered[reader] = time.monotonic() - self.requestTime
+                self.initialReaders.discard(reader)
+        self.pending = dict()
+        return
+
+    def invoke(self):
+        if self.tick is None:
+            return
+
+        sampleTime = datetime.fromtimestamp(self.tick, self.localTimeZone)
+
+        # The statistics of the day are reset together with the peak values.
+        if sampleTime.weekday() != self.today.weekday():
+            thePlant = self.sharedDict["Plant"]
+            thePlant["maxPeakOutputDay"] = 0
+            thePlant["maxPeakTime"] = "--:--"
+            thePlant["maxCycleLatency"] = 0
+            for statistics in list(self.statistics.values()) + [self.plantStatistics]:
+                statistics.reset()
+            self.publishStatistics()
+            self.today = sampleTime
+
+        for reader in self.readers:
+            thisState = self.sharedDict[reader.key]
+            if reader in self.gathered:
+                self.latencies[reader.key].add(self.gathered[reader] * 1000)
+                self.statistics[reader.key].update(reader.driver.currentOutput, self.tick)
+                if self.history:
+                    self.history.record(self.tick, reader.key, [getattr(reader.driver, field) for field in HISTORY_FIELDS])
+                # Cycle and time are only stamped, if the sample really changed the node.
+                if reader.setCurrentValues(thisState, sampleTime.time()):
+                    thisState.sampleCycle = self.cycleId
+                    thisState.sampleTime = self.tick
+            reader.checkDayChange(thisState, sampleTime)
+
+        if self.anomalyDetector and len(self.sampled):
+            self.detectAnomalies(sampleTime)
+
+        self.updatePlant(sampleTime)
+
+        if self.history:
+            self.history.flush(self.tick)
+        return
+
+    def detectAnomalies(self, sampleTime):
+        # Inverters which didn't answer in time are left out of the comparison.
+        outputs = [reader.driver.currentOutput for reader in self.readers]
+        valid = [reader in self.gathered for reader in self.readers]
+        updateAnomalies(self.anomalyDetector, self.sharedDict, self.tick, outputs, valid, sampleTime)
+        return
+
+    def publishStatistics(self):
+        theStatistics = { key: statistics.toDict() for key, statistics in self.statistics.items() }
+        theStatistics["Plant"] = self.plantStatistics.toDict()
+        self.sharedDict["Statistics"] = theStatistics
+        self.statisticsPublished = self.tick if self.tick else 0
+        return
+
+    def updatePlant(self, sampleTime):
+        thePlant = self.sharedDict["Plant"]
+        thePlant["changes"] = self.changeFilter.getStatistics()
+
+        if self.tick - self.statisticsPublished >= self.STATISTICS_INTERVAL:
+            self.publishStatistics()
+
+        # Nothing to do at night.
+        if len(self.sampled) == 0:
+            return
+
+        stragglers = [reader.key for reader in self.sampled if reader not in self.gathered]
+        thePlant["lastStragglers"] = stragglers
+
+        if len(stragglers):
+            thePlant["incompleteCycles"] += 1
+            for key in stragglers:
+                thePlant["stragglers"][key] = thePlant["stragglers"].get(key, 0) + 1
+            logging.info("Cycle {} incomplete, missing {}.".format(self.cycleId, ", ".join(stragglers)))
+            return
+
+        cycleLatency = round(max(self.gathered.values()) * 1000)
+
+        # The raw samples of this cycle, not the values within the deadbands.
+        currentOutput = 0
+        dayYield = 0
+        for reader in self.sampled:
+            currentOutput += reader.driver.currentOutput
+            dayYield += reader.driver.dayYield
+
+        thePlant["cycle"] = self.cycleId
+        thePlant["timestamp"] = self.tick
+        thePlant["currentOutput"] = currentOutput
+        thePlant["dayYield"] = dayYield
+        thePlant["cycleLatency"] = cycleLatency
+        thePlant["maxCycleLatency"] = max(thePlant["maxCycleLatency"], cycleLatency)
+        thePlant["completeCycles"] += 1
+        self.plantStatistics.update(currentOutput, self.tick)
+
+        if self.history:
+            # The plant's temperature is the highest of its inverters.
+            self.history.record(self.tick, "Plant", [currentOutput,
+                                                     dayYield,
+                                                     sum(reader.driver.totalYield for reader in self.sampled),
+                                                     max(reader.driver.internalTemperature for reader in self.sampled)])
+
+        if currentOutput > thePlant["maxPeakOutputDay"]:
+            thePlant["maxPeakOutputDay"] = currentOutput
+            thePlant["maxPeakTime"] = sampleTime.strftime("%H:%M")
+
+        if self.analytics:
+            self.analytics.onCompleteCycle()
+        return
+
+    def getLatencies(self):
+        # The response times of each inverter in milliseconds and the number of cycles it didn't answer in time.
+        if not self.latencies:
+            return dict()
+        stragglers = self.sharedDict["Plant"]["stragglers"]
+        return { key: { "latency": summarize(sketch),
+                        "missedCycles": stragglers.get(key, 0) }
+                 for key, sketch in self.latencies.items() }
+
+def updateAnomalies(detector, sharedDict, tick, outputs, valid, sampleTime):
+    # Compares the outputs of a cycle, in the order of the detector's keys, and updates the nodes' 'anomaly'.
+    for index in detector.update(tick, outputs, valid):
+        key = detector.keys[index]
+        if detector.flagged[index]:
+            logging.error("Output of {} is {:.0f} % below its usual share of the plant's output since {}.".format(
+                          key, (1 - detector.scores[index]) * 100, sampleTime.strftime("%H:%M")))
+        else:
+            logging.info("Output of {} is back to its usual share of the plant's output.".format(key))
+
+    for key, anomaly in zip(detector.keys, detector.getAnomalies()):
+        sharedDict[key].anomaly = anomaly
+    sharedDict["Plant"]["anomalies"] = detector.getFlagged()
+    return
+
+def summarize(sketch, maximum=None):
+    # The sketch's relative error mustn't put a percentile above the maximum.
+    summary = { "p{:g}".format(q * 100): round(sketch.quantile(q) if maximum is None else min(sketch.quantile(q), maximum), 1)
+                for q in SchedulerMonitor.QUANTILES }
+    if maximum is not None:
+        summary["max"] = round(maximum, 1)
+    return summary
+
+class SchedulerMonitor():
+    # The timing of the aligned sampling: how late each cycle started after its tick, how long acquiring (waiting for
+    # the inverters) and invoking (holding the access lock) took, and how many ticks passed without a cycle.
+    # Durations are kept in quantile sketches, so memory stays bounded.
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, interval, policy):
+        self.interval = interval
+        self.policy = policy
+        self.plants = dict()
+        self.cycles = 0
+        self.overruns = 0
+        self.missedIntervals = 0
+        self.sketches = { phase: QuantileSketch() for phase in ("lateness", "acquire", "invoke") }
+        self.maxima = { phase: 0.0 for phase in self.sketches }
+
+    def addPlant(self, plantName, samplePlant):
+        # Each plant's inverters are listed by 'plantName', a single plant's (None) directly.
+        self.plants[plantName] = samplePlant
+
+    def record(self, lateness, acquireDuration, invokeDuration, passed, missed):
+        # Durations are in seconds. 'passed' ticks passed during the cycle, 'missed' of them won't get a cycle.
+        self.cycles += 1
+        for phase, duration in (("lateness", lateness), ("acquire", acquireDuration), ("invoke", invokeDuration)):
+            self.sketches[phase].add(duration * 1000)
+            self.maxima[phase] = max(self.maxima[phase], duration * 1000)
+        if passed:
+            self.overruns += 1
+            self.missedIntervals += missed
+
+    def toDict(self):
+        theScheduler = { "interval": self.interval,
+                         "policy": self.policy,
+                         "cycles": self.cycles,
+                         "overruns": self.overruns,
+                         "missedIntervals": self.missedIntervals }
+        for phase, sketch in self.sketches.items():
+            theScheduler[phase] = summarize(sketch, self.maxima[phase])
+        if list(self.plants) == [None]:
+            theScheduler["inverters"] = self.plants[None].getLatencies()
+        else:
+            theScheduler["inverters"] = { plantName: samplePlant.getLatencies() for plantName, samplePlant in self.plants.items() }
+        return theScheduler
+
+class AlignedWorkerThread(WorkerThreadBase):
+    # A worker thread invoking its handler at wall clock boundaries of 'interval' seconds.
+    # The handler's 'acquire' is called without and its 'invoke' with holding the access lock.
+    #
+    # If a cycle overruns, i.e. ends after the next tick, the ticks passed meanwhile are handled by 'policy':
+    #   skip:     wait for the next tick to come (ticks passed get no cycle),
+    #   coalesce: start a single cycle for the latest tick passed right away,
+    #   catchup:  start a cycle for each tick passed, one after the other, but for no more than MAX_CATCH_UP ticks.
+    POLICIES = ("skip", "coalesce", "catchup")
+    MAX_CATCH_UP = 10
+    # Seconds between two log entries about overruns.
+    LOG_INTERVAL = 60
+    # Seconds between two attempts to prepare the handler, if preparing it failed.
+    PREPARE_RETRY = 60
+
+    def __init__(self, shutdownEvent, accessLock, threadHandler, interval, policy="skip", monitor=None):
+        super().__init__(shutdownEvent, accessLock, threadHandler)
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown overrun policy '{}'! Known policies: {}".format(policy, ", ".join(self.POLICIES)))
+        self.interval = interval
+        self.policy = policy
+        self.monitor = monitor
+        # The index of the latest tick, whose passing was accounted for.
+        self.accounted = 0
+        self.lastOverrunLog = 0
+        self.errors = 0
+        self.lastErrorLog = 0
+        return
+
+    def nextTick(self, now):
+        return (math.floor(now / self.interval) + 1) * self.interval
+
+    def scheduleNext(self, tick, now):
+        # Returns the next tick, the number of ticks newly passed during the cycle of 'tick' and how many ticks
+        # won't get a cycle. Ticks are counted by their index, so they don't drift.
+        index = round(tick / self.interval)
+        latest = math.floor(now / self.interval)
+        passed = max(0, latest - max(index, self.accounted))
+        self.accounted = max(self.accounted, latest)
+        if latest <= index:
+            return (index + 1) * self.interval, passed, 0
+        if self.policy == "coalesce":
+            return latest * self.interval, passed, latest - index - 1
+        if self.policy == "catchup":
+            missed = max(0, latest - index - self.MAX_CATCH_UP)
+            return (index + 1 + missed) * self.interval, passed, missed
+        return (latest + 1) * self.interval, passed, latest - index
+
+    def logError(self, what, error):
+        # Failing cycles are logged with their traceback, but not more often than every LOG_INTERVAL seconds.
+        self.errors += 1
+        now = time.time()
+        if now - self.lastErrorLog >= self.LOG_INTERVAL:
+            logging.exception("{} failed ({} error(s) so far)! Error: {}".format(what, self.errors, error))
+            self.lastErrorLog = now
+
+    def prepare(self):
+        # Returns whether the handler is prepared. There's no sampling without, e.g. as the change filter is missing.
+        with self.accessLock:
+            try:
+                self.threadHandler.prepare()
+                return True
+            except Exception as e:
+                self.logError("Preparing the sampling (retried every {} s)".format(self.PREPARE_RETRY), e)
+                return False
+
+    def run(self):
+        prepared = self.prepare()
+        tick = self.nextTick(time.time() if prepared else time.time() + self.PREPARE_RETRY)
+
+        while not self.shutdownEvent.wait(max(0.0, tick - time.time())):
+            if not prepared:
+                prepared = self.prepare()
+                tick = self.nextTick(time.time() if prepared else time.time() + self.PREPARE_RETRY)
+                continue
+
+            started = time.time()
+            try:
+                self.threadHandler.acquire(tick)
+                acquired = time.time()
+
+                with self.accessLock:
+                    self.threadHandler.invoke()
+                    finished = time.time()
+
+                    nextTick, passed, missed = self.scheduleNext(tick, finished)
+                    if self.monitor:
+                        self.monitor.record(started - tick, acquired - started, finished - acquired, passed, missed)
+            except Exception as e:
+                # The next cycle is scheduled anyway, so a single failing inverter or handler doesn't end the sampling.
+                self.logError("Cycle of {}".format(datetime.fromtimestamp(tick).strftime("%H:%M:%S")), e)
+                finished = time.time()
+                nextTick, passed, missed = self.scheduleNext(tick, finished)
+
+            if passed and finished - self.lastOverrunLog >= self.LOG_INTERVAL:
+                logging.info("Cycle of {} took {:.3f} s, {} interval(s) passed, {} missed ({}).".format(
+                             datetime.fromtimestamp(tick).strftime("%H:%M:%S"), finished - started, passed, missed, self.policy))
+                self.lastOverrunLog = finished
+            tick = nextTick
+        return
@@ -8,6 +8,8 @@
 #  Copyright (c) 2019 Joerg Beckers
 
 import os
+import struct
+import time
 
 # Needed for testing on Windows
 if os.name == "nt":
@@ -15,7 +17,8 @@ if os.name == "nt":
 
 from collections import namedtuple
 
-from pyModbusTCP.client import ModbusClient
+from ModbusGateway import ModbusConnection, ModbusGatewayClient, connectionPool
+from Drivers import registerDriver, buildReadPlan, sliceRegisters
 
 ModbusRegister = namedtuple("ModbusRegister", "Address SequenceSize")
 
@@ -26,9 +29,20 @@ class SunnyBoyRegisters():
         self.CURRENT_OUTPUT = ModbusRegister(30775, 2)
         self.INTERNAL_TEMPERATURE = ModbusRegister(30953, 2)
         self.CURRENT_STATE = ModbusRegister(30201, 2)
+        # Extended telemetry: current, voltage and power of each DC input (MPPT), the grid voltages L1 to L3 and the grid frequency.
+        self.DC_INPUT_A = ModbusRegister(30769, 6)
+        self.DC_INPUT_B = ModbusRegister(30957, 6)
+        self.GRID_VOLTAGE = ModbusRegister(30783, 6)
+        self.GRID_FREQUENCY = ModbusRegister(30803, 2)
+        # Identification registers, used for device discovery.
+        self.DEVICE_TYPE = ModbusRegister(30053, 2)
+        self.MAX_OUTPUT = ModbusRegister(30231, 2)
+        # Serial number (2 registers), SusyID (1 register) and unit id (1 register). Always answers on unit id '1'.
+        self.UNIT_ID = ModbusRegister(42109, 4)
 
 class SunnyBoyConstants():
     NAN_VALUE = 0x80000000
+    NAN_VALUE_U32 = 0xFFFFFFFF
     # SMA Modbus registers are 16 bits wide.
     MBREG_BITWIDTH = 16
     STATE_OK = 307
@@ -41,25 +55,99 @@ class SunnyBoyConstants():
                         STATE_OFF: "off", 
                         STATE_WARNING: "warning", 
                         STATE_ERROR: "error" }
+    # Device type numbers (register 30053) of known models.
+    DEVICE_TYPE_AS_STRING = { 9319: "SUNNY BOY 3.0",
+                              9320: "SUNNY BOY 3.6",
+                              9321: "SUNNY BOY 4.0",
+                              9322: "SUNNY BOY 5.0" }
 
-def getSunnyBoyUnitID(client):
-    # read inverters unit_id
-    if client.is_open:
-        unit_id_regs = client.read_input_registers(42109, 4)
-        if unit_id_regs:
-            client.unit_id = unit_id_regs[3]
+def shiftRegisters(regVal, sequenceSize):
+    if regVal is None:
+        return 0
+    if len(regVal) != sequenceSize:
+        return 0
+
+    val = 0
+    for i in range(0, sequenceSize, 1):
+        val |= regVal[i]
+        if i < sequenceSize-1:
+            val <<= SunnyBoyConstants.MBREG_BITWIDTH
+
+    if val == SunnyBoyConstants.NAN_VALUE:
+        val = 0
+    return val
+
+def decodeValues(regVal, signed=True):
+    # Decodes consecutive 32 bit values at once. SMA's NaN values are returned as None.
+    count = len(regVal)
+    values = struct.unpack(">{}{}".format(count // 2, "i" if signed else "I"), struct.pack(">{}H".format(count), *regVal))
+    nanValue = -SunnyBoyConstants.NAN_VALUE if signed else SunnyBoyConstants.NAN_VALUE_U32
+    return [None if value == nanValue else value for value in values]
+
+def scaleValues(values, divisor):
+    return [None if value is None else round(value / divisor, 3) for value in values]
+
+def getSunnyBoyIdentity(ipOrHostName, portNumber, timeout=5.0, connection=None):
+    # Returns a dict with unit id, model, serial number and maximum output or None, if the device doesn't look like an SMA inverter.
+    registers = SunnyBoyRegisters()
+
+    # Without a shared connection (e.g. when scanning) we use a private one.
+    privateConnection = connection is None
+    if privateConnection:
+        connection = ModbusConnection(ipOrHostName, portNumber, timeout)
+
+    try:
+        client = ModbusGatewayClient(connection, 1, timeout)
+        unit_id_regs = client.read_input_registers(registers.UNIT_ID.Address, registers.UNIT_ID.SequenceSize)
+        if not unit_id_regs:
+            return None
+
+        client.unit_id = unit_id_regs[3]
+        # Both reads are pipelined.
+        request_DeviceType = client.requestInputRegisters(registers.DEVICE_TYPE.Address, registers.DEVICE_TYPE.SequenceSize)
+        request_MaxOutput = client.requestInputRegisters(registers.MAX_OUTPUT.Address, registers.MAX_OUTPUT.SequenceSize)
+        deviceType = shiftRegisters(request_DeviceType.wait(timeout), registers.DEVICE_TYPE.SequenceSize)
+        maxOutput = shiftRegisters(request_MaxOutput.wait(timeout), registers.MAX_OUTPUT.SequenceSize)
+    finally:
+        if privateConnection:
+            connection.close()
+
+    if deviceType in SunnyBoyConstants.DEVICE_TYPE_AS_STRING:
+        model = SunnyBoyConstants.DEVICE_TYPE_AS_STRING[deviceType]
+    else:
+        model = "SMA device type {}".format(deviceType)
+
+    return { "unitId": client.unit_id,
+             "model": model,
+             "serialNumber": shiftRegisters(unit_id_regs[0:2], 2),
+             "maxOutput": maxOutput }
 
 class SunnyBoy():
-    def __init__(self, ipOrHostName, portNumber):
+    def __init__(self, ipOrHostName, portNumber, unitId=None, mbClient=None, deviceCache=None, clock=None):
         self.registers = SunnyBoyRegisters()
-        self.mbClient = ModbusClient()
-        self.mbClient.host = ipOrHostName
-        self.mbClient.port = portNumber
-        # Initialize with '1' and determine the correct Id by reading input register 42109 (see 'getSunnyBoyUnitID').
-        self.mbClient.unit_id = 1
+        self.identity = None
+        # Raw responses are recorded here in capture mode (see 'setCapture').
+        self.capture = None
+        self.captureId = None
+
+        # E.g. a client replaying captured responses.
+        if mbClient is not None:
+            unitId = mbClient.unit_id
+
+        # Inverters behind the same host and port (e.g. a Modbus gateway) share one pipelined connection.
+        connection = connectionPool.get(ipOrHostName, portNumber) if mbClient is None else None
+
+        # Without a known unit id, determine the correct one by reading input register 42109 (see 'getSunnyBoyIdentity').
+        if unitId is None:
+            self.identity = getSunnyBoyIdentity(ipOrHostName, portNumber, connection=connection)
+            unitId = self.identity["unitId"] if self.identity else 1
+            if deviceCache and self.identity:
+                deviceCache.update(ipOrHostName, portNumber, self.identity)
+
+        if mbClient is None:
+            mbClient = ModbusGatewayClient(connection, unitId)
+        self.mbClient = mbClient
         self.mbClient.open()
-        
-        getSunnyBoyUnitID(self.mbClient)
 
         self.dayYield = 0
         self.totalYield = 0
@@ -67,33 +155,70 @@ class SunnyBoy():
         self.maxPeakOutputDay = 0
         self.internalTemperature = 0
         self.currentState = SunnyBoyConstants.STATE_UNKNOWN
+        # Extended telemetry (see 'setTelemetry').
+        self.blocks = None
+        self.dcInputs = None
+        self.grid = None
         
     def shiftValue(self, regVal, sequenceSize):
-        if regVal is None:
-            return 0
-        if len(regVal) != sequenceSize:
-            return 0
+        return shiftRegisters(regVal, sequenceSize)
 
-        val = 0
-        for i in range(0, sequenceSize, 1):
-            val |= regVal[i]
-            if i < sequenceSize-1:
-                val <<= SunnyBoyConstants.MBREG_BITWIDTH
+    def setCapture(self, capture, name):
+        # Records every raw response to 'capture' (see 'Capture.CaptureWriter').
+        self.capture = capture
+        self.captureId = capture.register(name)
 
-        if val == SunnyBoyConstants.NAN_VALUE:
-            val = 0
-        return val
+    def setTelemetry(self, enabled):
+        # With extended telemetry, the values of the DC inputs and the grid are read too. All registers are merged
+        # into a few block reads, which are fewer round trips than the five single reads without telemetry.
+        if enabled:
+            registers = self.registers
+            self.blocks = buildReadPlan([registers.DAY_YIELD, registers.TOTAL_YIELD, registers.CURRENT_OUTPUT,
+                                         registers.INTERNAL_TEMPERATURE, registers.CURRENT_STATE, registers.DC_INPUT_A,
+                                         registers.DC_INPUT_B, registers.GRID_VOLTAGE, registers.GRID_FREQUENCY])
+        else:
+            self.blocks = None
+            self.dcInputs = None
+            self.grid = None
 
-    def readCurrentValues(self):
-        if not self.mbClient.is_open and not self.mbClient.open():
-            print ("Unable to connect to {}:{}".format(self.mbClient.host(), self.mbClient.port()))
+    def requestCurrentValues(self):
+        # Sends all requests at once without waiting for the responses, so the round trips overlap.
+        # Returns the pending requests for 'completeCurrentValues' or None, if the inverter isn't reachable.
+        if not self.mbClient.is_open() and not self.mbClient.open():
+            print ("Unable to connect to {}:{}".format(self.mbClient.host, self.mbClient.port))
+            return None
+
+        if self.blocks:
+            return [self.mbClient.requestInputRegisters(address, count) for address, count in self.blocks]
+
+        return [self.mbClient.requestInputRegisters(self.registers.DAY_YIELD.Address, self.registers.DAY_YIELD.SequenceSize),
+                self.mbClient.requestInputRegisters(self.registers.TOTAL_YIELD.Address, self.registers.TOTAL_YIELD.SequenceSize),
+                self.mbClient.requestInputRegisters(self.registers.CURRENT_OUTPUT.Address, self.registers.CURRENT_OUTPUT.SequenceSize),
+                self.mbClient.requestInputRegisters(self.registers.INTERNAL_TEMPERATURE.Address, self.registers.INTERNAL_TEMPERATURE.SequenceSize),
+                self.mbClient.requestInputRegisters(self.registers.CURRENT_STATE.Address, self.registers.CURRENT_STATE.SequenceSize)]
+
+    def completeCurrentValues(self, requests, timeout=None):
+        # Waits for the responses of 'requestCurrentValues'. Returns False, if not all of them arrived in time.
+        if requests is None:
             return False
 
-        regVal_DayYield = self.mbClient.read_input_registers(self.registers.DAY_YIELD.Address, self.registers.DAY_YIELD.SequenceSize)
-        regVal_TotalYield = self.mbClient.read_input_registers(self.registers.TOTAL_YIELD.Address, self.registers.TOTAL_YIELD.SequenceSize)
-        regVal_CurrentOutput = self.mbClient.read_input_registers(self.registers.CURRENT_OUTPUT.Address, self.registers.CURRENT_OUTPUT.SequenceSize)
-        regVal_InternalTemperature = self.mbClient.read_input_registers(self.registers.INTERNAL_TEMPERATURE.Address, self.registers.INTERNAL_TEMPERATURE.SequenceSize)
-        regVal_CurrentState = self.mbClient.read_input_registers(self.registers.CURRENT_STATE.Address, self.registers.CURRENT_STATE.SequenceSize)
+        if timeout is None:
+            timeout = self.mbClient.timeout
+
+        # 'timeout' applies to all responses together.
+        deadline = time.monotonic() + timeout
+        regVals = [request.wait(max(0.0, deadline - time.monotonic())) for request in requests]
+
+        if self.capture:
+            self.capture.record(self.captureId, requests, regVals)
+
+        if self.blocks:
+            return self.setTelemetryValues(regVals)
+
+        regVal_DayYield, regVal_TotalYield, regVal_CurrentOutput, regVal_InternalTemperature, regVal_CurrentState = regVals
+
+        if None in (regVal_DayYield, regVal_TotalYield, regVal_CurrentOutput, regVal_InternalTemperature, regVal_CurrentState):
+            return False
 
         self.dayYield = self.shiftValue(regVal_DayYield, self.registers.DAY_YIELD.SequenceSize)
         self.totalYield = self.shiftValue(regVal_TotalYield, self.registers.TOTAL_YIELD.SequenceSize)
@@ -101,4 +226,40 @@ class SunnyBoy():
         self.internalTemperature = self.shiftValue(regVal_InternalTemperature, self.registers.INTERNAL_TEMPERATURE.SequenceSize) * 0.1
         self.currentState = self.shiftValue(regVal_CurrentState, self.registers.CURRENT_STATE.SequenceSize)
 
-        return True
\ No newline at end of file
+        return True
+
+    def setTelemetryValues(self, blockRegisters):
+        # Slices the values out of the responses of the block reads.
+        if None in blockRegisters or any(len(registers) != count for (address, count), registers in zip(self.blocks, blockRegisters)):
+            return False
+
+        registers = self.registers
+        regVal_DayYield, regVal_TotalYield, regVal_CurrentOutput, regVal_InternalTemperature, regVal_CurrentState = [
+            sliceRegisters(self.blocks, blockRegisters, register.Address, register.SequenceSize)
+            for register in (registers.DAY_YIELD, registers.TOTAL_YIELD, registers.CURRENT_OUTPUT, registers.INTERNAL_TEMPERATURE, registers.CURRENT_STATE)]
+
+        self.dayYield = self.shiftValue(regVal_DayYield, registers.DAY_YIELD.SequenceSize)
+        self.totalYield = self.shiftValue(regVal_TotalYield, registers.TOTAL_YIELD.SequenceSize)
+        self.currentOutput = self.shiftValue(regVal_CurrentOutput, registers.CURRENT_OUTPUT.SequenceSize)
+        self.internalTemperature = self.shiftValue(regVal_InternalTemperature, registers.INTERNAL_TEMPERATURE.SequenceSize) * 0.1
+        self.currentState = self.shiftValue(regVal_CurrentState, registers.CURRENT_STATE.SequenceSize)
+
+        # Current (FIX3), voltage (FIX2) and power (FIX0) of each input, grid voltages and frequency (FIX2).
+        self.dcInputs = list()
+        for register in (registers.DC_INPUT_A, registers.DC_INPUT_B):
+            current, voltage, power = decodeValues(sliceRegisters(self.blocks, blockRegisters, register.Address, register.SequenceSize))
+            self.dcInputs.append({ "voltage": scaleValues([voltage], 100)[0],
+                                   "current": scaleValues([current], 1000)[0],
+                                   "power": power })
+
+        gridVoltage = decodeValues(sliceRegisters(self.blocks, blockRegisters, registers.GRID_VOLTAGE.Address, registers.GRID_VOLTAGE.SequenceSize), False)
+        gridFrequency = decodeValues(sliceRegisters(self.blocks, blockRegisters, registers.GRID_FREQUENCY.Address, registers.GRID_FREQUENCY.SequenceSize), False)
+        self.grid = { "voltage": scaleValues(gridVoltage, 100),
+                      "frequency": scaleValues(gridFrequency, 100)[0] }
+
+        return True
+
+    def readCurrentValues(self):
+        return self.completeCurrentValues(self.requestCurrentValues())
+
+registerDriver("sunnyboy", SunnyBoy)
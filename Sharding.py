@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Spreads the acquisition of a plant's inverters across several worker processes.
+#
+#  Each worker process samples its share of the inverters and writes their latest values into a fixed layout
+#  table in shared memory. The HTTP front process reads that table in place to update the shared dictionary.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import logging
+import signal
+import struct
+import threading
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+from datetime import datetime
+
+from raspend import ThreadHandlerBase
+from PlantSampling import SamplePlant, AlignedWorkerThread, updateAnomalies
+from ChangeFilter import getChangeStatistics
+from DailyStatistics import DailyStatistics, getThresholds
+from SMA_Inverters import SunnyBoyConstants
+from Suntimes import suntimesCache
+from Discovery import DeviceCache
+
+# The values of an inverter's node as stored in a row of the live table.
+LIVE_FIELDS = ("dayYield", "totalYield", "currentOutput", "internalTemperature", "currentState", "maxPeakOutputDay",
+               "maxPeakTime", "totalYieldLastYear", "totalYieldCurrYear", "version", "sampleCycle", "sampleTime")
+# Followed by the raw values of the latest cycle the inverter answered in, i.e. not within the deadbands.
+CYCLE_FIELDS = ("cycleTime", "cycleOutput", "cycleDayYield")
+
+# Each row starts with a sequence number, which is odd while the row is being written.
+LIVE_SEQUENCE = struct.Struct("<Q")
+LIVE_VALUES = struct.Struct("<{}d".format(len(LIVE_FIELDS) + len(CYCLE_FIELDS)))
+LIVE_ROW_SIZE = LIVE_SEQUENCE.size + LIVE_VALUES.size
+
+STATE_AS_CODE = { state: code for code, state in SunnyBoyConstants.STATE_AS_STRING.items() }
+
+# Seconds a reader waits for a consistent copy of a row, before it considers the row's writer dead.
+READ_TIMEOUT = 0.05
+# Seconds between two starts of the same shard.
+RESTART_DELAY = 10
+
+# The workers are spawned rather than forked, as the front process already runs threads (e.g. the HTTP servers) and
+# holds their sockets when a dead worker is restarted.
+processContext = multiprocessing.get_context("spawn")
+
+class LiveTable():
+    def __init__(self, rows, name=None):
+        # Creates a new table, unless 'name' refers to an existing one.
+        self.rows = rows
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=rows * LIVE_ROW_SIZE)
+            self.shm.buf[:] = bytes(rows * LIVE_ROW_SIZE)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+    def write(self, row, values):
+        # Only a single process may write a given row.
+        # The sequence number is still odd, if the previous writer of the row died while writing it.
+        offset = row * LIVE_ROW_SIZE
+        sequence = LIVE_SEQUENCE.unpack_from(self.shm.buf, offset)[0] | 1
+        LIVE_SEQUENCE.pack_into(self.shm.buf, offset, sequence)
+        LIVE_VALUES.pack_into(self.shm.buf, offset + LIVE_SEQUENCE.size, *values)
+        LIVE_SEQUENCE.pack_into(self.shm.buf, offset, sequence + 1)
+
+    def read(self, row):
+        # Retries until it got a consistent copy of the row. Returns (sequence, None), if there was none within
+        # READ_TIMEOUT seconds, e.g. as the writer died while writing the row.
+        offset = row * LIVE_ROW_SIZE
+        deadline = None
+        while True:
+            sequence = LIVE_SEQUENCE.unpack_from(self.shm.buf, offset)[0]
+            if not sequence & 1:
+                values = LIVE_VALUES.unpack_from(self.shm.buf, offset + LIVE_SEQUENCE.size)
+                if LIVE_SEQUENCE.unpack_from(self.shm.buf, offset)[0] == sequence:
+                    return sequence, values
+            if deadline is None:
+                deadline = time.monotonic() + READ_TIMEOUT
+            elif time.monotonic() > deadline:
+                return sequence, None
+            time.sleep(0)
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+def nodeToRow(thisState):
+    values = list()
+    for field in LIVE_FIELDS:
+        value = getattr(thisState, field)
+        if field == "currentState":
+            value = STATE_AS_CODE.get(value, SunnyBoyConstants.STATE_UNKNOWN)
+        elif field == "maxPeakTime":
+            value = -1 if value == "--:--" else int(value[0:2]) * 60 + int(value[3:5])
+        values.append(value)
+    return values
+
+def rowToNode(values, thisState):
+    for field, value in zip(LIVE_FIELDS, values):
+        if field == "currentState":
+            value = SunnyBoyConstants.STATE_AS_STRING.get(int(value), SunnyBoyConstants.STATE_AS_STRING[SunnyBoyConstants.STATE_UNKNOWN])
+        elif field == "maxPeakTime":
+            value = "--:--" if value < 0 else "{:02d}:{:02d}".format(int(value) // 60, int(value) % 60)
+        elif field != "internalTemperature" and field != "sampleTime":
+            value = int(value)
+        setattr(thisState, field, value)
+
+class SampleShard(SamplePlant):
+    # Samples the inverters of one worker process and publishes them in the live table.
+    def __init__(self, readers, localTimeZone, deadline, liveTable, rows):
+        super().__init__(readers, localTimeZone, deadline)
+        self.liveTable = liveTable
+        self.rows = rows
+        self.cycles = { reader.key: [0, 0, 0] for reader in readers }
+
+    def publish(self):
+        for reader in self.readers:
+            # The front process recognizes the cycle by its time, even if the node itself didn't change.
+            if reader in self.gathered:
+                self.cycles[reader.key] = [self.tick, reader.driver.currentOutput, reader.driver.dayYield]
+            self.liveTable.write(self.rows[reader.key], nodeToRow(self.sharedDict[reader.key]) + self.cycles[reader.key])
+
+    def prepare(self):
+        super().prepare()
+        self.publish()
+
+    def invoke(self):
+        super().invoke()
+        self.publish()
+
+def runShard(readerClass, tableName, rows, shardData, localTimeZone, interval, deviceCacheFileName, stopEvent):
+    # Entry point of a worker process. Shutdown is signaled by the front process via 'stopEvent'.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    liveTable = LiveTable(len(rows), tableName)
+    deviceCache = DeviceCache(deviceCacheFileName) if deviceCacheFileName else None
+    readers = [readerClass(inverter, localTimeZone, deviceCache) for inverter in shardData["Inverters"]]
+    sampleShard = SampleShard(readers, localTimeZone, interval * 0.8, liveTable, rows)
+    sampleShard.setSharedDict(shardData)
+    sampleShard.setShutdownFlag(stopEvent)
+
+    try:
+        AlignedWorkerThread(stopEvent, threading.Lock(), sampleShard, interval).run()
+    except Exception as e:
+        logging.error("Shard {} stopped unexpectedly! Error: {}".format(shardData["Inverters"], e))
+    finally:
+        liveTable.close()
+
+class ShardedAcquisition():
+    # Starts 'processes' worker processes, each sampling every n-th inverter of the plant.
+    # Workers that died are restarted by 'supervise'.
+    def __init__(self, readerClass, mbpvData, localTimeZone, interval, processes, deviceCacheFileName=None):
+        self.inverters = list(mbpvData["Inverters"])
+        self.rows = { inverter: row for row, inverter in enumerate(self.inverters) }
+        self.liveTable = LiveTable(len(self.inverters))
+        self.readerClass = readerClass
+        self.localTimeZone = localTimeZone
+        self.interval = interval
+        self.deviceCacheFileName = deviceCacheFileName
+        self.stopping = False
+        # (inverters, shard data) of each shard
+        self.shards = list()
+        self.workers = list()
+        # Each worker gets an event of its own, as a worker killed while waiting on a shared one would block setting it.
+        self.stopEvents = list()
+        self.started = list()
+
+        for shard in range(processes):
+            shardInverters = self.inverters[shard::processes]
+            if len(shardInverters) == 0:
+                continue
+            shardData = { "Unit": mbpvData["Unit"], "Inverters": shardInverters }
+            # The deadbands are applied by the workers, the anomalies are detected by the front process.
+            if "Deadbands" in mbpvData:
+                shardData["Deadbands"] = mbpvData["Deadbands"]
+            for inverter in shardInverters:
+                shardData[inverter] = mbpvData[inverter]
+            self.shards.append((shardInverters, shardData))
+
+    def startWorker(self, shard):
+        stopEvent = processContext.Event()
+        worker = processContext.Process(target=runShard,
+                                        args=(self.readerClass, self.liveTable.name, self.rows, self.shards[shard][1], self.localTimeZone,
+                                              self.interval, self.deviceCacheFileName, stopEvent),
+                                        name="mbpv-shard-{}".format(shard),
+                                        daemon=True)
+        worker.start()
+        self.workers[shard] = worker
+        self.stopEvents[shard] = stopEvent
+        self.started[shard] = time.monotonic()
+
+    def start(self):
+        self.workers = [None] * len(self.shards)
+        self.stopEvents = [None] * len(self.shards)
+        self.started = [0] * len(self.shards)
+        for shard in range(len(self.shards)):
+            self.startWorker(shard)
+
+    def supervise(self, sharedDict):
+        # Returns the inverters of the workers not running. These are restarted with their current nodes
+        # from 'sharedDict', but not sooner than RESTART_DELAY seconds after their last start.
+        stale = list()
+        if self.stopping:
+            return stale
+        for shard, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            shardInverters, shardData = self.shards[shard]
+            stale.extend(shardInverters)
+            if time.monotonic() - self.started[shard] < RESTART_DELAY:
+                continue
+            logging.error("Worker {} sampling {} died with exit code {}! Restarting it.".format(worker.name, shardInverters, worker.exitcode))
+            worker.join()
+            for inverter in shardInverters:
+                shardData[inverter] = sharedDict[inverter]
+            self.startWorker(shard)
+        return stale
+
+    def stop(self):
+        self.stopping = True
+        for stopEvent in self.stopEvents:
+            stopEvent.set()
+        for worker in self.workers:
+            worker.join()
+        self.liveTable.close()
+        self.liveTable.unlink()
+
+class ReadLiveTable(ThreadHandlerBase):
+    # Runs in the front process and copies the rows changed by the worker processes into the shared dictionary.
+    # The statistics, the anomalies and the plant's values are computed here from the raw values of each cycle.
+    def __init__(self, shardedAcquisition, localTimeZone):
+        self.shardedAcquisition = shardedAcquisition
+        self.liveTable = shardedAcquisition.liveTable
+        self.rows = shardedAcquisition.rows
+        self.localTimeZone = localTimeZone
+        self.sequences = dict()
+        self.nodeValues = dict()
+        self.versions = dict()
+        self.cycleTimes = dict()
+        # The raw values of the cycles not evaluated yet, by cycle time and inverter.
+        self.cycles = dict()
+        self.latestCycle = 0
+        self.written = 0
+        self.suppressed = 0
+        self.statistics = dict()
+        self.plantStatistics = None
+        self.statisticsPublished = 0
+        self.anomalyDetector = None
+        self.analytics = None
+        self.today = datetime.now(localTimeZone)
+        self.forecast = None
+
+    def setForecast(self, forecast):
+        self.forecast = forecast
+
+    def setAnomalyDetector(self, anomalyDetector):
+        self.anomalyDetector = anomalyDetector
+
+    def setAnalytics(self, analytics):
+        self.analytics = analytics
+
+    def prepare(self):
+        self.setSuntimes(self.today)
+
+        for inverter in self.rows:
+            self.versions[inverter] = self.sharedDict[inverter].version
+            self.statistics[inverter] = DailyStatistics(getThresholds(self.sharedDict[inverter].inverter.get("maxOutput", 0)))
+        self.plantStatistics = DailyStatistics(getThresholds(self.sharedDict["Unit"].get("peakOutputInWP", 0)))
+        self.publishStatistics()
+
+        if self.anomalyDetector:
+            self.anomalyDetector.setInverters(list(self.rows), [self.sharedDict[inverter].inverter.get("maxOutput", 0) for inverter in self.rows])
+
+        # The day's peak may have been restored by the state journal.
+        thePlant = self.sharedDict.get("Plant", dict())
+        self.sharedDict["Plant"] = { "timestamp": 0,
+                                     "currentOutput": 0,
+                                     "dayYield": 0,
+                                     "maxPeakOutputDay": thePlant.get("maxPeakOutputDay", 0),
+                                     "maxPeakTime": thePlant.get("maxPeakTime", "--:--"),
+                                     "anomalies": [],
+                                     "changes": getChangeStatistics(self.written, self.suppressed) }
+
+    def setSuntimes(self, dt):
+        theUnit = self.sharedDict["Unit"]
+        self.sharedDict["Suntimes"] = suntimesCache.getSuntimes(theUnit["location"]["longitude"], theUnit["location"]["latitude"], dt)
+        if self.forecast:
+            self.sharedDict["Forecast"] = self.forecast.getForecast(theUnit, dt)
+
+    def publishStatistics(self):
+        theStatistics = { inverter: statistics.toDict() for inverter, statistics in self.statistics.items() }
+        theStatistics["Plant"] = self.plantStatistics.toDict()
+        self.sharedDict["Statistics"] = theStatistics
+        self.statisticsPublished = self.latestCycle
+
+    def readRow(self, inverter, row):
+        sequence, values = self.liveTable.read(row)
+        # Rows not written yet must not overwrite the values loaded from the config file.
+        if values is None or sequence == 0 or self.sequences.get(inverter) == sequence:
+            return
+        self.sequences[inverter] = sequence
+
+        # Unchanged nodes aren't rewritten.
+        nodeValues = values[:len(LIVE_FIELDS)]
+        if nodeValues != self.nodeValues.get(inverter):
+            rowToNode(nodeValues, self.sharedDict[inverter])
+            self.nodeValues[inverter] = nodeValues
+
+        cycleTime, cycleOutput, cycleDayYield = values[len(LIVE_FIELDS):]
+        cycleOutput = int(cycleOutput)
+        cycleDayYield = int(cycleDayYield)
+        if cycleTime <= self.cycleTimes.get(inverter, 0):
+            return
+        self.cycleTimes[inverter] = cycleTime
+        self.latestCycle = max(self.latestCycle, cycleTime)
+
+        # Like the workers' change filters, each sample is counted as written, if it bumped the node's version.
+        version = self.sharedDict[inverter].version
+        if version != self.versions[inverter]:
+            self.written += 1
+        else:
+            self.suppressed += 1
+        self.versions[inverter] = version
+
+        self.statistics[inverter].update(cycleOutput, cycleTime)
+        self.cycles.setdefault(cycleTime, dict())[inverter] = (cycleOutput, cycleDayYield)
+
+    def invoke(self):
+        stale = set(self.shardedAcquisition.supervise(self.sharedDict))
+        for inverter, row in self.rows.items():
+            # The values of a dead worker's inverters are not current anymore.
+            if inverter in stale:
+                thisState = self.sharedDict[inverter]
+                thisState.currentOutput = 0
+                thisState.currentState = SunnyBoyConstants.STATE_AS_STRING[SunnyBoyConstants.STATE_UNKNOWN]
+                continue
+            self.readRow(inverter, row)
+
+        today = datetime.now(self.localTimeZone)
+        thePlant = self.sharedDict["Plant"]
+
+        # The statistics of the day are reset together with the peak values.
+        if today.weekday() != self.today.weekday():
+            self.setSuntimes(today)
+            thePlant["maxPeakOutputDay"] = 0
+            thePlant["maxPeakTime"] = "--:--"
+            for statistics in list(self.statistics.values()) + [self.plantStatistics]:
+                statistics.reset()
+            self.publishStatistics()
+            self.today = today
+
+        # The workers publish their rows one after the other, so a cycle is evaluated once all inverters or
+        # a later cycle arrived. Inverters missing by then didn't answer in time.
+        for cycleTime in sorted(self.cycles):
+            samples = self.cycles[cycleTime]
+            if len(samples) < len(self.rows) and cycleTime == self.latestCycle:
+                break
+            del self.cycles[cycleTime]
+            self.evaluateCycle(cycleTime, samples)
+
+        thePlant["changes"] = getChangeStatistics(self.written, self.suppressed)
+        if self.latestCycle - self.statisticsPublished >= SamplePlant.STATISTICS_INTERVAL:
+            self.publishStatistics()
+
+    def evaluateCycle(self, cycleTime, samples):
+        sampleTime = datetime.fromtimestamp(cycleTime, self.localTimeZone)
+
+        if self.anomalyDetector:
+            keys = self.anomalyDetector.keys
+            updateAnomalies(self.anomalyDetector, self.sharedDict, cycleTime, [samples.get(key, (0, 0))[0] for key in keys],
+                            [key in samples for key in keys], sampleTime)
+
+        # The plant's values are only taken from complete cycles.
+        thePlant = self.sharedDict["Plant"]
+        if len(samples) < len(self.rows) or cycleTime <= thePlant["timestamp"]:
+            return
+
+        thePlant["timestamp"] = cycleTime
+        thePlant["currentOutput"] = sum(output for output, dayYield in samples.values())
+        thePlant["dayYield"] = sum(dayYield for output, dayYield in samples.values())
+        self.plantStatistics.update(thePlant["currentOutput"], cycleTime)
+
+        if thePlant["currentOutput"] > thePlant["maxPeakOutputDay"]:
+            thePlant["maxPeakOutputDay"] = thePlant["currentOutput"]
+            thePlant["maxPeakTime"] = sampleTime.strftime("%H:%M")
+
+        if self.analytics:
+            self.analytics.onCompleteCycle()
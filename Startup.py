@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Helpers for a fast start on small devices: timing the phases of the start.
+#
+#  Imported first by mbpv.py, so the time of the imports is part of the report.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import logging
+import time
+
+STARTED = time.perf_counter()
+
+class StartupTimer():
+    def __init__(self):
+        self.phases = list()
+        self.last = STARTED
+
+    def mark(self, phase):
+        # Ends 'phase', which started with the previous mark or the import of this module.
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def getTotal(self):
+        return self.last - STARTED
+
+    def report(self):
+        logging.info("Startup took {:.0f} ms: {}".format(self.getTotal() * 1000, ", ".join("{} {:.0f} ms".format(phase, duration * 1000) for phase, duration in self.phases)))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Crash-safe persistence of the runtime counters of a plant (e.g. last year's total yield and the day's peaks).
+#
+#  Every minute, the counters that changed since the last checkpoint are appended as small deltas to a journal
+#  (one JSON object per line) and synced to disk with a single fsync, outside of the access lock. When the journal grows too large, all
+#  counters are compacted into a state file, which is replaced atomically, and the journal is truncated.
+#  On restart the state file is loaded and the journal is replayed on top of it. A torn last line is ignored.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import copy
+import logging
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from raspend import ThreadHandlerBase
+from InverterState import InverterState
+
+def replaceFile(fileName, text):
+    # Writes 'text' to a temporary file first, so 'fileName' holds either the old or the new content after a crash.
+    tmpFileName = fileName + ".tmp"
+    with open(tmpFileName, "w") as tmpFile:
+        tmpFile.write(text)
+        tmpFile.flush()
+        os.fsync(tmpFile.fileno())
+    os.replace(tmpFileName, fileName)
+
+    # Make the rename itself durable. Not possible on Windows.
+    if os.name != "nt":
+        directory = os.open(os.path.dirname(os.path.abspath(fileName)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+class StateJournal(ThreadHandlerBase):
+    # Seconds between two checkpoints.
+    CHECKPOINT_INTERVAL = 60
+    # The journal is compacted into the state file, once it's larger than this.
+    MAX_JOURNAL_SIZE = 64 * 1024
+
+    INVERTER_FIELDS = ("totalYieldLastYear", "totalYieldCurrYear", "maxPeakOutputDay", "maxPeakTime")
+    PLANT_FIELDS = ("maxPeakOutputDay", "maxPeakTime")
+
+    def __init__(self, configFileName, localTimeZone):
+        root = os.path.splitext(configFileName)[0]
+        self.stateFileName = root + ".state"
+        self.journalFileName = root + ".journal"
+        self.localTimeZone = localTimeZone
+        self.sequence = 0
+        # The counters as stored in state file and journal, e.g. { "sunnyboy1": { "day": "2019-12-02", ... } }
+        self.persisted = dict()
+        self.journal = None
+        # Checkpoints are collected while holding the access lock, but written and synced by a thread of their own,
+        # which keeps its own copy of the counters for compacting.
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mbpv-journal")
+        self.written = dict()
+        self.writtenSequence = 0
+
+    def getDay(self):
+        return datetime.now(self.localTimeZone).strftime("%Y-%m-%d")
+
+    def collect(self):
+        day = self.getDay()
+        counters = dict()
+        for inverter in self.sharedDict["Inverters"]:
+            thisState = self.sharedDict[inverter]
+            counters[inverter] = { field: getattr(thisState, field) for field in self.INVERTER_FIELDS }
+            counters[inverter]["day"] = day
+        if "Plant" in self.sharedDict:
+            counters["Plant"] = { field: self.sharedDict["Plant"][field] for field in self.PLANT_FIELDS }
+            counters["Plant"]["day"] = day
+        return counters
+
+    def load(self):
+        if os.path.isfile(self.stateFileName):
+            try:
+                with open(self.stateFileName) as stateFile:
+                    state = json.load(stateFile)
+                self.sequence = state["sequence"]
+                self.persisted = state["counters"]
+            except Exception as e:
+                logging.error("Reading {} failed! Error: {}".format(self.stateFileName, e))
+
+        if not os.path.isfile(self.journalFileName):
+            return
+
+        replayed = 0
+        with open(self.journalFileName) as journalFile:
+            for line in journalFile:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Only the last line can be torn by a crash.
+                    logging.info("Ignoring the incomplete end of {}.".format(self.journalFileName))
+                    break
+                # Entries already compacted into the state file.
+                if entry["sequence"] <= self.sequence:
+                    continue
+                self.persisted.setdefault(entry["key"], dict()).update(entry["values"])
+                self.sequence = entry["sequence"]
+                replayed += 1
+        logging.info("Replayed {} entries of {}.".format(replayed, self.journalFileName))
+
+    def recover(self):
+        # Restores the counters into the plant's shared dictionary. Must be called before the handlers are prepared.
+        self.load()
+
+        today = self.getDay()
+        for key, counters in self.persisted.items():
+            sameDay = counters.get("day") == today
+            if key == "Plant":
+                if sameDay:
+                    self.sharedDict["Plant"] = { field: counters[field] for field in self.PLANT_FIELDS }
+                continue
+            thisState = self.sharedDict.get(key)
+            if not isinstance(thisState, InverterState):
+                continue
+            thisState.totalYieldLastYear = counters.get("totalYieldLastYear", thisState.totalYieldLastYear)
+            thisState.totalYieldCurrYear = counters.get("totalYieldCurrYear", 0)
+            # The year changed while we were down.
+            if counters.get("day", today)[0:4] < today[0:4]:
+                thisState.totalYieldLastYear += thisState.totalYieldCurrYear
+                thisState.totalYieldCurrYear = 0
+            # The peaks of another day are outdated.
+            if sameDay:
+                thisState.maxPeakOutputDay = counters["maxPeakOutputDay"]
+                thisState.maxPeakTime = counters["maxPeakTime"]
+            else:
+                thisState.maxPeakOutputDay = 0
+                thisState.maxPeakTime = "--:--"
+
+        self.written = copy.deepcopy(self.persisted)
+        self.writtenSequence = self.sequence
+        self.compact()
+
+    def checkpoint(self):
+        # Collects the counters changed since the last checkpoint and leaves writing them to the writer thread.
+        entries = list()
+        for key, counters in self.collect().items():
+            persisted = self.persisted.get(key, dict())
+            values = { field: value for field, value in counters.items() if persisted.get(field) != value }
+            if len(values) == 0:
+                continue
+            self.sequence += 1
+            entries.append({ "sequence": self.sequence, "key": key, "values": values })
+            persisted.update(values)
+            self.persisted[key] = persisted
+
+        if len(entries):
+            self.writer.submit(self.write, entries)
+
+    def write(self, entries):
+        for entry in entries:
+            self.written.setdefault(entry["key"], dict()).update(entry["values"])
+            self.writtenSequence = entry["sequence"]
+
+        try:
+            if self.journal is None:
+                self.journal = open(self.journalFileName, "a")
+            # All entries of a checkpoint share a single fsync.
+            self.journal.write("\n".join(json.dumps(entry) for entry in entries) + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        except Exception as e:
+            logging.error("Writing {} failed! Error: {}".format(self.journalFileName, e))
+            return
+
+        if self.journal.tell() > self.MAX_JOURNAL_SIZE:
+            self.compact()
+
+    def compact(self):
+        try:
+            replaceFile(self.stateFileName, json.dumps({ "sequence": self.writtenSequence, "counters": self.written }, indent=2))
+        except Exception as e:
+            logging.error("Writing {} failed! Error: {}".format(self.stateFileName, e))
+            return
+
+        # Entries left over by a crash right here are skipped on replay by their sequence number.
+        if self.journal:
+            self.journal.close()
+        self.journal = open(self.journalFileName, "w")
+
+    def close(self):
+        self.checkpoint()
+        self.writer.shutdown()
+        self.compact()
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def prepare(self):
+        pass
+
+    def invoke(self):
+        self.checkpoint()
+        return
@@ -15,7 +15,6 @@
 import time
 from datetime import datetime, timedelta, timezone
 from math import sin, acos, cos, pi, radians, degrees, atan2, asin, tan, ceil, floor, sqrt, fabs, nan, isnan
-import argparse
 
 # Sun coordinates
 class c_SunCoor:
@@ -728,6 +727,8 @@ class SunMoon:
     def ComputeSunRiseSet(self):
 		# return sunrise or sunset time as unix timestamp (seconds since epoch)
 		# depending on given command line argument
+        # argparse is only imported here, so importing this module stays cheap.
+        import argparse
         parser = argparse.ArgumentParser(description='Calculate Sunrise or Sunset times')
         group = parser.add_mutually_exclusive_group()
         group.add_argument("-R", "--sunrise", help="return sunrise", action="store_true")
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Generic driver for SunSpec compliant inverters (https://sunspec.org).
+#
+#  The chain of SunSpec models is walked once at connect time and the offsets of the models are kept in the
+#  device cache, so later starts skip the walk. A poll reads all needed registers of the inverter model
+#  (101, 102 or 103) with a single block read, which also checks that the cached offsets are still valid.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import logging
+import time
+from datetime import datetime
+
+from ModbusGateway import ModbusGatewayClient, connectionPool
+from SMA_Inverters import SunnyBoyConstants
+from Drivers import registerDriver, buildReadPlan, sliceRegisters
+
+# "SunS"
+SUNSPEC_MARKER = [0x5375, 0x6E53]
+SUNSPEC_BASE_ADDRESSES = (40000, 0, 50000)
+SUNSPEC_END = 0xFFFF
+# Protects against devices with a broken model chain.
+MAX_MODELS = 64
+
+MODEL_COMMON = 1
+MODEL_NAMEPLATE = 120
+# Three phase, split phase and single phase inverters share the same layout.
+INVERTER_MODELS = (103, 102, 101)
+
+# Marks values a device doesn't implement.
+NOT_IMPLEMENTED_INT16 = 0x8000
+
+# Offsets within a model, counted from its header (model id and length).
+class SunSpecOffsets():
+    ID = 0
+    COMMON_MANUFACTURER = (2, 16)
+    COMMON_MODEL = (18, 16)
+    COMMON_SERIAL_NUMBER = (50, 16)
+    NAMEPLATE_W_RTG = 3
+    NAMEPLATE_W_RTG_SF = 4
+    INVERTER_W = 14
+    INVERTER_W_SF = 15
+    INVERTER_WH = 24
+    INVERTER_WH_SF = 26
+    INVERTER_TMP_CAB = 33
+    INVERTER_TMP_SF = 37
+    INVERTER_ST = 38
+    # Number of registers read per poll, from the header up to the operating state.
+    INVERTER_POLL_SIZE = 39
+
+# Operating states of the inverter models mapped to the states served by mbpv.
+STATE_AS_SMA_STATE = { 1: SunnyBoyConstants.STATE_OFF,      # off
+                       2: SunnyBoyConstants.STATE_OFF,      # sleeping
+                       3: SunnyBoyConstants.STATE_OK,       # starting
+                       4: SunnyBoyConstants.STATE_OK,       # MPPT
+                       5: SunnyBoyConstants.STATE_OK,       # throttled
+                       6: SunnyBoyConstants.STATE_OFF,      # shutting down
+                       7: SunnyBoyConstants.STATE_ERROR,    # fault
+                       8: SunnyBoyConstants.STATE_OFF }     # standby
+
+def toSigned(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+def scaleValue(value, scaleFactor):
+    # Values and scale factors are signed 16 bit registers.
+    if value == NOT_IMPLEMENTED_INT16 or scaleFactor == NOT_IMPLEMENTED_INT16:
+        return 0
+    return toSigned(value) * 10 ** toSigned(scaleFactor)
+
+def decodeString(registers):
+    data = b"".join(register.to_bytes(2, "big") for register in registers)
+    return data.split(b"\x00")[0].decode("ascii", "replace").strip()
+
+class SunSpecInverter():
+    # Without a successfully walked model chain, the walk is retried after this many seconds.
+    DISCOVERY_RETRY = 60
+
+    def __init__(self, ipOrHostName, portNumber, unitId=None, mbClient=None, deviceCache=None, clock=None):
+        self.host = ipOrHostName
+        self.port = portNumber
+        self.deviceCache = deviceCache
+        # The day yield is counted per day of this clock.
+        self.clock = clock if clock is not None else datetime.now
+        self.identity = None
+        self.capture = None
+        self.captureId = None
+
+        if mbClient is not None:
+            unitId = mbClient.unit_id
+        # There's no common register for discovering the unit id of a SunSpec device.
+        if unitId is None:
+            unitId = 1
+        self.unitId = unitId
+
+        if mbClient is None:
+            mbClient = ModbusGatewayClient(connectionPool.get(ipOrHostName, portNumber), unitId)
+        self.mbClient = mbClient
+        self.mbClient.open()
+
+        # Model id -> (address, length)
+        self.models = None
+        self.inverterModel = None
+        self.blocks = list()
+        self.lastDiscovery = None
+
+        self.dayYield = 0
+        self.totalYield = 0
+        self.currentOutput = 0
+        self.internalTemperature = 0
+        self.currentState = SunnyBoyConstants.STATE_UNKNOWN
+        # The inverter models have no day yield, so we count it from the total yield at the start of the day.
+        self.day = None
+        self.dayStartYield = None
+
+        entry = deviceCache.lookup(ipOrHostName, portNumber, unitId) if deviceCache else None
+        if entry and "sunspecModels" in entry:
+            self.identity = entry
+            self.setModels({ int(modelId): tuple(model) for modelId, model in entry["sunspecModels"].items() })
+            if entry.get("dayStart", [None])[0] == self.clock().strftime("%Y-%m-%d"):
+                self.day, self.dayStartYield = entry["dayStart"]
+        else:
+            self.discover()
+
+    def walkModels(self):
+        # Returns the models of the device or None, if it isn't a SunSpec device or didn't answer.
+        for baseAddress in SUNSPEC_BASE_ADDRESSES:
+            if self.mbClient.read_holding_registers(baseAddress, 2) == SUNSPEC_MARKER:
+                break
+        else:
+            return None
+
+        models = dict()
+        address = baseAddress + 2
+        for i in range(MAX_MODELS):
+            header = self.mbClient.read_holding_registers(address, 2)
+            if header is None:
+                return None
+            modelId, length = header
+            if modelId == SUNSPEC_END:
+                break
+            models[modelId] = (address, length)
+            address += 2 + length
+        return models
+
+    def readIdentity(self, models):
+        identity = { "unitId": self.unitId, "model": "SunSpec device", "serialNumber": "", "maxOutput": 0 }
+
+        # Both reads are pipelined.
+        requestCommon = None
+        requestNameplate = None
+        if MODEL_COMMON in models:
+            address, length = models[MODEL_COMMON]
+            requestCommon = self.mbClient.requestHoldingRegisters(address, SunSpecOffsets.COMMON_SERIAL_NUMBER[0] + SunSpecOffsets.COMMON_SERIAL_NUMBER[1])
+        if MODEL_NAMEPLATE in models:
+            address, length = models[MODEL_NAMEPLATE]
+            requestNameplate = self.mbClient.requestHoldingRegisters(address, SunSpecOffsets.NAMEPLATE_W_RTG_SF + 1)
+
+        common = requestCommon.wait(self.mbClient.timeout) if requestCommon else None
+        if common:
+            manufacturer = decodeString(common[SunSpecOffsets.COMMON_MANUFACTURER[0]:sum(SunSpecOffsets.COMMON_MANUFACTURER)])
+            model = decodeString(common[SunSpecOffsets.COMMON_MODEL[0]:sum(SunSpecOffsets.COMMON_MODEL)])
+            identity["model"] = "{} {}".format(manufacturer, model).strip()
+            identity["serialNumber"] = decodeString(common[SunSpecOffsets.COMMON_SERIAL_NUMBER[0]:sum(SunSpecOffsets.COMMON_SERIAL_NUMBER)])
+
+        nameplate = requestNameplate.wait(self.mbClient.timeout) if requestNameplate else None
+        if nameplate:
+            identity["maxOutput"] = round(scaleValue(nameplate[SunSpecOffsets.NAMEPLATE_W_RTG], nameplate[SunSpecOffsets.NAMEPLATE_W_RTG_SF]))
+
+        return identity
+
+    def discover(self):
+        self.lastDiscovery = time.monotonic()
+        if not self.mbClient.is_open() and not self.mbClient.open():
+            return False
+
+        models = self.walkModels()
+        if models is None:
+            logging.error("No SunSpec models found at {}:{} (unit id {})!".format(self.host, self.port, self.unitId))
+            return False
+
+        self.identity = self.readIdentity(models)
+        self.identity["sunspecModels"] = { str(modelId): list(model) for modelId, model in models.items() }
+        self.setModels(models)
+        self.saveIdentity()
+        logging.info("SunSpec device at {}:{} (unit id {}) has the models {}.".format(self.host, self.port, self.unitId, sorted(models)))
+        return True
+
+    def saveIdentity(self):
+        if self.deviceCache and self.identity:
+            self.identity["dayStart"] = [self.day, self.dayStartYield]
+            self.deviceCache.update(self.host, self.port, self.identity, self.unitId)
+
+    def setModels(self, models):
+        self.models = models
+        self.inverterModel = None
+        self.blocks = list()
+        for modelId in INVERTER_MODELS:
+            if modelId in models:
+                self.inverterModel = modelId
+                address, length = models[modelId]
+                self.blocks = buildReadPlan([(address, SunSpecOffsets.INVERTER_POLL_SIZE)])
+                break
+        if self.inverterModel is None:
+            logging.error("SunSpec device at {}:{} (unit id {}) has no inverter model!".format(self.host, self.port, self.unitId))
+
+    def setCapture(self, capture, name):
+        # Records every raw response to 'capture' (see 'Capture.CaptureWriter').
+        self.capture = capture
+        self.captureId = capture.register(name)
+
+    def requestCurrentValues(self):
+        # Sends the block reads of the read plan without waiting for the responses.
+        # Returns the pending requests for 'completeCurrentValues' or None, if the inverter isn't reachable.
+        if self.inverterModel is None:
+            if self.lastDiscovery is not None and time.monotonic() - self.lastDiscovery < self.DISCOVERY_RETRY:
+                return None
+            if not self.discover() or self.inverterModel is None:
+                return None
+
+        if not self.mbClient.is_open() and not self.mbClient.open():
+            print ("Unable to connect to {}:{}".format(self.mbClient.host, self.mbClient.port))
+            return None
+
+        return [self.mbClient.requestHoldingRegisters(address, count) for address, count in self.blocks]
+
+    def completeCurrentValues(self, requests, timeout=None):
+        # Waits for the responses of 'requestCurrentValues'. Returns False, if not all of them arrived in time.
+        if requests is None:
+            return False
+
+        if timeout is None:
+            timeout = self.mbClient.timeout
+
+        deadline = time.monotonic() + timeout
+        regVals = [request.wait(max(0.0, deadline - time.monotonic())) for request in requests]
+
+        if self.capture:
+            self.capture.record(self.captureId, requests, regVals)
+
+        if None in regVals:
+            return False
+
+        address, length = self.models[self.inverterModel]
+        registers = sliceRegisters(self.blocks, regVals, address, SunSpecOffsets.INVERTER_POLL_SIZE)
+
+        # The device's models moved (e.g. after a firmware update), so the chain is walked again with the next poll.
+        if registers[SunSpecOffsets.ID] != self.inverterModel:
+            logging.info("SunSpec models of {}:{} (unit id {}) changed.".format(self.host, self.port, self.unitId))
+            self.inverterModel = None
+            self.lastDiscovery = None
+            return False
+
+        self.currentOutput = max(0, round(scaleValue(registers[SunSpecOffsets.INVERTER_W], registers[SunSpecOffsets.INVERTER_W_SF])))
+        totalYield = (registers[SunSpecOffsets.INVERTER_WH] << 16) | registers[SunSpecOffsets.INVERTER_WH + 1]
+        self.totalYield = round(totalYield * 10 ** toSigned(registers[SunSpecOffsets.INVERTER_WH_SF]))
+        self.internalTemperature = scaleValue(registers[SunSpecOffsets.INVERTER_TMP_CAB], registers[SunSpecOffsets.INVERTER_TMP_SF])
+        self.currentState = STATE_AS_SMA_STATE.get(registers[SunSpecOffsets.INVERTER_ST], SunnyBoyConstants.STATE_UNKNOWN)
+
+        today = self.clock().strftime("%Y-%m-%d")
+        if self.day != today or self.dayStartYield is None or self.totalYield < self.dayStartYield:
+            self.day = today
+            self.dayStartYield = self.totalYield
+            # Survives a restart during the day.
+            self.saveIdentity()
+        self.dayYield = self.totalYield - self.dayStartYield
+
+        return True
+
+    def readCurrentValues(self):
+        return self.completeCurrentValues(self.requestCurrentValues())
+
+registerDriver("sunspec", SunSpecInverter)
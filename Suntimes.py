@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Cache for sunrise, transit and sunset times, shared by all inverters and plants of an mbpv instance.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import threading
+from datetime import timedelta
+
+from SunMoon import SunMoon
+
+class SuntimesCache():
+    # Days kept before and after the most recently requested day.
+    KEEP_DAYS = 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.suns = dict()
+        self.days = dict()
+
+    def getSunRiseSet(self, longitude, latitude, dt):
+        location = (longitude, latitude)
+        key = (longitude, latitude, dt.year, dt.month, dt.day)
+        with self.lock:
+            if key not in self.days:
+                if location not in self.suns:
+                    self.suns[location] = SunMoon(longitude, latitude, dt)
+                self.days[key] = self.suns[location].GetSunRiseSet(dt)
+            return self.days[key]
+
+    def getSuntimes(self, longitude, latitude, dt):
+        # Returns the node 'Suntimes' for the given location and day.
+        suntimes = { "today": self.getSunRiseSet(longitude, latitude, dt),
+                     "yesterday": self.getSunRiseSet(longitude, latitude, dt - timedelta(1)),
+                     "tomorrow": self.getSunRiseSet(longitude, latitude, dt + timedelta(1)) }
+        self.prune(dt)
+        return suntimes
+
+    def prune(self, dt):
+        first = dt - timedelta(self.KEEP_DAYS)
+        last = dt + timedelta(self.KEEP_DAYS)
+        first = (first.year, first.month, first.day)
+        last = (last.year, last.month, last.day)
+        with self.lock:
+            for key in [key for key in self.days if not first <= key[2:] <= last]:
+                del(self.days[key])
+
+# Plants at the same location share their calculations.
+suntimesCache = SuntimesCache()
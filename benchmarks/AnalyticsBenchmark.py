@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Compares the recompute of the yearly and monthly report from the stored dailies, vectorized and as a plain loop.
+#
+#  $ python3 benchmarks/AnalyticsBenchmark.py --years=20 --rounds=10
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import argparse
+import os
+import sys
+import time
+from datetime import date
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from Analytics import Analytics, DAILY_RECORD
+
+def createAnalytics():
+    analytics = Analytics("benchmark.json")
+    analytics.kWp = 6.27
+    analytics.annualYield = 925 * analytics.kWp
+    analytics.latitude = 50.7753455
+    analytics.monthlyShares = None
+    return analytics
+
+def computeLoop(analytics, dailies):
+    years = dict()
+    months = dict()
+    for dayNumber, dayYield in dailies.tolist():
+        day = date.fromordinal(dayNumber)
+        for sums in (years.setdefault(str(day.year), [0.0, 0.0, 0]), months.setdefault(day.strftime("%Y-%m"), [0.0, 0.0, 0])):
+            sums[0] += dayYield / 1000
+            sums[1] += analytics.getExpectedYield(day)
+            sums[2] += 1
+    return years, months
+
+def main():
+    cmdLineParser = argparse.ArgumentParser(prog="AnalyticsBenchmark", usage="%(prog)s [options]")
+    cmdLineParser.add_argument("--years", help="Number of years of dailies (default: 20)", type=int, default=20, required=False)
+    cmdLineParser.add_argument("--rounds", help="Number of recomputes (default: 10)", type=int, default=10, required=False)
+    args = cmdLineParser.parse_args()
+
+    first = date(2000, 1, 1).toordinal()
+    dailies = np.zeros(date(2000 + args.years, 1, 1).toordinal() - first, dtype=DAILY_RECORD)
+    dailies["day"] = np.arange(first, first + len(dailies))
+    dailies["yield"] = np.random.default_rng(1).uniform(0, 40000, len(dailies))
+
+    # The shares of each year are cached by both variants, so they're computed up front.
+    analytics = createAnalytics()
+    computeLoop(analytics, dailies)
+
+    startTime = time.perf_counter()
+    for _ in range(args.rounds):
+        years, months = computeLoop(analytics, dailies)
+    loopTime = (time.perf_counter() - startTime) / args.rounds
+
+    startTime = time.perf_counter()
+    for _ in range(args.rounds):
+        analytics.computeReport(dailies)
+    vectorizedTime = (time.perf_counter() - startTime) / args.rounds
+
+    matches = all(np.allclose(analytics.years[year], years[year]) for year in years)
+
+    print("{} years, {} dailies, results match: {}".format(args.years, len(dailies), matches))
+    print("{:<15}{:>18}".format("variant", "ms per report"))
+    print("{:<15}{:>18.2f}".format("loop", loopTime * 1000))
+    print("{:<15}{:>18.2f}".format("vectorized", vectorizedTime * 1000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Measures the cost of the cross inverter anomaly detection per sampling cycle for growing numbers of inverters,
+#  i.e. the comparison of all outputs and the update of the inverter nodes, and checks a simulated fault is flagged.
+#
+#  $ python3 benchmarks/AnomalyBenchmark.py --inverters=10,100,1000 --cycles=2000
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+
+from Anomalies import AnomalyDetector
+from InverterState import InverterState
+
+def runCycles(count, cycles, interval):
+    # Returns the seconds per cycle and the cycle, at which the inverter failing at the middle was flagged.
+    keys = ["inverter{}".format(number) for number in range(count)]
+    states = [InverterState({ "host": "127.0.0.1", "port": 502, "maxOutput": 3000 }) for key in keys]
+    detector = AnomalyDetector(None, interval)
+    detector.setInverters(keys, [3000] * count)
+
+    rng = np.random.default_rng(1)
+    shares = rng.uniform(0.8, 1.1, count)
+    failing = count // 2
+    flaggedAt = None
+
+    total = 0.0
+    for cycle in range(cycles):
+        level = 0.5 + 0.3 * np.sin(cycle / 500)
+        outputs = (3000 * level * shares * (1 + 0.02 * rng.standard_normal(count))).tolist()
+        if cycle >= cycles // 2:
+            outputs[failing] *= 0.5
+        valid = [True] * count
+
+        startTime = time.perf_counter()
+        changed = detector.update(cycle * interval, outputs, valid)
+        for state, anomaly in zip(states, detector.getAnomalies()):
+            state.anomaly = anomaly
+        total += time.perf_counter() - startTime
+
+        if failing in changed and flaggedAt is None:
+            flaggedAt = cycle
+    return total / cycles, flaggedAt
+
+def main():
+    cmdLineParser = argparse.ArgumentParser(prog="AnomalyBenchmark", usage="%(prog)s [options]")
+    cmdLineParser.add_argument("--inverters", help="Comma separated numbers of inverters (default: 10,100,1000)", type=str, default="10,100,1000", required=False)
+    cmdLineParser.add_argument("--cycles", help="Number of sampling cycles (default: 2000)", type=int, default=2000, required=False)
+    cmdLineParser.add_argument("--interval", help="Sampling interval in seconds (default: 10)", type=float, default=10, required=False)
+    args = cmdLineParser.parse_args()
+
+    for count in [int(count) for count in args.inverters.split(",")]:
+        perCycle, flaggedAt = runCycles(count, args.cycles, args.interval)
+        print("{:6} inverters: {:8.3f} ms per cycle, {:6.2f} us per inverter, fault at cycle {} flagged at cycle {}".format(
+              count, perCycle * 1e3, perCycle * 1e6 / count, args.cycles // 2, flaggedAt))
+
+if __name__ == "__main__":
+    main()
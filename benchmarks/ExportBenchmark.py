@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Measures the columnar export of the history against reading the same rows with 'History.query' (which answers
+#  '/history'), for a synthetic history of minute segments. The peak memory of the export should not grow with the
+#  number of days.
+#
+#  $ python3 benchmarks/ExportBenchmark.py --inverters=20 --days=7,31
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+from tzlocal import get_localzone
+
+from Export import RECORD_DTYPE, exportHistory
+from History import History, HISTORY_FIELDS, RESOLUTION_MINUTE
+
+def createHistory(directory, names, start, days, localTimeZone):
+    # Writes minute segments with random values, as 'History' would after 'days' days of sampling.
+    history = History(directory, localTimeZone)
+    rng = np.random.default_rng(1)
+    for day in range(days):
+        starts = np.arange(start + day * 86400, start + (day + 1) * 86400, RESOLUTION_MINUTE)
+        for name in names:
+            records = np.zeros(len(starts), RECORD_DTYPE)
+            records["start"] = starts
+            records["count"] = 60
+            records["values"] = rng.uniform(0, 3000, (len(starts), len(HISTORY_FIELDS), 1))
+            # Periods follow the local days, so a UTC day may span two of them.
+            periods = np.array([history.getPeriod(RESOLUTION_MINUTE, recordStart) for recordStart in starts[::60]]).repeat(60)
+            for period in np.unique(periods):
+                fileName = history.getSegmentFileName(RESOLUTION_MINUTE, period, name)
+                os.makedirs(os.path.dirname(fileName), exist_ok=True)
+                with open(fileName, "ab") as segmentFile:
+                    segmentFile.write(records[periods == period].tobytes())
+    return history
+
+def measure(function):
+    tracemalloc.start()
+    startTime = time.perf_counter()
+    result = function()
+    duration = time.perf_counter() - startTime
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, duration, peak
+
+def main():
+    cmdLineParser = argparse.ArgumentParser(prog="ExportBenchmark", usage="%(prog)s [options]")
+    cmdLineParser.add_argument("--inverters", help="Number of inverters (default: 20)", type=int, default=20, required=False)
+    cmdLineParser.add_argument("--days", help="Comma separated numbers of days of minute segments (default: 7,31)", type=str, default="7,31", required=False)
+    args = cmdLineParser.parse_args()
+
+    localTimeZone = get_localzone()
+    names = ["inverter{}".format(number) for number in range(args.inverters)]
+    for days in [int(days) for days in args.days.split(",")]:
+        directory = tempfile.mkdtemp()
+        try:
+            now = int(time.time()) // 86400 * 86400
+            start = now - days * 86400
+            history = createHistory(os.path.join(directory, "history"), names, start, days, localTimeZone)
+
+            metadata, exportDuration, exportPeak = measure(lambda: exportHistory(history, os.path.join(directory, "export"), start, now, names,
+                                                                               HISTORY_FIELDS, "avg", RESOLUTION_MINUTE, now))
+            rows, queryDuration, queryPeak = measure(lambda: sum(1 for row in history.query(start, now, names, HISTORY_FIELDS, "avg", RESOLUTION_MINUTE, now)))
+
+            print("{:4} days, {:9} rows: export {:7.2f} s ({:8.0f} rows/s, peak {:6.1f} MB), query {:7.2f} s ({:8.0f} rows/s, peak {:6.1f} MB)".format(
+                  days, metadata["rows"], exportDuration, metadata["rows"] / exportDuration, exportPeak / 1e6,
+                  queryDuration, rows / queryDuration, queryPeak / 1e6))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Load test of the HTTP servers: many concurrent clients polling '/data' while a simulated acquisition updates the
+#  inverters holding the access lock. The server runs in a process of its own. Each client keeps its connection
+#  alive if the server does, i.e. the asynchronous front end, and reconnects otherwise, i.e. raspend's server.
+#  Reports the throughput and the latency percentiles as seen by the clients.
+#
+#  $ python3 benchmarks/HttpLoadBenchmark.py --clients=1000 --duration=10 --servers=async,threaded
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+
+from AsyncHttpServer import AsyncHTTPServerThread
+from HttpServer import MbpvHTTPServerThread
+from InverterState import InverterState
+
+def createSharedDict(count):
+    inverters = { "inverter{}".format(number): InverterState({ "host": "127.0.0.1", "port": 502, "maxOutput": 3000 }) for number in range(count) }
+    return { "Inverters": inverters, "Plant": { "currentOutput": 0, "dayYield": 0 } }
+
+def runServer(server, port, count, interval, rateLimit, ready, stop):
+    # raspend's server logs each request to stderr.
+    sys.stderr = open(os.devnull, "w")
+    dataLock = threading.Lock()
+    shutdownFlag = threading.Event()
+    sharedDict = createSharedDict(count)
+    if server == "async":
+        httpd = AsyncHTTPServerThread(shutdownFlag, dataLock, sharedDict, None, port, None, rateLimit, min(AsyncHTTPServerThread.CACHE_SECONDS, interval / 2))
+    else:
+        httpd = MbpvHTTPServerThread(shutdownFlag, dataLock, sharedDict, None, port)
+    httpd.daemon = True
+    httpd.start()
+    ready.set()
+
+    # The acquisition updates all inverters once per interval, holding the lock like 'SamplePlant.invoke'.
+    cycle = 0
+    while not stop.wait(interval):
+        cycle += 1
+        with dataLock:
+            for number, state in enumerate(sharedDict["Inverters"].values()):
+                state.currentOutput = (cycle * 7 + number) % 3000
+                state.sampleCycle = cycle
+            sharedDict["Plant"]["currentOutput"] = sum(state.currentOutput for state in sharedDict["Inverters"].values())
+    shutdownFlag.set()
+    httpd.join(2)
+
+async def readResponse(reader):
+    # Returns the status, the body and whether the server keeps the connection alive.
+    statusLine = await reader.readline()
+    if not statusLine:
+        raise ConnectionError("Connection closed")
+    status = int(statusLine.split()[1])
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, separator, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+        return status, body, headers.get("connection", "").lower() != "close" and statusLine.startswith(b"HTTP/1.1")
+    return status, await reader.read(), False
+
+async def runClient(port, path, deadline, results):
+    connection = None
+    while time.perf_counter() < deadline:
+        startTime = time.perf_counter()
+        try:
+            if connection is None:
+                connection = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), 10)
+            reader, writer = connection
+            writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(path).encode("ascii"))
+            status, body, keepAlive = await asyncio.wait_for(readResponse(reader), 10)
+            results["latencies"].append(time.perf_counter() - startTime)
+            results["statuses"][status] = results["statuses"].get(status, 0) + 1
+            if not keepAlive:
+                writer.close()
+                connection = None
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError):
+            results["errors"] += 1
+            if connection is not None:
+                connection[1].close()
+                connection = None
+            await asyncio.sleep(0.1)
+    if connection is not None:
+        connection[1].close()
+
+async def runClients(port, clients, duration, path):
+    results = { "latencies": list(), "statuses": dict(), "errors": 0 }
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[runClient(port, path, deadline, results) for client in range(clients)])
+    return results
+
+async def getMetrics(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+    status, body, keepAlive = await readResponse(reader)
+    writer.close()
+    return json.loads(body)
+
+def main():
+    cmdLineParser = argparse.ArgumentParser(prog="HttpLoadBenchmark", usage="%(prog)s [options]")
+    cmdLineParser.add_argument("--servers", help="Comma separated servers to test: async, threaded (default: async,threaded)", type=str, default="async,threaded", required=False)
+    cmdLineParser.add_argument("--clients", help="Number of concurrent clients (default: 1000)", type=int, default=1000, required=False)
+    cmdLineParser.add_argument("--duration", help="Seconds of load per server (default: 10)", type=float, default=10, required=False)
+    cmdLineParser.add_argument("--inverters", help="Number of inverters in '/data' (default: 100)", type=int, default=100, required=False)
+    cmdLineParser.add_argument("--interval", help="Sampling interval in seconds (default: 1)", type=float, default=1, required=False)
+    cmdLineParser.add_argument("--ratelimit", help="Requests per second and client of the asynchronous server (default: 0, unlimited)", type=float, default=0, required=False)
+    cmdLineParser.add_argument("--path", help="Path requested by the clients (default: /data)", type=str, default="/data", required=False)
+    cmdLineParser.add_argument("--port", help="Port of the server (default: 8180)", type=int, default=8180, required=False)
+    args = cmdLineParser.parse_args()
+
+    for server in args.servers.split(","):
+        ready = multiprocessing.Event()
+        stop = multiprocessing.Event()
+        process = multiprocessing.Process(target=runServer, args=(server, args.port, args.inverters, args.interval, args.ratelimit, ready, stop))
+        process.start()
+        ready.wait(10)
+        time.sleep(0.2)
+
+        results = asyncio.run(runClients(args.port, args.clients, args.duration, args.path))
+        metrics = asyncio.run(getMetrics(args.port)) if server == "async" else None
+
+        stop.set()
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+
+        latencies = np.array(results["latencies"]) * 1000
+        p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (0, 0)
+        print("{:8}: {:6} clients, {:8.0f} responses/s, p50 {:8.1f} ms, p99 {:8.1f} ms, max {:8.1f} ms, errors {}, statuses {}".format(
+              server, args.clients, len(latencies) / args.duration, p50, p99, latencies.max() if len(latencies) else 0,
+              results["errors"], results["statuses"]))
+        if metrics:
+            print("          server side: {} requests, {} renders, latency {}".format(metrics["requests"], metrics["renders"], metrics["latency"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Compares the memory and the speed of plant wide loops of inverter nodes stored as dicts and as 'InverterState' records.
+#
+#  $ python3 benchmarks/InverterStateBenchmark.py --inverters=10000 --rounds=100
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from InverterState import InverterState
+
+def createNode(number):
+    return { "inverter": { "name": "SUNNY BOY 3.0", "host": "192.168.0.{}".format(number % 256), "port": 502, "unitId": 3, "maxOutput": 3000 },
+             "totalYieldLastYear": 1000000 + number,
+             "totalYieldCurrYear": 0,
+             "dayYield": 0,
+             "totalYield": 0,
+             "currentOutput": 0,
+             "maxPeakOutputDay": 0,
+             "maxPeakTime": "--:--",
+             "internalTemperature": 0.0,
+             "currentState": "ok",
+             "version": 0,
+             "sampleCycle": 0,
+             "sampleTime": 0 }
+
+def measureMemory(create, count):
+    tracemalloc.start()
+    nodes = [create(number) for number in range(count)]
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return nodes, size
+
+def runDicts(nodes, rounds):
+    startTime = time.perf_counter()
+    for cycle in range(rounds):
+        # What a sampling cycle writes ...
+        for node in nodes:
+            node["currentOutput"] = cycle
+            node["dayYield"] = node["dayYield"] + cycle
+            node["totalYieldCurrYear"] = node["totalYield"] - node["totalYieldLastYear"]
+            if node["currentOutput"] > node["maxPeakOutputDay"]:
+                node["maxPeakOutputDay"] = node["currentOutput"]
+        # ... and the plant totals read.
+        currentOutput = 0
+        dayYield = 0
+        for node in nodes:
+            currentOutput += node["currentOutput"]
+            dayYield += node["dayYield"]
+    return time.perf_counter() - startTime
+
+def runStates(nodes, rounds):
+    startTime = time.perf_counter()
+    for cycle in range(rounds):
+        for node in nodes:
+            node.currentOutput = cycle
+            node.dayYield = node.dayYield + cycle
+            node.totalYieldCurrYear = node.totalYield - node.totalYieldLastYear
+            if node.currentOutput > node.maxPeakOutputDay:
+                node.maxPeakOutputDay = node.currentOutput
+        currentOutput = 0
+        dayYield = 0
+        for node in nodes:
+            currentOutput += node.currentOutput
+            dayYield += node.dayYield
+    return time.perf_counter() - startTime
+
+def main():
+    cmdLineParser = argparse.ArgumentParser(prog="InverterStateBenchmark", usage="%(prog)s [options]")
+    cmdLineParser.add_argument("--inverters", help="Number of inverters (default: 10000)", type=int, default=10000, required=False)
+    cmdLineParser.add_argument("--rounds", help="Number of sampling cycles (default: 100)", type=int, default=100, required=False)
+    args = cmdLineParser.parse_args()
+
+    # The config subnode is the same for both layouts, so it isn't measured.
+    configs = [createNode(number)["inverter"] for number in range(args.inverters)]
+
+    dictNodes, dictSize = measureMemory(lambda number: dict(createNode(number), inverter=configs[number]), args.inverters)
+    stateNodes, stateSize = measureMemory(lambda number: InverterState.fromDict(dict(createNode(number), inverter=configs[number])), args.inverters)
+
+    dictTime = runDicts(dictNodes, args.rounds)
+    stateTime = runStates(stateNodes, args.rounds)
+
+    print("{} inverters, {} cycles".format(args.inverters, args.rounds))
+    print("{:<15}{:>18}{:>18}".format("layout", "bytes per node", "us per node/cycle"))
+    print("{:<15}{:>18.0f}{:>18.3f}".format("dict", dictSize / args.inverters, dictTime / (args.inverters * args.rounds) * 1e6))
+    print("{:<15}{:>18.0f}{:>18.3f}".format("InverterState", stateSize / args.inverters, stateTime / (args.inverters * args.rounds) * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Measures the MQTT publisher against a local broker stand-in: the cost of a change for the sampling thread,
+#  the throughput to the broker and the recovery from a broker outage.
+#
+#  $ python3 benchmarks/MqttBenchmark.py --inverters=10000 --cycles=20
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from InverterState import InverterState
+from MqttPublisher import MqttPublisher, CONNECT, PUBLISH, PINGREQ, DISCONNECT
+
+class BrokerStandIn():
+    # Accepts MQTT connections and keeps the latest payload of each topic. Just enough of a broker for QoS 0.
+    def __init__(self, port=0):
+        self.port = port
+        self.latest = dict()
+        self.published = 0
+        self.server = None
+        self.connections = list()
+
+    def start(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", self.port))
+        self.port = self.server.getsockname()[1]
+        self.server.listen()
+        threading.Thread(target=self.accept, args=(self.server,), daemon=True).start()
+
+    def stop(self):
+        # Wakes up the thread blocked in 'accept', so the port is free again.
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+        self.connections = list()
+
+    def accept(self, server):
+        while True:
+            try:
+                connection, address = server.accept()
+            except OSError:
+                return
+            self.connections.append(connection)
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection):
+        stream = connection.makefile("rb")
+        try:
+            while True:
+                header = stream.read(1)
+                if not header:
+                    return
+                length = 0
+                shift = 0
+                while True:
+                    digit = stream.read(1)[0]
+                    length += (digit & 0x7F) << shift
+                    shift += 7
+                    if not digit & 0x80:
+                        break
+                body = stream.read(length)
+                packetType = header[0] & 0xF0
+                if packetType == CONNECT:
+                    connection.sendall(bytes([0x20, 2, 0, 0]))
+                elif packetType == PUBLISH:
+                    topicLength = int.from_bytes(body[0:2], "big")
+                    self.latest[body[2:2 + topicLength].decode("utf-8")] = body[2 + topicLength:]
+                    self.published += 1
+                elif packetType == PINGREQ:
+                    connection.sendall(bytes([0xD0, 0]))
+                elif packetType == DISCONNECT:
+                    return
+        except (OSError, IndexError, ValueError):
+            return
+
+def runCycles(publisher, states, cycles, firstCycle):
+    # What the sampling thread does, if all inverters changed. Returns the seconds per change and the slowest cycle.
+    total = 0.0
+    slowest = 0.0
+    for cycle in range(firstCycle, firstCycle + cycles):
+        startTime = time.perf_counter()
+        for key, state in states.items():
+            state.currentOutput = cycle
+            state.version = cycle
+            publisher.onChange(key, state, None)
+        duration = time.perf_counter() - startTime
+        total += duration
+        slowest = max(slowest, duration)
+    return total / (cycles * len(states)), slowest
+
+def waitForVersion(broker, publisher, states, version, timeout=120):
+    # Waits until the broker got the given version of every inverter.
+    startTime = time.perf_counter()
+    expected = ('"version": {}}}'.format(version)).encode("utf-8")
+    while time.perf_counter() - startTime < timeout:
+        if all(broker.latest.get(publisher.topic + "/" + key, b"").endswith(expected) for key in states):
+            return time.perf_counter() - startTime
+        time.sleep(0.05)
+    return None
+
+def main():
+    cmdLineParser = argparse.ArgumentParser(prog="MqttBenchmark", usage="%(prog)s [options]")
+    cmdLineParser.add_argument("--inverters", help="Number of inverters (default: 10000)", type=int, default=10000, required=False)
+    cmdLineParser.add_argument("--cycles", help="Number of sampling cycles (default: 20)", type=int, default=20, required=False)
+    args = cmdLineParser.parse_args()
+
+    broker = BrokerStandIn()
+    broker.start()
+
+    states = dict()
+    for number in range(args.inverters):
+        states["inverter{}".format(number)] = InverterState({ "host": "127.0.0.1", "port": 502, "maxOutput": 3000 })
+    sharedDict = dict(states, Inverters=list(states), Suntimes={ "today": [0, 0, 0] })
+
+    publisher = MqttPublisher({ "host": "127.0.0.1", "port": broker.port, "maxQueue": args.inverters * 2 })
+    publisher.setSharedDict(sharedDict)
+    publisher.prepare()
+
+    print("{} inverters, {} cycles".format(args.inverters, args.cycles))
+
+    startTime = time.perf_counter()
+    perChange, slowest = runCycles(publisher, states, args.cycles, 1)
+    delivered = waitForVersion(broker, publisher, states, args.cycles)
+    elapsed = time.perf_counter() - startTime
+    statistics = publisher.getStatistics()
+    print("connected:     {:.2f} us per change, slowest cycle {:.1f} ms".format(perChange * 1e6, slowest * 1e3))
+    print("               all latest values at the broker after {:.2f} s, {:.0f} messages/s, {} batches, {} coalesced"
+          .format(elapsed, statistics["published"] / elapsed, statistics["batches"], statistics["coalesced"]))
+
+    # During an outage the queue holds the latest value per inverter only.
+    broker.stop()
+    time.sleep(0.5)
+    perChange, slowest = runCycles(publisher, states, args.cycles, args.cycles + 1)
+    statistics = publisher.getStatistics()
+    print("broker down:   {:.2f} us per change, slowest cycle {:.1f} ms, {} pending, {} dropped"
+          .format(perChange * 1e6, slowest * 1e3, statistics["pending"], statistics["dropped"]))
+
+    broker.start()
+    recovered = waitForVersion(broker, publisher, states, args.cycles * 2)
+    statistics = publisher.getStatistics()
+    print("broker back:   all latest values at the broker after {}, {} connects".format(
+          "{:.2f} s".format(recovered) if recovered is not None else "timeout", statistics["connects"]))
+
+    publisher.close()
+    if delivered is None:
+        print("Not all values were delivered!")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Measures the time from starting mbpv until '/data' is served and fails, if the median exceeds the budget.
+#
+#  $ python3 benchmarks/StartupBenchmark.py --config=./mbpv_config.json --runs=5 --budget=1000
+#
+#  The first run parses the config file, the following runs use its cache. The phases of each start are taken
+#  from the startup report in mbpv.log.
+#
+#  License: MIT
+#
+#  Copyright (c) 2019 Joerg Beckers
+
+import argparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+MBPV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mbpv.py")
+
+def getFreePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def readReport(directory):
+    # The phases of the last start, as written to mbpv.log.
+    report = None
+    try:
+        with open(os.path.join(directory, "mbpv.log")) as logFile:
+            for line in logFile:
+                if "Startup took" in line:
+                    report = line.strip().split(":", 2)[-1]
+    except OSError:
+        pass
+    return report
+
+def measureStart(configFileName, directory, timeout):
+    # Returns the seconds until '/data' answered and the startup report of the log.
+    port = getFreePort()
+    startTime = time.perf_counter()
+    process = subprocess.Popen([sys.executable, MBPV, "--port", str(port), "--config", configFileName],
+                               cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    served = None
+    try:
+        while time.perf_counter() - startTime < timeout and process.poll() is None:
+            try:
+                with urllib.request.urlopen("http://127.0.0.1:{}/data".format(port), timeout=timeout) as response:
+                    response.read()
+                served = time.perf_counter() - startTime
+                break
+            except OSError:
+                time.sleep(0.005)
+        # '/data' is served before the handlers are set up, so the report follows a bit later.
+        previous = readReport(directory)
+        while served is not None and time.perf_counter() - startTime < timeout and process.poll() is None:
+            if readReport(directory) != previous:
+                break
+            time.sleep(0.01)
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    return served, readReport(directory) or "no report"
+
+def main():
+    cmdLineParser = argparse.ArgumentParser(prog="StartupBenchmark", usage="%(prog)s [options]")
+    cmdLineParser.add_argument("--config", help="Config file to start with (default: mbpv_config.json)", type=str,
+                               default=os.path.join(os.path.dirname(MBPV), "mbpv_config.json"), required=False)
+    cmdLineParser.add_argument("--runs", help="Number of starts (default: 5)", type=int, default=5, required=False)
+    cmdLineParser.add_argument("--budget", help="Maximum median milliseconds until '/data' is served (default: 1000)", type=float, default=1000, required=False)
+    args = cmdLineParser.parse_args()
+
+    # mbpv writes its state and cache files next to the config, so it runs on a copy.
+    directory = tempfile.mkdtemp(prefix="mbpv-startup-")
+    try:
+        configFileName = os.path.join(directory, os.path.basename(args.config))
+        shutil.copyfile(args.config, configFileName)
+
+        durations = list()
+        for run in range(args.runs):
+            served, report = measureStart(configFileName, directory, max(10, args.budget / 100))
+            if served is None:
+                print("run {}: '/data' wasn't served".format(run + 1))
+                sys.exit(1)
+            durations.append(served)
+            print("run {}: '/data' served after {:.0f} ms ({})".format(run + 1, served * 1000, report))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    median = sorted(durations)[len(durations) // 2] * 1000
+    print("median {:.0f} ms, budget {:.0f} ms: {}".format(median, args.budget, "ok" if median <= args.budget else "exceeded"))
+    sys.exit(0 if median <= args.budget else 1)
+
+if __name__ == "__main__":
+    main()
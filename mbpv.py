@@ -7,157 +7,223 @@
 #  
 #  Copyright (c) 2019 Joerg Beckers
 
+# Imported first, so the startup report includes the time of all other imports.
+from Startup import StartupTimer
 import logging
 import json
 import os
 import argparse
-import requests
+from concurrent.futures import ThreadPoolExecutor
 from tzlocal import get_localzone
-from datetime import datetime, timedelta, time, timezone
+from datetime import datetime, time
 from raspend import RaspendApplication, ThreadHandlerBase, ScheduleRepetitionType
-from SMA_Inverters import SunnyBoy, SunnyBoyConstants
-from SunMoon import SunMoon
-
-class ReadSunnyBoy(ThreadHandlerBase):
-    def __init__(self, key, localTimeZone):
+from raspend.utils.commandmapping import CommandMap
+from SMA_Inverters import SunnyBoyConstants
+# The modules of the drivers are imported when the first inverter uses them (see 'Drivers.createDriver').
+from Drivers import createDriver
+from Suntimes import suntimesCache
+from ChangeFilter import ChangeFilter
+from PlantSampling import SamplePlant, AlignedWorkerThread, SchedulerMonitor
+from MultiPlant import PlantGroup, getPlantName, getPlantFileName, checkPlantNames, getMqttTopic, checkMqttTopics
+from InverterState import InverterState, toInverterStates, jsonDefault
+from HttpServer import MbpvHTTPServerThread
+
+class ReadInverter(ThreadHandlerBase):
+    def __init__(self, key, localTimeZone, deviceCache=None, clock=None, mbClient=None):
         self.key = key
         self.localTimeZone = localTimeZone
-        self.today = datetime.now(localTimeZone)
+        self.deviceCache = deviceCache
+        # A replay uses its own clock and a client answering with captured responses.
+        self.clock = clock
+        self.mbClient = mbClient
+        self.capture = None
+        # The plant's sampler replaces this by a filter shared by all inverters of the plant.
+        self.changeFilter = ChangeFilter()
+        # The plant's sampler reads all inverters at once instead (see 'SamplePlant.prepare').
+        self.readOnPrepare = True
+        # Shared by all inverters of the plant, so the forecast is computed once per day.
+        self.forecast = None
+        self.today = self.now()
         return
 
+    def now(self):
+        if self.clock:
+            return self.clock()
+        return datetime.now(self.localTimeZone)
+
+    def setCapture(self, capture, name):
+        self.capture = capture
+        self.captureName = name
+
+    def setChangeFilter(self, changeFilter):
+        self.changeFilter = changeFilter
+
+    def setForecast(self, forecast):
+        self.forecast = forecast
+
     def prepare(self):
-        thisDict = self.sharedDict[self.key]
+        # The node is an 'InverterState', which already holds the persisted peak and last year's total yield.
+        thisState = self.sharedDict[self.key]
 
-        if "maxPeakOutputDay" not in thisDict:
-            thisDict["maxPeakOutputDay"] = 0
-        if "totalYieldLastYear" not in thisDict:
-            thisDict["totalYieldLastYear"] = 0
-        if "maxPeakTime" not in thisDict:
-            thisDict["maxPeakTime"] = "--:--"
+        thisState.totalYieldCurrYear = 0
+        thisState.dayYield = 0
+        thisState.totalYield = 0
+        thisState.currentOutput = 0
+        thisState.internalTemperature = 0
+        thisState.currentState = SunnyBoyConstants.STATE_AS_STRING[SunnyBoyConstants.STATE_UNKNOWN]
 
-        thisDict["totalYieldCurrYear"] = 0
-        thisDict["dayYield"] = 0
-        thisDict["totalYield"] = 0
-        thisDict["currentOutput"] = 0
-        thisDict["internalTemperature"] = 0
-        thisDict["currentState"] = SunnyBoyConstants.STATE_AS_STRING[SunnyBoyConstants.STATE_UNKNOWN]
+        inverter = thisState.inverter
+        self.telemetry = inverter.get("telemetry", False)
+        unitId = self.getUnitId(inverter)
+        self.driver = createDriver(inverter, unitId, self.mbClient, self.deviceCache, self.now)
 
-        inverter = thisDict["inverter"]
-        self.sunnyBoy = SunnyBoy(inverter["host"], inverter["port"])
+        # Inverters behind the same gateway share host and port, so the discovered unit id is cached per inverter.
+        if unitId is None and self.deviceCache and self.driver.identity:
+            self.deviceCache.update(inverter["host"], inverter["port"], self.driver.identity, name=self.key)
 
-        self.getCurrentValues(thisDict, datetime.now(self.localTimeZone).time())
+        if self.capture:
+            self.driver.setCapture(self.capture, self.captureName)
+
+        if self.readOnPrepare:
+            self.getCurrentValues(thisState, self.now().time())
 
-        theUnit = self.sharedDict["Unit"]
-        self.sun = SunMoon(theUnit["location"]["longitude"], theUnit["location"]["latitude"], self.today)
         self.setSuntimes()
 
         return
 
+    def getUnitId(self, inverter):
+        # A configured unit id takes precedence over a cached one. 'None' lets the driver discover it.
+        if "unitId" in inverter:
+            return inverter["unitId"]
+        if self.deviceCache:
+            entry = self.deviceCache.lookup(inverter["host"], inverter["port"], name=self.key)
+            if entry:
+                return entry["unitId"]
+        return None
+
     def setSuntimes(self, dt=None):
         if dt == None:
             dt = self.today
 
-        if "Suntimes" not in self.sharedDict:
-            theSun = self.sharedDict["Suntimes"] = dict()
-        else:
-            theSun = self.sharedDict["Suntimes"]
+        theUnit = self.sharedDict["Unit"]
+        theSun = suntimesCache.getSuntimes(theUnit["location"]["longitude"], theUnit["location"]["latitude"], dt)
 
-        sunRiseSet = self.sun.GetSunRiseSet(dt)
+        self.sunrise = theSun["today"][0]
+        self.sunset = theSun["today"][2]
 
-        self.sunrise = datetime.fromtimestamp(sunRiseSet[0], self.localTimeZone).timestamp()
-        self.sunset  = datetime.fromtimestamp(sunRiseSet[2], self.localTimeZone).timestamp()
-        
-        theSun["today"] = sunRiseSet
-        theSun["yesterday"] = self.sun.GetSunRiseSet(dt - timedelta(1))
-        theSun["tomorrow"] = self.sun.GetSunRiseSet(dt + timedelta(1))
+        self.sharedDict["Suntimes"] = theSun
+        if self.forecast:
+            self.sharedDict["Forecast"] = self.forecast.getForecast(theUnit, dt)
         return
 
-    def getCurrentValues(self, thisDict, currentTime):
-        if self.sunnyBoy.readCurrentValues():
-            thisDict["dayYield"] = self.sunnyBoy.dayYield
-            thisDict["totalYield"] = self.sunnyBoy.totalYield
-            thisDict["currentOutput"] = self.sunnyBoy.currentOutput
-            thisDict["internalTemperature"] = self.sunnyBoy.internalTemperature
-            if self.sunnyBoy.currentState in SunnyBoyConstants.STATE_AS_STRING:
-                thisDict["currentState"] = SunnyBoyConstants.STATE_AS_STRING[self.sunnyBoy.currentState]
-            else:
-                thisDict["currentState"] = SunnyBoyConstants.STATE_AS_STRING[SunnyBoyConstants.STATE_UNKNOWN]
-
-            # Determine the maximum peak output value.
-            if self.sunnyBoy.currentOutput > thisDict["maxPeakOutputDay"]:
-                thisDict["maxPeakOutputDay"] = self.sunnyBoy.currentOutput
-                thisDict["maxPeakTime"] = currentTime.strftime("%H:%M")
+    def isDaylight(self, ts):
+        # Are we between sunrise and sunset? Only then the inverter values need to be read out.
+        # May not work for midnight sun regions (https://en.wikipedia.org/wiki/Midnight_sun).
+        return ts > (self.sunrise - 1800) and ts < (self.sunset + 1800)
 
-            thisDict["totalYieldCurrYear"] = self.sunnyBoy.totalYield - thisDict["totalYieldLastYear"]
+    def getCurrentValues(self, thisState, currentTime):
+        if self.driver.readCurrentValues():
+            self.setCurrentValues(thisState, currentTime)
         return
 
-    def invoke(self):
-        # Reference section of this handler within the sharedDict.
-        thisDict = self.sharedDict[self.key]
-
-        today = datetime.now(self.localTimeZone)
-        ts = int(today.timestamp())
-
-        # Are we between sunrise and sunset, then we read out the inverter values.
-        # May not work for midnight sun regions (https://en.wikipedia.org/wiki/Midnight_sun).
-        if ts > (self.sunrise - 1800) and ts < (self.sunset + 1800):
-            self.getCurrentValues(thisDict, today.time())
-
+    def setCurrentValues(self, thisState, currentTime):
+        # Returns the fields that changed beyond their deadbands.
+        if self.driver.currentState in SunnyBoyConstants.STATE_AS_STRING:
+            currentState = SunnyBoyConstants.STATE_AS_STRING[self.driver.currentState]
+        else:
+            currentState = SunnyBoyConstants.STATE_AS_STRING[SunnyBoyConstants.STATE_UNKNOWN]
+
+        # Determine the maximum peak output value.
+        if self.driver.currentOutput > thisState.maxPeakOutputDay:
+            thisState.maxPeakOutputDay = self.driver.currentOutput
+            thisState.maxPeakTime = currentTime.strftime("%H:%M")
+
+        # Extended telemetry is written with every sample, without deadbands and without bumping the version.
+        if self.telemetry:
+            thisState.dcInputs = self.driver.dcInputs
+            thisState.grid = self.driver.grid
+
+        return self.changeFilter.apply(self.key, thisState, { "dayYield": self.driver.dayYield,
+                                                              "totalYield": self.driver.totalYield,
+                                                              "currentOutput": self.driver.currentOutput,
+                                                              "internalTemperature": self.driver.internalTemperature,
+                                                              "currentState": currentState,
+                                                              "totalYieldCurrYear": self.driver.totalYield - thisState.totalYieldLastYear })
+
+    def checkDayChange(self, thisState, today):
         # Check if day changed, then reset maxPeakOutputDay.
         if today.weekday() != self.today.weekday():
-            thisDict["maxPeakOutputDay"] = 0
-            thisDict["maxPeakTime"] = "--:--"
+            thisState.maxPeakOutputDay = 0
+            thisState.maxPeakTime = "--:--"
 
             # If the year changes too, then we need to save the total yield of last year, 
             # because the inverter always increments the total yield.
             if today.year > self.today.year:
-                thisDict["totalYieldLastYear"] += thisDict["totalYieldCurrYear"]
-                thisDict["totalYieldCurrYear"] = 0
+                thisState.totalYieldLastYear += thisState.totalYieldCurrYear
+                thisState.totalYieldCurrYear = 0
 
             # Update sunrise and -set information.
             self.setSuntimes(today)
 
             # Save the new day as today.
             self.today = today
+        return
+
+    def invoke(self):
+        # Reference the state of this handler's inverter within the sharedDict.
+        thisState = self.sharedDict[self.key]
+
+        today = self.now()
 
+        if self.isDaylight(int(today.timestamp())):
+            self.getCurrentValues(thisState, today.time())
+
+        self.checkDayChange(thisState, today)
         return
 
 class PublishInverterPeaksToFile(ThreadHandlerBase):
     def __init__(self, fileName):
+        from PeakLog import PeakLog
         self.fileName = fileName
+        # The peaks and the daily statistics are logged to binary files, the csv file is exported from them.
+        self.peakLog = PeakLog(fileName)
+        # The files are written by a thread of their own, so the fsync of the peak log and the export of the csv file
+        # (growing with the log) don't happen while holding the access lock.
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mbpv-peaks")
 
     def prepare(self):
-        # Create a csv file to store the peak values.
-        if not os.path.isfile(self.fileName):
-            try:
-                csvFile = open(self.fileName, "wt")
-                inverters = self.sharedDict["Inverters"]
-                header = "Date,"
-                for inverter in inverters:
-                    header += inverter + ","
-                header = header[:-1] + "\n"
-                csvFile.write(header)
-                csvFile.close()
-            except IOError as e:
-                logging.error("Unable to open csv file '{}'! Error: {}".format(self.fileName, e))
-
-    def saveInverterPeaks(self):
-        tNow = datetime.now()
-        strLine = "{}-{:02d}-{:02d},".format(tNow.year, tNow.month, tNow.day)
-        inverters = self.sharedDict["Inverters"]
-        for inverter in inverters:
-            strLine += str(self.sharedDict[inverter]["maxPeakOutputDay"]) + ","
-        strLine = strLine[:-1] + "\n"
+        self.peakLog.importCsv()
+
+    def close(self):
+        self.writer.shutdown()
+        self.peakLog.close()
+
+    def collectInverterPeaks(self):
+        peaks = list()
+        for inverter in self.sharedDict["Inverters"]:
+            inverterState = self.sharedDict[inverter]
+            peaks.append((inverter, inverterState.maxPeakOutputDay, inverterState.maxPeakTime))
+        if "Plant" in self.sharedDict:
+            peaks.append(("Plant", self.sharedDict["Plant"]["maxPeakOutputDay"], self.sharedDict["Plant"]["maxPeakTime"]))
+        return peaks
+
+    def collectStatistics(self):
+        if "Statistics" not in self.sharedDict:
+            return None
+        return dict(self.sharedDict["Statistics"])
+
+    def save(self, day, peaks, theStatistics):
+        # The day's statistics are stored together with its peaks.
         try:
-            csvFile = open(self.fileName, "at")
-            csvFile.write(strLine)
-            csvFile.close()
+            if self.peakLog.add(day, peaks, theStatistics):
+                self.peakLog.exportCsv()
         except IOError as e:
-            logging.error("Unable to open csv file '{}'! Error: {}".format(self.fileName, e))
+            logging.error("Unable to write peak log '{}'! Error: {}".format(self.peakLog.fileName, e))
         return
 
     def invoke(self):
-        self.saveInverterPeaks()
+        # Only the values are collected while holding the access lock.
+        self.writer.submit(self.save, datetime.now().date(), self.collectInverterPeaks(), self.collectStatistics())
         return
 
 class PublishPVUnitValuesToPVOutput(ThreadHandlerBase):
@@ -175,11 +241,20 @@ class PublishPVUnitValuesToPVOutput(ThreadHandlerBase):
         maxPeakOutputDay = 0
         maxPeakTime = "--:--"
         for inverter in self.sharedDict["Inverters"]:
-            totalOutputDay += self.sharedDict[inverter]["dayYield"]
-            maxPeakOutputDay += self.sharedDict[inverter]["maxPeakOutputDay"]
+            inverterState = self.sharedDict[inverter]
+            totalOutputDay += inverterState.dayYield
+            maxPeakOutputDay += inverterState.maxPeakOutputDay
             # I would assume that both inverters have the same peak time, but if not, then we take the later one.
-            if maxPeakTime < self.sharedDict[inverter]["maxPeakTime"]:
-                maxPeakTime = self.sharedDict[inverter]["maxPeakTime"]
+            if maxPeakTime < inverterState.maxPeakTime:
+                maxPeakTime = inverterState.maxPeakTime
+
+        # Prefer the true plant peak taken from time aligned samples over the sum of the inverters' peaks.
+        if "Plant" in self.sharedDict and self.sharedDict["Plant"]["maxPeakOutputDay"] > 0:
+            maxPeakOutputDay = self.sharedDict["Plant"]["maxPeakOutputDay"]
+            maxPeakTime = self.sharedDict["Plant"]["maxPeakTime"]
+
+        # Only needed once a day, so it isn't imported at startup.
+        import requests
 
         headers = {"X-Pvoutput-Apikey" : self.apiKey,
                    "X-Pvoutput-SystemId" : self.systemId}
@@ -193,26 +268,22 @@ class PublishPVUnitValuesToPVOutput(ThreadHandlerBase):
 
         return
 
-class PersistConfigFile(ThreadHandlerBase):
-    def __init__(self, configFileName, mbpvData, PVOutput):
-        self.configFileName = configFileName
-        self.mbpvData = mbpvData
-        self.PVOutput = PVOutput
+def getPersistentData(mbpvData, privateNodes):
+    mbpvData = mbpvData.copy()
 
-    def prepare(self):
-        pass
+    # Remove items from dict which not need to be stored.
+    for key in ["Suntimes", "Forecast", "Plant", "Statistics", "Analytics", "MQTTStatus"]:
+        if key in mbpvData:
+            del(mbpvData[key])
 
-    def invoke(self):
-        mbpvData = self.mbpvData.copy()
+    # The runtime counters of the inverters are kept in the state journal.
+    for inverter in mbpvData["Inverters"]:
+        if isinstance(mbpvData[inverter], InverterState):
+            mbpvData[inverter] = mbpvData[inverter].toConfig()
 
-        if "Suntimes" in mbpvData:
-            del(mbpvData["Suntimes"])
-        
-        if self.PVOutput:
-            mbpvData["PVOutput.org"] = self.PVOutput
+    mbpvData.update(privateNodes)
 
-        saveConfigData(self.configFileName, mbpvData)
-        return
+    return mbpvData
 
 def loadConfigData(configFileName):
     data = None
@@ -231,14 +302,16 @@ def loadConfigData(configFileName):
     return data
 
 def saveConfigData(configFileName, mbpvData):
+    from StateJournal import replaceFile
     try:
-        with open(configFileName, 'w') as outfile:
-            json.dump(mbpvData, outfile, indent=2)
-            outfile.close()
+        replaceFile(configFileName, json.dumps(mbpvData, indent=2, default=jsonDefault))
     except Exception as e:
         logging.error("Writing {} failed! Error: {}".format(configFileName, e))
 
 def main():
+    startupTimer = StartupTimer()
+    startupTimer.mark("imports")
+
     localTimeZone = get_localzone()
 
     logging.basicConfig(filename='mbpv.log', level=logging.INFO)
@@ -248,49 +321,300 @@ def main():
     # Check commandline arguments.
     cmdLineParser = argparse.ArgumentParser(prog="mbpv", usage="%(prog)s [options]")
     cmdLineParser.add_argument("--port", help="The port the server should listen on", type=int, required=True)
-    cmdLineParser.add_argument("--config", help="Path to the config file", type=str, required=True)
+    cmdLineParser.add_argument("--config", help="Path to the config file, several files for serving several plants", type=str, nargs="+", required=True)
+    cmdLineParser.add_argument("--asyncport", help="The port of the asynchronous HTTP front end for many clients (default: none)", type=int, required=False)
+    cmdLineParser.add_argument("--ratelimit", help="Requests per second and client served by the asynchronous front end (default: 0, unlimited)", type=float, default=0, required=False)
     cmdLineParser.add_argument("--peaklog", help="Path to the log file for inverter peak values", type=str, required=False)
+    cmdLineParser.add_argument("--interval", help="The sampling interval in seconds (default: 1)", type=float, default=1, required=False)
+    cmdLineParser.add_argument("--overrun", help="What to do with the ticks passed while a sampling cycle overran: skip (default), coalesce or catchup", type=str, choices=AlignedWorkerThread.POLICIES, default="skip", required=False)
+    cmdLineParser.add_argument("--processes", help="Number of worker processes sampling the inverters (default: 0, sample within the server process)", type=int, default=0, required=False)
+    cmdLineParser.add_argument("--capture", help="Path to a file recording all raw Modbus responses", type=str, required=False)
+    cmdLineParser.add_argument("--replay", help="Path to a capture file to replay instead of reading the inverters", type=str, required=False)
+    cmdLineParser.add_argument("--replayspeed", help="Acceleration factor of the replay, 0 replays as fast as possible (default: 1)", type=float, default=1, required=False)
+    cmdLineParser.add_argument("--history", help="Path to the directory storing the history of the inverters' values", type=str, required=False)
+    cmdLineParser.add_argument("--devicecache", help="Path to the cache file for discovered inverter identities", type=str, required=False)
+    cmdLineParser.add_argument("--scan", help="Subnet to scan for inverters, e.g. 192.168.178.0/24", type=str, required=False)
+    cmdLineParser.add_argument("--scanports", help="Comma separated list of ports to scan", type=str, default="502", required=False)
 
     try: 
         args = cmdLineParser.parse_args()
     except SystemExit:
         return
 
-    mbpvData = loadConfigData(args.config)
+    plants = list()
+    for configFileName in args.config:
+        mbpvData = loadConfigData(configFileName)
+
+        if not mbpvData:
+            print("Error loading configuration, see log for details.")
+            return
+
+        # The credentials for PVOutput and the MQTT broker must not be exposed via HTTP.
+        privateNodes = dict()
+        for key in ["PVOutput.org", "MQTT"]:
+            if key in mbpvData:
+                privateNodes[key] = mbpvData[key]
+                del(mbpvData[key])
 
-    if not mbpvData:
-        print("Error loading configuration, see log for details.")
+        plants.append((configFileName, getPlantName(configFileName), mbpvData, privateNodes))
+
+    startupTimer.mark("config")
+
+    multiPlant = len(plants) > 1
+    if multiPlant:
+        try:
+            checkPlantNames(plantName for configFileName, plantName, mbpvData, privateNodes in plants)
+            checkMqttTopics(getMqttTopic(privateNodes["MQTT"], plantName, multiPlant)
+                            for configFileName, plantName, mbpvData, privateNodes in plants if "MQTT" in privateNodes)
+        except ValueError as e:
+            print(e)
+            return
+
+    if multiPlant and args.processes > 0:
+        print("Worker processes can't be used with several plants.")
         return
 
-    myApp = RaspendApplication(args.port, mbpvData)
+    if args.processes > 0 and (args.capture or args.replay):
+        print("Capturing and replaying can't be used with worker processes.")
+        return
 
-    for inverter in mbpvData["Inverters"]:
-        myApp.createWorkerThread(ReadSunnyBoy(inverter, localTimeZone), 1)
+    if args.processes > 0 and args.history:
+        print("The history can't be recorded with worker processes.")
+        return
+
+    if args.processes > 0 and any(mbpvData[inverter]["inverter"].get("telemetry", False) for configFileName, plantName, mbpvData, privateNodes in plants
+                                  for inverter in mbpvData["Inverters"]):
+        print("Extended telemetry can't be read with worker processes.")
+        return
+
+    if args.processes > 0 and any("MQTT" in privateNodes for configFileName, plantName, mbpvData, privateNodes in plants):
+        print("Publishing to MQTT isn't possible with worker processes.")
+        return
+
+    deviceCache = None
+    if args.devicecache:
+        from Discovery import DeviceCache
+        # A replay uses the identities of the devices, but mustn't overwrite them (e.g. the SunSpec day start).
+        deviceCache = DeviceCache(args.devicecache, readOnly=args.replay is not None)
+
+    # From here on the inverter nodes are 'InverterState' records.
+    # Their runtime counters are restored from the state journal. A replay must not touch the plant's state.
+    journals = list()
+    for configFileName, plantName, mbpvData, privateNodes in plants:
+        toInverterStates(mbpvData)
+        if not args.replay:
+            from StateJournal import StateJournal
+            journals.append(StateJournal(configFileName, localTimeZone))
+            journals[-1].setSharedDict(mbpvData)
+            journals[-1].recover()
+
+    startupTimer.mark("journal")
+
+    if args.scan:
+        from Discovery import scanNetwork, addDiscoveredInverters
+        # Discovered inverters are added to the first plant.
+        configFileName, plantName, mbpvData, privateNodes = plants[0]
+        ports = [int(port) for port in args.scanports.split(",")]
+        if addDiscoveredInverters(mbpvData, scanNetwork(args.scan, ports), deviceCache) > 0:
+            toInverterStates(mbpvData)
+            saveConfigData(configFileName, getPersistentData(mbpvData, privateNodes))
+        startupTimer.mark("scan")
+
+    # With several plants, each plant is served under its own node, e.g. '/data/plant1'.
+    if multiPlant:
+        sharedDict = { "Plants": [plantName for configFileName, plantName, mbpvData, privateNodes in plants] }
+        for configFileName, plantName, mbpvData, privateNodes in plants:
+            sharedDict[plantName] = mbpvData
+    else:
+        sharedDict = plants[0][2]
+
+    # The HTTP server is started by us, since it has to serve the JSON views of the inverter states.
+    myApp = RaspendApplication(None, sharedDict)
+    histories = dict()
+    peakLogs = dict()
+    # The timing of the aligned sampling is served at '/scheduler'.
+    schedulerMonitor = SchedulerMonitor(args.interval, args.overrun) if args.processes == 0 and not args.replay else None
+    commandMap = CommandMap()
+    httpd = MbpvHTTPServerThread(myApp.getShutdownFlag(), myApp.getAccessLock(), sharedDict, commandMap, args.port, histories, localTimeZone, peakLogs, schedulerMonitor)
+    # '/data' is served right away, while the handlers are set up. If setting them up fails, the server mustn't
+    # keep the process alive.
+    httpd.daemon = True
+    httpd.start()
+
+    asyncHttpd = None
+    if args.asyncport:
+        from AsyncHttpServer import AsyncHTTPServerThread
+        # A rendered '/data' is reused for at most half an interval.
+        asyncHttpd = AsyncHTTPServerThread(myApp.getShutdownFlag(), myApp.getAccessLock(), sharedDict, commandMap, args.asyncport, schedulerMonitor,
+                                           args.ratelimit, min(AsyncHTTPServerThread.CACHE_SECONDS, args.interval / 2))
+        asyncHttpd.daemon = True
+        asyncHttpd.start()
+    startupTimer.mark("http")
+
+    sampler = None
+    shardedAcquisition = None
+
+    capture = None
+    if args.capture:
+        from Capture import CaptureWriter
+        capture = CaptureWriter(args.capture)
+
+    replayClock = None
+    replayClients = dict()
+    if args.replay:
+        from Capture import ReplayClient, ReplayClock, ReplayWorkerThread, getCaptureStartTime, readCaptureCycles
+        replayClock = ReplayClock(localTimeZone, getCaptureStartTime(args.replay))
+
+    samplePlants = list()
+    peakLoggers = list()
+    publishers = list()
+    analytics = list()
+    mqttPublishers = list()
+
+    for configFileName, plantName, mbpvData, privateNodes in plants:
+        plantHandlers = list()
+
+        if args.processes > 0:
+            # The inverters are sampled by worker processes, this process only serves their values.
+            from Sharding import ShardedAcquisition, ReadLiveTable
+            shardedAcquisition = ShardedAcquisition(ReadInverter, mbpvData, localTimeZone, args.interval, args.processes, args.devicecache)
+            liveTableReader = ReadLiveTable(shardedAcquisition, localTimeZone)
+            myApp.createWorkerThread(liveTableReader, args.interval)
+            if len(mbpvData["Inverters"]) > 1 and mbpvData.get("Anomalies", dict()).get("enabled", True):
+                from Anomalies import AnomalyDetector
+                liveTableReader.setAnomalyDetector(AnomalyDetector(mbpvData.get("Anomalies"), args.interval))
+        else:
+            # All inverters are read out at the same wall clock ticks, so their values can be summed up consistently.
+            readers = list()
+            for inverter in mbpvData["Inverters"]:
+                # Captured responses are recorded per plant and inverter.
+                captureName = plantName + "/" + inverter if multiPlant else inverter
+                if args.replay:
+                    replayClients[captureName] = ReplayClient(captureName)
+                    readers.append(ReadInverter(inverter, localTimeZone, deviceCache, replayClock, replayClients[captureName]))
+                else:
+                    readers.append(ReadInverter(inverter, localTimeZone, deviceCache))
+                if capture:
+                    readers[-1].setCapture(capture, captureName)
+            samplePlants.append(SamplePlant(readers, localTimeZone, args.interval * 0.8, replayClock))
+            plantHandlers.append(samplePlants[-1])
+            if schedulerMonitor:
+                schedulerMonitor.addPlant(plantName if multiPlant else None, samplePlants[-1])
+            # The inverters of a plant are compared with each other at each cycle. numpy takes a while to import.
+            if len(readers) > 1 and mbpvData.get("Anomalies", dict()).get("enabled", True):
+                from Anomalies import AnomalyDetector
+                samplePlants[-1].setAnomalyDetector(AnomalyDetector(mbpvData.get("Anomalies"), args.interval))
+            # Replayed samples would be recorded to the plant's history under their captured timestamps.
+            if args.history and not args.replay:
+                from History import History
+                history = History(os.path.join(args.history, plantName) if multiPlant else args.history, localTimeZone)
+                histories[plantName if multiPlant else None] = history
+                samplePlants[-1].setHistory(history)
+
+        if args.peaklog:
+            peakLoggers.append(PublishInverterPeaksToFile(getPlantFileName(args.peaklog, plantName) if multiPlant else args.peaklog))
+            plantHandlers.append(peakLoggers[-1])
+            peakLogs[plantName if multiPlant else None] = peakLoggers[-1].peakLog
+
+        # The dailies are stored next to the config file, like the state journal.
+        if not args.replay:
+            # numpy takes a while to import.
+            from Analytics import Analytics
+            from Forecast import Forecast
+            analytics.append(Analytics(configFileName))
+            plantHandlers.append(analytics[-1])
+            # The report of the start up is published again, once the inverters' yields were read.
+            if args.processes > 0:
+                liveTableReader.setAnalytics(analytics[-1])
+            else:
+                samplePlants[-1].setAnalytics(analytics[-1])
+
+            # The forecast is based on the dailies and set at the day's rollover, like the Suntimes.
+            forecast = Forecast(configFileName, localTimeZone)
+            if args.processes > 0:
+                liveTableReader.setForecast(forecast)
+            else:
+                for reader in readers:
+                    reader.setForecast(forecast)
+
+        if "PVOutput.org" in privateNodes:
+            PVOutput = privateNodes["PVOutput.org"]
+            publishers.append(PublishPVUnitValuesToPVOutput(PVOutput["apiKey"], PVOutput["systemId"]))
+            plantHandlers.append(publishers[-1])
+
+        # Changes are pushed to the broker by the sampling thread, the Suntimes are checked every minute.
+        if "MQTT" in privateNodes and not args.replay:
+            from MqttPublisher import MqttPublisher
+            mqttPublishers.append(MqttPublisher(privateNodes["MQTT"], "mbpv-" + plantName, getMqttTopic(privateNodes["MQTT"], plantName, multiPlant)))
+            samplePlants[-1].addChangeListener(mqttPublishers[-1].onChange)
+            plantHandlers.append(mqttPublishers[-1])
+
+        # Bind the handlers to their plant's part of the shared dictionary.
+        for handler in plantHandlers:
+            handler.setSharedDict(mbpvData)
+
+    # One thread per task serves all plants.
+    if len(samplePlants):
+        plantSampler = PlantGroup(samplePlants)
+        plantSampler.setSharedDict(myApp.getSharedDict())
+        plantSampler.setShutdownFlag(myApp.getShutdownFlag())
+        if args.replay:
+            sampler = ReplayWorkerThread(myApp.getShutdownFlag(), myApp.getAccessLock(), plantSampler, 
+                                         readCaptureCycles(args.replay, args.interval), replayClients, replayClock, args.replayspeed)
+        else:
+            sampler = AlignedWorkerThread(myApp.getShutdownFlag(), myApp.getAccessLock(), plantSampler, args.interval, args.overrun, schedulerMonitor)
 
     # Data acquisition resets the peak values at midnight.
-    myApp.createScheduledWorkerThread(PublishInverterPeaksToFile(args.peaklog), time(23, 0), None, ScheduleRepetitionType.DAILY)
+    # Replayed peaks would replace today's in the peak log.
+    if len(peakLoggers) and not args.replay:
+        myApp.createScheduledWorkerThread(PlantGroup(peakLoggers), time(23, 0), None, ScheduleRepetitionType.DAILY)
 
-    PVOutput = None
-    if "PVOutput.org" in mbpvData:
-        PVOutput = mbpvData["PVOutput.org"]
-        del(mbpvData["PVOutput.org"])
-        myApp.createScheduledWorkerThread(PublishPVUnitValuesToPVOutput(PVOutput["apiKey"], PVOutput["systemId"]), 
-                                          time(23, 30), 
-                                          None, 
-                                          ScheduleRepetitionType.DAILY)
+    if len(publishers) and not args.replay:
+        myApp.createScheduledWorkerThread(PlantGroup(publishers), time(23, 30), None, ScheduleRepetitionType.DAILY)
 
-    myApp.createScheduledWorkerThread(PersistConfigFile(args.config, mbpvData, PVOutput), time(23, 55), None, ScheduleRepetitionType.DAILY);
+    # The day's yield is final after sunset.
+    if len(analytics):
+        myApp.createScheduledWorkerThread(PlantGroup(analytics), time(23, 45), None, ScheduleRepetitionType.DAILY)
 
-    myApp.run()
+    if len(mqttPublishers):
+        myApp.createWorkerThread(PlantGroup(mqttPublishers), 60)
 
-    if PVOutput:
-        mbpvData["PVOutput.org"] = PVOutput
+    # The journals are already bound to their plants.
+    if len(journals):
+        myApp.createWorkerThread(PlantGroup(journals), StateJournal.CHECKPOINT_INTERVAL)
 
-    # Remove items from dict which not need to be stored.
-    if "Suntimes" in mbpvData:
-        del(mbpvData["Suntimes"])
+    startupTimer.mark("handlers")
+
+    if sampler:
+        sampler.start()
+    # The worker processes are spawned, so they neither inherit the threads nor the listening sockets of the HTTP servers.
+    if shardedAcquisition:
+        shardedAcquisition.start()
+
+    startupTimer.mark("threads")
+    startupTimer.report()
+
+    myApp.run()
 
-    saveConfigData(args.config, mbpvData)
+    myApp.getShutdownFlag().set()
+    httpd.join()
+    if asyncHttpd:
+        asyncHttpd.join()
+    if sampler:
+        sampler.join()
+    if shardedAcquisition:
+        shardedAcquisition.stop()
+    if capture:
+        capture.close()
+    for history in histories.values():
+        history.close()
+    for peakLogger in peakLoggers:
+        peakLogger.close()
+    for mqttPublisher in mqttPublishers:
+        mqttPublisher.close()
+
+    for journal in journals:
+        journal.close()
 
     logging.info("Stopped at {} (PID={})".format(datetime.now(localTimeZone), os.getpid()))
 